@@ -0,0 +1,41 @@
+"""
+Helpers shared by the benchmark scripts: loading a pyp.py from any checkout (for the
+--module options), and measuring peak memory, each measurement in a process of its own.
+"""
+import os
+import sys
+import gc
+import imp
+import resource
+import multiprocessing
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The pyp.py in this tree, the default for --module
+DEFAULT_PYP = os.path.join(BENCH_DIR, os.pardir, 'pyp.py')
+
+
+# Imports the pyp.py at path as the module pyp (it imports pyp_runtime from its own directory)
+def load_pyp(path):
+    sys.path.insert(0, os.path.dirname(path))
+    return imp.load_source('pyp', path)
+
+
+# Calls func(*args), returns (its result, how much the peak RSS of this process grew
+# meanwhile, in KB). ru_maxrss only ever goes up, so this needs a fresh process (see
+# run_isolated) to be the peak of func itself.
+def measure_peak_kb(func, *args):
+    gc.collect()
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result = func(*args)
+    return (result, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss)
+
+
+# Yields func(task) for each task, in order, each run in a new worker process
+def run_isolated(func, tasks):
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for result in pool.imap(func, tasks):
+            yield result
+    finally:
+        pool.terminate()
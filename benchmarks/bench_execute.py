@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+Compares executing generated template code in-process (compile + exec, what
+pyp.py does now) against the old path of writing the script to a temp file and
+importing it with runpy.run_module.
+
+    python benchmarks/bench_execute.py [-n REPEAT]
+"""
+import os
+import sys
+import time
+import runpy
+import tempfile
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import pyp
+
+
+def make_template(num_lines):
+    lines = ["% x = 5"]
+    for i in range(num_lines):
+        if i % 4 == 0:
+            lines.append("line %d has ${x + %d} and ${'abc' * 2}" % (i, i))
+        else:
+            lines.append("plain text line %d" % i)
+    return "\n".join(lines)
+
+
+# The execution path pyp.py used before compiling in-process
+def run_runpy(python_text, output):
+    def _PRINT(line):
+        output.write(line + "\n")
+
+    pyfile = tempfile.NamedTemporaryFile(suffix='.py')
+    pyfile.write(python_text)
+    pyfile.flush()
+    sys.path.append(os.path.dirname(pyfile.name))
+    modname = os.path.split(pyfile.name)[1].replace('.py','')
+    runpy.run_module(modname, init_globals=pyp.make_namespace(_PRINT))
+    pyfile.close()
+
+
+def run_exec(python_text, output, code=None):
+    def _PRINT(line):
+        output.write(line + "\n")
+
+    if code is None:
+        code = compile(python_text, "bench.pyp", 'exec')
+    exec code in pyp.make_namespace(_PRINT)
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=20, help='Runs per measurement')
+    options = parser.parse_args()
+
+    output = open(os.devnull, 'w')
+    syspath_len = len(sys.path)
+    try:
+        print "%-10s %12s %12s %8s %14s" % ("lines", "runpy (ms)", "exec (ms)", "speedup", "cached (ms)")
+        for num_lines in (10, 100, 1000, 10000, 100000):
+            pypparser = pyp.PYPParser(make_template(num_lines), input_filename="bench.pyp")
+            python_text = pypparser.parse()
+
+            runpy_time = best_time(lambda: run_runpy(python_text, output), options.repeat)
+            exec_time = best_time(lambda: run_exec(python_text, output), options.repeat)
+
+            # exec of an already compiled code object, i.e. a compile cache hit
+            code = compile(python_text, "bench.pyp", 'exec')
+            cached_time = best_time(lambda: run_exec(python_text, output, code), options.repeat)
+
+            print "%-10d %12.3f %12.3f %7.1fx %14.3f" % (num_lines, runpy_time*1000, exec_time*1000,
+                                                         runpy_time/exec_time, cached_time*1000)
+
+        print
+        print "sys.path entries leaked by runpy path: %d" % (len(sys.path) - syspath_len)
+    finally:
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Measures the memory used by parsing a large template: the size of the parse tree
+(nodes, their attribute storage and what they hold, walked with sys.getsizeof), the
+size of the generated-line -> pyp-line map, and the peak RSS growth of a full parse().
+Each measurement runs in a fresh process. --module loads pyp from another file, for
+comparing against an older version.
+
+Python 2 has no tracemalloc, so sizes come from sys.getsizeof and ru_maxrss instead.
+
+    python benchmarks/bench_memory.py [--lines 100000] [--module old/pyp.py]
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+from _common import DEFAULT_PYP, load_pyp, measure_peak_kb, run_isolated
+import bench_parse_scaling
+
+
+# Total size of obj and everything reachable from it through containers and node
+# attributes (each object counted once). Strings shared with other objects count too.
+def deep_sizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, dict):
+        for (key, value) in obj.iteritems():
+            size += deep_sizeof(key, seen) + deep_sizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_sizeof(item, seen)
+    elif not isinstance(obj, (str, unicode, int, long, float, bool, type(None))):
+        if hasattr(obj, '__dict__'):
+            size += deep_sizeof(obj.__dict__, seen)
+        for cls in type(obj).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(obj, name):
+                    size += deep_sizeof(getattr(obj, name), seen)
+    return size
+
+def count_nodes(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    count = 1
+    for child in getattr(obj, 'nodes', []) or []:
+        count += count_nodes(child, seen)
+    for block in getattr(obj, 'control_blocks', []) or []:
+        count += 1
+        for child in block.nodes:
+            count += count_nodes(child, seen)
+    return count
+
+
+# Runs in a worker process: returns (tree bytes, node count, line map bytes, line map
+# entries, peak RSS growth of parse() in KB, parse time)
+def measure(task):
+    (module_path, num_lines) = task
+    pyp = load_pyp(module_path)
+    text = bench_parse_scaling.make_template(num_lines)
+
+    def parse():
+        start = time.time()
+        pyp.PYPParser(text).parse()
+        return time.time() - start
+    (elapsed, peak_kb) = measure_peak_kb(parse)
+
+    # the tree itself, parsed again to get hold of the sequence
+    sequence = pyp.PythonSequence()
+    sequence.parse_lines(pyp.tokenize(text))
+    sequence.get_python_text()
+    line_map = sequence.python_line_map
+    sequence.python_line_map = None
+    tree_bytes = deep_sizeof(sequence, set())
+    nodes = count_nodes(sequence, set())
+    line_map_bytes = deep_sizeof(line_map, set())
+
+    return (tree_bytes, nodes, line_map_bytes, len(line_map), peak_kb, elapsed)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--lines', dest='lines', type=int, default=100000, help='Template size in lines')
+    parser.add_argument('--module', dest='module', default=DEFAULT_PYP,
+                        help='pyp.py to measure (default: the one in this tree)')
+    options = parser.parse_args()
+
+    [(tree_bytes, nodes, line_map_bytes, line_map_len, peak_kb, elapsed)] = \
+        run_isolated(measure, [(os.path.abspath(options.module), options.lines)])
+
+    print "template:         %d lines (%s)" % (options.lines, options.module)
+    print "parse tree:       %.1f MB in %d nodes (%.0f bytes/node)" % (tree_bytes / 1e6, nodes,
+                                                                     float(tree_bytes) / nodes)
+    print "line map:         %.2f MB for %d entries" % (line_map_bytes / 1e6, line_map_len)
+    print "parse() peak RSS: +%.1f MB" % (peak_kb / 1024.0)
+    print "parse() time:     %.2fs" % elapsed
+
+
+if __name__ == "__main__":
+    main()
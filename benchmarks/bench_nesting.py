@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""
+Measures rendering deeply nested pypdef calls, where each pypdef outputs the ones it
+calls: the best render time and the peak RSS growth of one render, for fragment trees
+of several shapes. Each measurement runs in a fresh process. --module loads pyp from
+another file, for comparing against an older version.
+
+    chain   one pypdef per level, each outputs --lines lines and the level below it
+    tree    a binary tree of pypdef calls, text at every node
+    value   the chain, but each level uses the one below as a value (${len(x)} and ${x})
+
+    python benchmarks/bench_nesting.py [--depth 500] [--lines 10] [--fanout-depth 14] [--module old/pyp.py]
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+from _common import DEFAULT_PYP, load_pyp, measure_peak_kb, run_isolated
+
+CHAIN = """\
+% pypdef level(depth):
+<div class="level-${depth}">
+% for i in range(LINES):
+  line ${i} of the static text at this level, long enough for copying it to show
+% endfor
+  % if depth:
+${level(depth - 1)}
+  % endif
+</div>
+% endpypdef
+${level(DEPTH)}
+"""
+
+TREE = """\
+% pypdef node(depth, label):
+<node ${label}>
+  % if depth:
+${node(depth - 1, label + 'l')}
+${node(depth - 1, label + 'r')}
+  % endif
+</node>
+% endpypdef
+${node(DEPTH, 'n')}
+"""
+
+VALUE = """\
+% pypdef level(depth):
+<div class="level-${depth}">
+% for i in range(LINES):
+  line ${i} of the static text at this level, long enough for copying it to show
+% endfor
+  % if depth:
+  % inner = level(depth - 1)
+${len(inner)} characters below
+${inner}
+  % endif
+</div>
+% endpypdef
+${level(DEPTH)}
+"""
+
+SHAPES = [('chain', CHAIN), ('tree', TREE), ('value', VALUE)]
+
+
+
+# Runs in a worker process: returns (output bytes, peak RSS growth of the first render in
+# KB, best render time)
+def measure(task):
+    (module_path, text, depth, num_lines, repeat) = task
+    pyp = load_pyp(module_path)
+    template = pyp.Template(text=text, cache=pyp.CompileCache())
+
+    # (the output is thrown away, so the peak is what rendering itself needs)
+    (_, peak_kb) = measure_peak_kb(lambda: template.render_to(pyp.NullSink(), DEPTH=depth, LINES=num_lines))
+    output_bytes = len(template.render(DEPTH=depth, LINES=num_lines))
+
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        template.render_to(pyp.NullSink(), DEPTH=depth, LINES=num_lines)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (output_bytes, peak_kb, best)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--depth', dest='depth', type=int, default=500,
+                        help='Nesting depth of the chain and value shapes (default: 500)')
+    parser.add_argument('--lines', dest='lines', type=int, default=10,
+                        help='Lines of text per level of the chain and value shapes (default: 10)')
+    parser.add_argument('--fanout-depth', dest='fanout_depth', type=int, default=14,
+                        help='Depth of the binary tree shape (default: 14)')
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=5,
+                        help='Renders per measurement, the fastest one counts (default: 5)')
+    parser.add_argument('--module', dest='module', default=DEFAULT_PYP,
+                        help='pyp.py to measure (default: the one in this tree)')
+    options = parser.parse_args()
+
+    # (each level is a couple of Python frames deep)
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), options.depth * 4 + 100))
+
+    print "%s" % options.module
+    print "%-8s %8s %12s %12s %14s" % ("shape", "depth", "output(KB)", "time(ms)", "peak RSS(KB)")
+    tasks = [(os.path.abspath(options.module), text, options.fanout_depth if name == 'tree' else options.depth,
+              options.lines, options.repeat) for (name, text) in SHAPES]
+    for ((name, _), (_, _, depth, _, _), (output_bytes, peak_kb, elapsed)) in \
+            zip(SHAPES, tasks, run_isolated(measure, tasks)):
+        print "%-8s %8d %12d %12.2f %14d" % (name, depth, output_bytes / 1024, elapsed * 1000, peak_kb)
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
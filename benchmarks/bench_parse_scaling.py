@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Checks that parsing scales linearly with template size. Parses synthetic templates
+of doubling size and compares time per line of the largest against the smallest;
+exits non-zero if it grew by more than --max-ratio.
+
+    python benchmarks/bench_parse_scaling.py [--max-ratio 2.0]
+"""
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import pyp
+
+
+# A mix of text, expressions, nested control blocks and <% %> blocks, repeated
+CHUNK = """\
+config entry ${i}
+% for j in range(2):
+  % if j:
+    value = ${j * i}
+  % else:
+    value = none
+  % endif
+% endfor
+<%
+    i += 1
+%>
+"""
+
+def make_template(num_lines):
+    chunk_lines = CHUNK.count("\n")
+    return "% i = 0\n" + CHUNK * (num_lines // chunk_lines)
+
+
+def parse_time(text, repeat):
+    times = []
+    for _ in range(repeat):
+        pypparser = pyp.PYPParser(text)
+        start = time.time()
+        pypparser.parse()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=3, help='Runs per measurement')
+    parser.add_argument('--max-ratio', dest='max_ratio', type=float, default=2.0,
+                        help='Allowed growth of per-line parse time from smallest to largest input')
+    options = parser.parse_args()
+
+    sizes = [12500, 25000, 50000, 100000, 200000]
+    per_line = []
+    print "%-10s %12s %16s" % ("lines", "parse (ms)", "per line (us)")
+    for num_lines in sizes:
+        text = make_template(num_lines)
+        num_lines = text.count("\n")
+        elapsed = parse_time(text, options.repeat)
+        per_line.append(elapsed / num_lines)
+        print "%-10d %12.1f %16.2f" % (num_lines, elapsed*1000, per_line[-1]*1e6)
+
+    ratio = per_line[-1] / per_line[0]
+    print
+    print "per-line time ratio (largest/smallest): %.2f" % ratio
+    if ratio > options.max_ratio:
+        print "FAIL: parse time is growing faster than linear"
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Measures "pyp.py records": renders one small template for every record of a generated
+JSON lines file, at a few sizes, and prints the wall time, records per second and the
+peak RSS of the largest pyp.py process (the reader, or one of its workers). The peak
+should stay flat as the number of records grows, since records are streamed.
+
+    python benchmarks/bench_records.py [--records 1000,10000,100000] [-j 4] [--tree other/checkout]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+TEMPLATE = """\
+Record ${record_number}: ${name}
+% for (key, value) in sorted(record.items()):
+  ${key} = ${value}
+% endfor
+"""
+
+
+def write_records(filename, count):
+    with open(filename, 'w') as f:
+        for i in xrange(count):
+            f.write(json.dumps({'id': i, 'name': "name %d" % i, 'tags': ["tag%d" % (i % 7)] * 5}) + "\n")
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--records', dest='records', default='1000,10000,100000',
+                        help='Comma separated numbers of records (default: 1000,10000,100000)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=4, help='Worker processes (default: 4)')
+    parser.add_argument('--tree', dest='tree', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir),
+                        help='Directory with the pyp.py to measure (default: this tree)')
+    options = parser.parse_args()
+
+    pyp_path = os.path.join(os.path.abspath(options.tree), "pyp.py")
+    workdir = tempfile.mkdtemp(prefix="pyp_records")
+    try:
+        pypfile = os.path.join(workdir, "t.pyp")
+        with open(pypfile, 'w') as f:
+            f.write(TEMPLATE)
+
+        print "%s, %d jobs" % (pyp_path, options.jobs)
+        print "%10s %10s %12s %14s" % ("records", "time(s)", "records/s", "peak RSS(MB)")
+        for count in [int(n) for n in options.records.split(',')]:
+            records = os.path.join(workdir, "records.jsonl")
+            write_records(records, count)
+            outdir = os.path.join(workdir, "out")
+
+            # each size runs in a child of a fresh process, so RUSAGE_CHILDREN is its own
+            argv = [sys.executable, "-c",
+                    "import sys, subprocess, resource; "
+                    "status = subprocess.call(sys.argv[1:], stdout=open('/dev/null', 'w')); "
+                    "print resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss; sys.exit(status)",
+                    sys.executable, pyp_path, "records", "-j", str(options.jobs),
+                    "-o", os.path.join(outdir, "{id}.txt"), pypfile, records]
+            start = time.time()
+            process = subprocess.Popen(argv, stdout=subprocess.PIPE)
+            (out, _) = process.communicate()
+            elapsed = time.time() - start
+            if process.returncode != 0:
+                print "%10d %10s" % (count, "failed")
+                continue
+            print "%10d %10.2f %12.0f %14.1f" % (count, elapsed, count / elapsed, int(out) / 1024.0)
+            sys.stdout.flush()
+            shutil.rmtree(outdir)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Measures cold startup: the wall time of a fresh interpreter doing one small job (best of
+--repeat runs), and how many modules it imports. The jobs: importing pyp_runtime and
+pyp, rendering a template through pyp_runtime.render_code (code compiled beforehand),
+rendering a module made by "pyp.py compile", a pyp.py render with a warm compile cache,
+and a render through "pyp.py serve" with pyp_client.py.
+
+Python 2 has no -X importtime, so imports are counted from the output of python -v.
+--tree runs the same jobs against another checkout, for comparison (jobs it can't run
+show as n/a).
+
+    python benchmarks/bench_startup.py [--repeat 20] [--tree /path/to/other/checkout]
+"""
+import os
+import sys
+import time
+import shutil
+import marshal
+import tempfile
+import compileall
+import subprocess
+from argparse import ArgumentParser
+
+TEMPLATE = """\
+% rows = [(i, i * i) for i in range(20)]
+Squares:
+% for (i, square) in rows:
+  ${i} -> ${square}
+% endfor
+"""
+
+# Renders code compiled beforehand (see main), with nothing but pyp_runtime
+RUNTIME_RENDER = """\
+import sys, marshal, pyp_runtime
+with open(sys.argv[1], 'rb') as f:
+    (code, line_map, source_lines) = marshal.load(f)
+pyp_runtime.render_code(code, sys.stdout, line_map, source_lines, filename='t.pyp')
+"""
+
+
+def child_env():
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env.pop('PYTHONVERBOSE', None)
+    return env
+
+def run(argv, cwd):
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(argv, cwd=cwd, env=child_env(), stdout=devnull, stderr=devnull)
+
+def best_time(argv, cwd, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        if run(argv, cwd) != 0:
+            return None
+        times.append(time.time() - start)
+    return min(times)
+
+# Modules imported, counted from python -v ("import name # ..." lines)
+def count_imports(argv, cwd):
+    process = subprocess.Popen(argv[:1] + ['-v'] + argv[1:], cwd=cwd, env=child_env(),
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (_, err) = process.communicate()
+    return len([line for line in err.splitlines() if line.startswith("import ")])
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=20, help='Runs per job')
+    parser.add_argument('--tree', dest='tree', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir),
+                        help='Directory with the pyp.py to measure (default: this tree)')
+    options = parser.parse_args()
+
+    tree = os.path.abspath(options.tree)
+    python = sys.executable
+    workdir = tempfile.mkdtemp(prefix="pyp_startup")
+    server = None
+    try:
+        pypfile = os.path.join(workdir, "t.pyp")
+        with open(pypfile, 'w') as f:
+            f.write(TEMPLATE)
+        with open(os.path.join(workdir, "runtime_render.py"), 'w') as f:
+            f.write(RUNTIME_RENDER)
+        cache_dir = os.path.join(workdir, "cache")
+        socket_path = os.path.join(workdir, "pyp.sock")
+
+        # Everything is byte-compiled first, as it would be when installed
+        for name in ("pyp.py", "pyp_runtime.py", "pyp_client.py"):
+            if os.path.exists(os.path.join(tree, name)):
+                compileall.compile_file(os.path.join(tree, name), quiet=True)
+
+        sys.path.insert(0, tree)
+        import pyp
+        pypparser = pyp.PYPParser(TEMPLATE, input_filename="t.pyp")
+        code = pypparser.compile_python(pypparser.parse())
+        with open(os.path.join(workdir, "t.pypcode"), 'wb') as f:
+            marshal.dump((code, pypparser.python_line_map, pypparser.get_source_lines()), f)
+
+        run([python, os.path.join(tree, "pyp.py"), "compile", pypfile], workdir)
+        compileall.compile_dir(workdir, quiet=True)
+        run([python, os.path.join(tree, "pyp.py"), "--cache-dir", cache_dir, pypfile], workdir)   # warms the cache
+
+        if os.path.exists(os.path.join(tree, "pyp_client.py")):
+            server = subprocess.Popen([python, os.path.join(tree, "pyp.py"), "serve", "--socket", socket_path],
+                                      cwd=workdir, env=child_env())
+            for _ in range(100):
+                if os.path.exists(socket_path):
+                    break
+                time.sleep(0.05)
+
+        path_setup = "import sys; sys.path.insert(0, %r); " % tree
+        jobs = [
+            ("python (nothing)", [python, "-c", "pass"]),
+            ("import pyp_runtime", [python, "-c", path_setup + "import pyp_runtime"]),
+            ("import pyp", [python, "-c", path_setup + "import pyp"]),
+            ("pyp_runtime.render_code", [python, "-c", path_setup + "sys.argv[1:] = ['t.pypcode']; " +
+                                         "exec open('runtime_render.py').read()"]),
+            ("precompiled module render", [python, "-c", "import sys, t; t.render(sys.stdout)"]),
+            ("pyp.py, warm compile cache", [python, os.path.join(tree, "pyp.py"), "--cache-dir", cache_dir, pypfile]),
+            ("pyp_client.py + server", [python, os.path.join(tree, "pyp_client.py"), "--socket", socket_path, pypfile]),
+        ]
+
+        print "%s (%s)" % (tree, python)
+        print "%-30s %10s %10s" % ("job", "best (ms)", "imports")
+        for (name, argv) in jobs:
+            elapsed = best_time(argv, workdir, options.repeat)
+            if elapsed is None:
+                print "%-30s %10s %10s" % (name, "n/a", "")
+            else:
+                print "%-30s %10.1f %10d" % (name, elapsed * 1000, count_imports(argv, workdir))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    main()
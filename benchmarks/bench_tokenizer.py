@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Compares pyp.tokenize (one master regex per line, multi-line ${} handled in the same
+pass) against the way lines used to be classified: the whole text rewritten by
+preprocess_text to put multi-line ${} expressions on one line (padding with DUMMYTEXT
+lines), then each line tried against up to seven regexes in turn.
+
+    python benchmarks/bench_tokenizer.py [-n REPEAT] [--lines 200000]
+"""
+import os
+import re
+import sys
+import time
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import pyp
+
+
+# A mix of text, expressions (one of them over several lines), control blocks, comments
+# and <% %> blocks, repeated
+CHUNK = """\
+## a comment
+config entry ${i} with ${name.upper()}
+% for j in range(2):
+  % if j:
+    value = ${j * i}
+  % elif i:
+    value = ${i +
+              1}
+  % else:
+    value = none
+  % endif
+% endfor
+% x = i * 2
+<%
+    i += 1
+    doc = \"\"\"
+text in a string
+\"\"\"
+%>
+plain text line without anything in it
+"""
+
+def make_template(num_lines):
+    return CHUNK * (num_lines // CHUNK.count("\n"))
+
+
+# The classification pyp.py did before tokenize, kept here for comparison
+class OldLexer:
+    EXPR_REGEX = pyp.PythonSequence.EXPR_REGEX
+    keywords = pyp.PythonSequence.keywords_regex_chunk
+    middle_keywords = "|".join(pyp.PythonSequence.middle_keywords)
+
+    DUMMYTEXT = "DUMMYTEXT"
+    DUMMYTEXT_REGEX = re.compile("%s\s*$" % DUMMYTEXT)
+    PYP_COMMENT_REGEX = re.compile('\s*##')
+    PYTHON_BLOCK_START_REGEX = re.compile("\s*<%")
+    PYTHON_BLOCK_END_REGEX = re.compile("\s*%>")
+    CONTROL_START_REGEX = re.compile("\s*%\s*(({key}).*:)".format(key=keywords))
+    CONTROL_MIDDLE_REGEX = re.compile("\s*%\s*(({key}).*:)".format(key=middle_keywords))
+    CONTROL_END_REGEX = re.compile("\s*%\s*end({key})".format(key=keywords))
+    NORMAL_PYTHON_LINE_REGEX = re.compile("\s*%\s*(.*)")
+
+    def preprocess_text(self, text):
+        dummyline = "\n%s" % self.DUMMYTEXT
+
+        def replace_func(match):
+            innertext = match.group('inner')
+            return "${%s}" % innertext.replace("\n", " ") + dummyline * innertext.count("\n")
+
+        return self.EXPR_REGEX.sub(replace_func, text)
+
+    # Returns [(kind, line, linenum)], like parse_lines used to see them
+    def tokenize(self, text):
+        text = self.preprocess_text(text)
+        textlines = text.split("\n")
+        lines = iter(zip(textlines, [1+x for x in range(len(textlines))]))
+
+        tokens = []
+        for (line, linenum) in lines:
+            if self.PYP_COMMENT_REGEX.match(line) or self.DUMMYTEXT_REGEX.match(line):
+                continue
+            line = line.replace(self.DUMMYTEXT, "")
+
+            if self.PYTHON_BLOCK_START_REGEX.match(line):
+                block_lines = []
+                for (block_line, block_linenum) in lines:
+                    if self.PYTHON_BLOCK_END_REGEX.match(block_line):
+                        break
+                    block_lines.append(block_line)
+                tokens.append(("block_start", line, linenum))
+                continue
+
+            for (kind, regex) in (("control_start", self.CONTROL_START_REGEX),
+                                  ("control_middle", self.CONTROL_MIDDLE_REGEX),
+                                  ("control_end", self.CONTROL_END_REGEX),
+                                  ("python", self.NORMAL_PYTHON_LINE_REGEX)):
+                if regex.match(line):
+                    tokens.append((kind, line, linenum))
+                    break
+            else:
+                tokens.append(("text", line, linenum))
+        return tokens
+
+
+def best_time(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=3, help='Runs per measurement')
+    parser.add_argument('--lines', dest='lines', type=int, default=200000, help='Size of the largest template')
+    options = parser.parse_args()
+
+    old_lexer = OldLexer()
+    sizes = [options.lines // 16, options.lines // 4, options.lines]
+
+    print "%-10s %14s %14s %10s" % ("lines", "old (ms)", "tokenize (ms)", "speedup")
+    for num_lines in sizes:
+        text = make_template(num_lines)
+        old_time = best_time(lambda: old_lexer.tokenize(text), options.repeat)
+        new_time = best_time(lambda: list(pyp.tokenize(text)), options.repeat)
+        print "%-10d %14.1f %14.1f %9.2fx" % (text.count("\n"), old_time*1000, new_time*1000, old_time / new_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Checks for bugs that were fixed once, each in a scratch directory of its own. Prints
+every check's result and exits non-zero if any failed.
+
+    python benchmarks/check_regressions.py [--module old/pyp.py]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import StringIO
+import tempfile
+import traceback
+from argparse import ArgumentParser
+
+from _common import DEFAULT_PYP, load_pyp
+
+
+def write_files(files):
+    for (name, text) in files.items():
+        with open(name, 'w') as f:
+            f.write(text)
+
+def read_file(name):
+    with open(name) as f:
+        return f.read()
+
+
+# Two watched templates including the same file both get re-rendered when it changes
+def check_watch_shared_include():
+    write_files({'lib.pyp': "shared v1\n",
+                 'a.pyp': "a\n% include \"lib.pyp\"\n",
+                 'b.pyp': "b\n% include \"lib.pyp\"\n"})
+    watcher = pyp.TemplateWatcher([('a.pyp', 'a.txt'), ('b.pyp', 'b.txt')])
+    watcher.check()
+    time.sleep(1.1)   # (a new mtime, for filesystems with 1s resolution)
+    write_files({'lib.pyp': "shared v2\n"})
+    assert watcher.check() == 2
+    for name in ['a.txt', 'b.txt']:
+        assert "shared v2" in read_file(name), (name, read_file(name))
+
+
+# The render server reports a template mixing non-ASCII str text and unicode prints as a
+# runtime error, like the command line does, instead of failing in the serve loop
+def check_serve_unicode_print():
+    write_files({'u.pyp': "caf\xc3\xa9 text\n% print u\"\\xe9\"\n"})
+    server = pyp.RenderServer(nocache=True)
+    response = json.loads(server.handle_line(json.dumps({'pypfile': 'u.pyp', 'cwd': os.getcwd()})))
+    assert response['stdout'].startswith(u"caf\xc3\xa9 text\n"), response
+    assert "UnicodeEncodeError" in response['stdout'], response
+
+
+# Python lines whose first name only starts with a control keyword aren't control statements
+def check_keyword_prefixed_names():
+    text = ('% cache_key = "a:b"\n% format = "c:d"\n% elsewhere = "e:f"\n% endfor_x = 1\n'
+            '${cache_key} ${format} ${elsewhere} ${endfor_x}\n')
+    output = pyp.Template(text).render()
+    assert output.splitlines()[0] == "a:b c:d e:f 1", output
+
+
+# Render stats count output lines, not sink appends (a merged text run is one append),
+# whichever way the template is rendered
+def check_stats_output_lines():
+    text = "header ${title}\nsecond\nthird\n% for i in range(3):\nrow ${i}\n  detail ${i * 2}\n% endfor\nfooter\n"
+    with open('t.pyp', 'w') as f:
+        f.write(text)
+
+    def render_with(render, template_class=pyp.Template):
+        collector = pyp.StatsCollector()
+        output = render(template_class(text, observer=collector))
+        totals = collector.get_results()['totals']
+        assert (totals['output_lines'], totals['output_bytes']) == (output.count("\n"), len(output)), \
+            (render, totals['output_lines'], output.count("\n"))
+
+    class Writer:
+        def __init__(self):
+            self.chunks = []
+        def write(self, chunk):
+            self.chunks.append(chunk)
+
+    def render_async(template):
+        writer = Writer()
+        for _ in template.render_async(writer, title="T"):
+            pass
+        return "".join(writer.chunks)
+
+    def render_to_file(template):
+        template.render_to(pyp.FileSink('t.txt'), title="T")
+        return read_file('t.txt')
+
+    def render_to_stream(template):
+        out = StringIO.StringIO()
+        template.render_to(out, title="T")
+        return out.getvalue()
+
+    render_with(lambda template: template.render(title="T"))
+    render_with(lambda template: "".join(template.render_iter(title="T")))
+    render_with(render_to_stream)
+    render_with(render_to_file)
+    render_with(render_async, pyp.AsyncTemplate)
+
+    collector = pyp.StatsCollector()
+    records = [{'title': str(i)} for i in range(10)]
+    output_lines = 0
+    for (_, filename, success, error_text, _) in pyp.render_records('t.pyp', records, '{title}.txt', jobs=2,
+                                                                    observer=collector):
+        assert success, error_text
+        output_lines += read_file(filename).count("\n")
+    assert collector.get_results()['totals']['output_lines'] == output_lines
+
+
+# The render server applies the command line's --stats and --manifest options it's sent
+def check_serve_options():
+    write_files({'t.pyp': "line ${1 + 1}\n"})
+    server = pyp.RenderServer(nocache=True)
+    request = {'pypfile': 't.pyp', 'cwd': os.getcwd(), 'output': 't.txt', 'stats': True, 'manifest': 'm.json'}
+    response = json.loads(server.handle_line(json.dumps(request)))
+    assert response['status'] == 0, response
+    assert "STATS" in response['stderr'], response
+    assert 't.txt' in json.loads(read_file('m.json')), read_file('m.json')
+
+
+CHECKS = [check_watch_shared_include, check_serve_unicode_print, check_keyword_prefixed_names,
+          check_stats_output_lines, check_serve_options]
+
+
+def main():
+    global pyp
+
+    parser = ArgumentParser()
+    parser.add_argument('--module', dest='module', default=DEFAULT_PYP,
+                        help='pyp.py to check (default: the one in this tree)')
+    options = parser.parse_args()
+
+    pyp = load_pyp(os.path.abspath(options.module))
+
+    failures = 0
+    start_dir = os.getcwd()
+    for check in CHECKS:
+        workdir = tempfile.mkdtemp(prefix="pyp_check")
+        os.chdir(workdir)
+        try:
+            check()
+            print "ok      %s" % check.__name__
+        except Exception:
+            failures += 1
+            print "FAILED  %s" % check.__name__
+            print "".join("    " + line for line in traceback.format_exc().splitlines(True))
+        finally:
+            os.chdir(start_dir)
+            shutil.rmtree(workdir)
+
+    print "%d checks, %d failed" % (len(CHECKS), failures)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
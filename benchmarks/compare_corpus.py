@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Renders every template in benchmarks/corpus with this tree's pyp.py and with another
+checkout's, and lists the ones whose output (error reports and exit status included)
+differs. For checking that a codegen or runtime change leaves rendered output
+byte-identical: run it against a checkout of the commit before the change.
+
+    python benchmarks/compare_corpus.py --tree other/checkout [-v]
+"""
+import os
+import re
+import sys
+import difflib
+import subprocess
+from argparse import ArgumentParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(BENCH_DIR, "corpus")
+
+# Parts of error reports that change from run to run: the temp files older versions ran
+# the generated code from, and object addresses
+VOLATILE_REGEX = re.compile(r"\S*/tmp\w*\.py|0x[0-9a-f]+")
+
+
+def get_templates():
+    templates = []
+    for (dirpath, dirnames, filenames) in os.walk(CORPUS_DIR):
+        for filename in filenames:
+            if filename.endswith(".pyp"):
+                templates.append(os.path.relpath(os.path.join(dirpath, filename), CORPUS_DIR))
+    return sorted(templates)
+
+
+# Output and exit status of "pyp.py template arg1", run from the template's directory
+def render(pyp_path, template):
+    path = os.path.join(CORPUS_DIR, template)
+    process = subprocess.Popen([sys.executable, pyp_path, os.path.basename(path), "arg1"],
+                               cwd=os.path.dirname(path), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    (out, _) = process.communicate()
+    return VOLATILE_REGEX.sub("X", out) + "[exit status %d]\n" % process.returncode
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--tree', dest='tree', required=True, help='Directory with the pyp.py to compare against')
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true', default=False,
+                        help='Show a diff for each template that differs')
+    options = parser.parse_args()
+
+    this_pyp = os.path.join(BENCH_DIR, os.pardir, "pyp.py")
+    other_pyp = os.path.join(os.path.abspath(options.tree), "pyp.py")
+
+    templates = get_templates()
+    differ = 0
+    for template in templates:
+        (other, this) = (render(other_pyp, template), render(this_pyp, template))
+        if other == this:
+            continue
+        differ += 1
+        print "DIFF", template
+        if options.verbose:
+            for line in difflib.unified_diff(other.splitlines(), this.splitlines(), options.tree, "this tree",
+                                             lineterm=""):
+                print "   ", line
+    print "%d templates, %d differ" % (len(templates), differ)
+    sys.exit(1 if differ else 0)
+
+
+if __name__ == "__main__":
+    main()
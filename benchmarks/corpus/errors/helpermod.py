@@ -0,0 +1,2 @@
+def boom(x):
+    return 1 / x
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+Renders a set of templates (with includes, imports, cached pypdefs, cache regions and
+runtime errors) from many threads at once, sharing the Template objects and caches, and
+checks every output byte for byte (and every error's file/line) against a render of the
+same template and context done alone beforehand. Exits non-zero on any difference.
+
+    python benchmarks/stress_threads.py [--threads 16] [--renders 2000] [--module old/pyp.py]
+"""
+import os
+import sys
+import random
+import shutil
+import tempfile
+import StringIO
+import traceback
+from multiprocessing.pool import ThreadPool
+from argparse import ArgumentParser
+
+from _common import DEFAULT_PYP, load_pyp
+
+
+FILES = {
+    'lib.pyp': """\
+% pypdef row(label, values):
+${label}: ${', '.join(str(v) for v in values)}
+% endpypdef
+% pypdef cached square(n):
+${n * n}
+% endpypdef
+""",
+    'header.pyp': """\
+== ${title} (${len(items)} items) ==
+""",
+    'report.pyp': """\
+% import "lib.pyp" as lib
+% include "header.pyp"
+% for (i, item) in enumerate(items):
+${lib.row("item %d" % i, [item, lib.square(item)])}
+% endfor
+% cache key=len(items):
+${len(items)} items
+% endcache
+% include "footer.pyp"
+""",
+    'footer.pyp': """\
+% if items:
+  last: ${items[-1]}
+% else:
+  no items
+% endif
+-- ${title} --
+""",
+    'recurse.pyp': """\
+% pypdef tree(depth, label):
+  % if depth:
+${tree(depth - 1, label + 'l')}
+${tree(depth - 1, label + 'r')}
+  % else:
+leaf ${label}
+  % endif
+% endpypdef
+${tree(len(items) % 5 + 1, title)}
+% include "header.pyp"
+""",
+    'fails.pyp': """\
+% include "header.pyp"
+% for item in items:
+${100 / (item - 3)}
+% endfor
+""",
+}
+
+TEMPLATES = ['report.pyp', 'recurse.pyp', 'fails.pyp']
+
+
+def make_context(seed):
+    rand = random.Random(seed)
+    return {'title': "run%d" % seed, 'items': [rand.randint(0, 9) for _ in range(rand.randint(0, 12))]}
+
+# Returns ("ok", output) or ("error", (filename, linenum, text)) for one render
+def render(template, context, how):
+    try:
+        if how == "render":
+            return ("ok", template.render(**context))
+        elif how == "render_to":
+            out = StringIO.StringIO()
+            template.render_to(out, **context)
+            return ("ok", out.getvalue())
+        else:
+            return ("ok", "".join(template.render_iter(**context)))
+    except pyp.TemplateError as inst:
+        return ("error", (os.path.basename(inst.filename or ""), inst.linenum, inst.text))
+
+
+def main():
+    global pyp
+
+    parser = ArgumentParser()
+    parser.add_argument('--threads', dest='threads', type=int, default=16, help='Rendering threads')
+    parser.add_argument('--renders', dest='renders', type=int, default=2000, help='Total number of renders')
+    parser.add_argument('--contexts', dest='contexts', type=int, default=50, help='Different contexts to render with')
+    parser.add_argument('--module', dest='module', default=DEFAULT_PYP,
+                        help='pyp.py to test (default: the one in this tree)')
+    options = parser.parse_args()
+
+    pyp = load_pyp(options.module)
+
+    # switch threads as often as possible, to shake out races
+    sys.setcheckinterval(1)
+
+    tempdir = tempfile.mkdtemp(prefix="pyp_stress")
+    try:
+        for (name, text) in FILES.items():
+            with open(os.path.join(tempdir, name), 'w') as f:
+                f.write(text)
+        paths = [os.path.join(tempdir, name) for name in TEMPLATES]
+
+        # Expected results, each rendered alone with templates and caches of its own
+        expected = {}
+        for path in paths:
+            for seed in range(options.contexts):
+                template = pyp.Template(filename=path, cache=pyp.CompileCache(),
+                                        region_cache=pyp.MemoryRegionCache())
+                expected[(path, seed)] = render(template, make_context(seed), "render")
+
+        # The same renders from many threads, all sharing one Template per file and the
+        # default caches
+        templates = dict((path, pyp.Template(filename=path)) for path in paths)
+        rand = random.Random(0)
+        tasks = [(rand.choice(paths), rand.randrange(options.contexts),
+                  rand.choice(["render", "render_to", "render_iter"])) for _ in range(options.renders)]
+
+        def run(task):
+            (path, seed, how) = task
+            try:
+                return (task, render(templates[path], make_context(seed), how))
+            except Exception:
+                return (task, ("exception", traceback.format_exc()))
+
+        pool = ThreadPool(options.threads)
+        try:
+            results = pool.map(run, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        failures = 0
+        for ((path, seed, how), result) in results:
+            if result != expected[(path, seed)]:
+                failures += 1
+                if failures <= 5:
+                    print "MISMATCH: %s context %d (%s)" % (os.path.basename(path), seed, how)
+                    print "  expected: %r" % (expected[(path, seed)],)
+                    print "  got:      %r" % (result,)
+    finally:
+        shutil.rmtree(tempdir)
+
+    print "%d renders in %d threads: %d mismatches" % (len(tasks), options.threads, failures)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for the separate phases of rendering a template: tokenizing (tokenize),
+parsing (parse_lines, including _process_python_block), code generation
+(get_python_text), compiling and executing.
+Runs synthetic templates of several shapes across input sizes, and reports the best
+time per phase and the peak memory of each run.
+
+Results can be saved as a baseline, and later runs compared against it: any phase
+slower than the baseline by more than --threshold (or peak memory above it by more
+than --mem-threshold) is reported, and the exit status is non-zero.
+
+    python benchmarks/suite.py [--sizes 1000,4000,16000] [--workloads static,exprs]
+    python benchmarks/suite.py --save baseline.json
+    python benchmarks/suite.py --compare baseline.json [--threshold 1.25]
+"""
+import os
+import sys
+import json
+import time
+from argparse import ArgumentParser
+
+from _common import measure_peak_kb, run_isolated
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import pyp
+
+
+PHASES = ['tokenize', 'parse', 'codegen', 'compile', 'execute']
+
+
+# Template generators, each returns a template of (about) num_lines lines. They repeat a
+# chunk, with the chunk's lines counted by its number of newlines.
+def _repeat(header, chunk, num_lines):
+    return header + chunk * max(1, num_lines // chunk.count("\n"))
+
+# Long runs of plain text
+def make_static(num_lines):
+    chunk = "".join("This is a plain line of static text, number %d in its paragraph.\n" % i
+                    for i in range(20))
+    return _repeat("", chunk, num_lines)
+
+# Every line full of ${} expressions
+def make_exprs(num_lines):
+    chunk = ("${a} + ${b} = ${a + b}, ${name.upper()} ${items[0]} ${len(items)}\n"
+             "row ${'%05d' % a} | ${b * 2.5} | ${', '.join(items)} | ${d['key']}\n")
+    header = "% a = 1\n% b = 2\n% name = 'pyp'\n% items = ['x', 'y', 'z']\n% d = {'key': 'value'}\n"
+    return _repeat(header, chunk, num_lines)
+
+# Deeply nested % if/% for blocks
+def make_nested(num_lines):
+    depth = 6
+    lines = []
+    for level in range(depth):
+        indent = "  " * level
+        lines.append("%s%% for i%d in range(2):" % (indent, level))
+        lines.append("%s  %% if i%d or %d %% 2:" % (indent, level, level))
+    lines.append("%s  level %d: ${i0} ${i%d}" % ("  " * depth, depth, depth - 1))
+    for level in reversed(range(depth)):
+        indent = "  " * level
+        lines.append("%s  %% else:" % indent)
+        lines.append("%s    skipped ${i%d}" % (indent, level))
+        lines.append("%s  %% endif" % indent)
+        lines.append("%s%% endfor" % indent)
+    return _repeat("", "\n".join(lines) + "\n", num_lines)
+
+# Large <% %> blocks with triple-quoted strings
+def make_pyblock(num_lines):
+    chunk = ('<%\n'
+             'doc = """\n'
+             'A triple-quoted string inside a python block,\n'
+             '    with indented lines\n'
+             'and a few more lines of text.\n'
+             '"""\n'
+             'total = 0\n'
+             'for word in doc.split():\n'
+             '    if len(word) > 3:\n'
+             '        total += len(word)\n'
+             'def helper(x):\n'
+             '    return """result: %d""" % (x * 2)\n'
+             'summary = helper(total)\n'
+             '%>\n'
+             '${summary}\n')
+    return _repeat("", chunk, num_lines)
+
+# Heavy pypdef recursion: every chunk (re)defines a recursive pypdef and calls it
+def make_recursion(num_lines):
+    chunk = ("% pypdef tree(depth, label):\n"
+             "  % if depth:\n"
+             "${tree(depth - 1, label + 'l')}\n"
+             "${tree(depth - 1, label + 'r')}\n"
+             "  % else:\n"
+             "leaf ${label}\n"
+             "  % endif\n"
+             "% endpypdef\n"
+             "${tree(6, 'n')}\n")
+    return _repeat("", chunk, num_lines)
+
+WORKLOADS = [
+    ('static', make_static),
+    ('exprs', make_exprs),
+    ('nested', make_nested),
+    ('pyblock', make_pyblock),
+    ('recursion', make_recursion),
+]
+
+
+def _time_phases(text):
+    times = {}
+
+    pypparser = pyp.PYPParser(text, input_filename="bench.pyp")
+    start = time.time()
+    tokens = list(pyp.tokenize(text))
+    times['tokenize'] = time.time() - start
+
+    sequence = pyp.PythonSequence()
+    start = time.time()
+    sequence.parse_lines(tokens)
+    times['parse'] = time.time() - start
+
+    start = time.time()
+    python_text = sequence.get_python_text()
+    times['codegen'] = time.time() - start
+    pypparser.python_line_map = sequence.python_line_map
+
+    start = time.time()
+    code = pypparser.compile_python(python_text)
+    times['compile'] = time.time() - start
+
+    start = time.time()
+    pypparser.run_code(code, pyp.NullSink())
+    times['execute'] = time.time() - start
+
+    return times
+
+
+# Runs one workload/size in a fresh worker process (see main), so that the peak RSS it
+# reports belongs to this run only. Returns (name, num_lines, best times, peak memory in KB).
+def run_case(task):
+    (name, num_lines, repeat) = task
+    text = dict(WORKLOADS)[name](num_lines)
+
+    def run():
+        best = {}
+        for _ in range(repeat):
+            times = _time_phases(text)
+            for phase in PHASES:
+                best[phase] = min(best.get(phase, times[phase]), times[phase])
+        return best
+    (best, peak_rss) = measure_peak_kb(run)
+    return (name, text.count("\n"), best, peak_rss)
+
+
+def _case_key(name, num_lines):
+    return "%s/%d" % (name, num_lines)
+
+# Returns a list of regression messages for results compared to a baseline
+def compare(results, baseline, threshold, mem_threshold, min_time):
+    regressions = []
+    for (key, result) in sorted(results.items()):
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        for phase in PHASES:
+            (now, before) = (result['times'][phase], base['times'].get(phase))
+            # (very short phases are too noisy to compare)
+            if before is None or max(now, before) < min_time:
+                continue
+            if now > before * threshold:
+                regressions.append("%s %s: %.2fms -> %.2fms (x%.2f)" % (key, phase, before*1000, now*1000,
+                                                                        now / before))
+        (now, before) = (result['peak_kb'], base.get('peak_kb'))
+        if before and now > before * mem_threshold and now - before > 1024:
+            regressions.append("%s peak memory: %dKB -> %dKB (x%.2f)" % (key, before, now, float(now) / before))
+    return regressions
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--repeat', dest='repeat', type=int, default=5,
+                        help='Runs per measurement, the fastest one counts (default: 5)')
+    parser.add_argument('--sizes', dest='sizes', default='1000,4000,16000',
+                        help='Comma separated template sizes, in lines (default: 1000,4000,16000)')
+    parser.add_argument('--workloads', dest='workloads', default=','.join(name for (name, _) in WORKLOADS),
+                        help='Comma separated workloads to run (default: all of them)')
+    parser.add_argument('--save', dest='save', metavar='FILE', help='Save the results as a JSON baseline')
+    parser.add_argument('--compare', dest='compare', metavar='FILE', help='Compare the results against a baseline')
+    parser.add_argument('--threshold', dest='threshold', type=float, default=1.25,
+                        help='Allowed slowdown of a phase against the baseline (default: 1.25)')
+    parser.add_argument('--mem-threshold', dest='mem_threshold', type=float, default=1.25,
+                        help='Allowed growth of peak memory against the baseline (default: 1.25)')
+    parser.add_argument('--min-time', dest='min_time', type=float, default=0.002,
+                        help='Phases shorter than this (in seconds) are not compared (default: 0.002)')
+    options = parser.parse_args()
+
+    sizes = [int(x) for x in options.sizes.split(',')]
+    names = options.workloads.split(',')
+    for name in names:
+        if name not in dict(WORKLOADS):
+            parser.error("unknown workload '%s'" % name)
+
+    tasks = [(name, num_lines, options.repeat) for name in names for num_lines in sizes]
+
+    print "%-18s %8s" % ("workload", "lines") + "".join("%15s" % (phase + "(ms)") for phase in PHASES) + "%12s" % "peak(KB)"
+    results = {}
+    for (name, num_lines, times, peak_kb) in run_isolated(run_case, tasks):
+        results[_case_key(name, num_lines)] = {'times': times, 'peak_kb': peak_kb}
+        print "%-18s %8d" % (name, num_lines) + "".join("%15.2f" % (times[phase]*1000) for phase in PHASES) + "%12d" % peak_kb
+        sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'version': pyp.__version__, 'results': results}, f, indent=2, sort_keys=True)
+        print
+        print "Saved baseline to %s" % options.save
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, options.threshold, options.mem_threshold, options.min_time)
+        print
+        if regressions:
+            print "REGRESSIONS against %s:" % options.compare
+            for regression in regressions:
+                print "  " + regression
+            sys.exit(1)
+        print "No regressions against %s" % options.compare
+
+
+if __name__ == "__main__":
+    main()
@@ -4,20 +4,37 @@ import traceback
 import os
 import re
 
-import argparse
-from argparse import ArgumentParser
-
-import tempfile
-import copy
-from pprint import PrettyPrinter
-pp = PrettyPrinter()
-import runpy
-import random
+# (modules only some modes need, like argparse, tempfile, multiprocessing or socket, are
+# imported where they're used, to keep startup fast)
+import linecache
+import threading
+import itertools
+import functools
+import StringIO
+import time
+import types
+import select
+import signal
 import exceptions
+import hashlib
+import marshal
+import imp
+from array import array
+from collections import OrderedDict
+
+from pyp_runtime import (get_source_linenum, TemplateError, ParseError, TemplateSyntaxError,
+                         TemplateRuntimeError, OutputSink, ListSink, NullSink, StreamSink, FileSink,
+                         get_file_signature, SpoolSink, _ChunkQueueSink, CachedPypdef, cached_pypdef, pypdef, value_writer,
+                         print_call, print_run, ASYNC_CHECKPOINT, ASYNC_END, Ready, AsyncIterator, async_iter,
+                         RenderAborted, make_namespace, get_error_location, render_code, join_lines,
+                         close_failed_sink)
 
 __version__ = "0.12"
 
-from string import Template
+# Format of the generated Python, part of the compile cache key. Bump it with any change to
+# the code PythonSequence generates (or to the runtime helpers it calls), so that templates
+# compiled by an older pyp.py are never loaded from a cache dir.
+CODEGEN_VERSION = 6
 
 # Turns " to \", and ' to \'
 def escape_quotes(string):
@@ -26,13 +43,20 @@ def escape_quotes(string):
 def escape_percent(string):
     return string.replace("%","%%")
 
-class PythonLine:
+# The parse tree nodes use __slots__: a big template makes hundreds of thousands of them,
+# and a per-instance __dict__ would be most of their size
+
+class PythonLine(object):
+    __slots__ = ('string', 'noindent', 'indent_levels', 'linenum')
+
     INDENT = "    "
 
-    def __init__(self, string, noindent=False):
+    # linenum: the pyp source line this line came from (None for generated boilerplate)
+    def __init__(self, string, noindent=False, linenum=None):
         self.string = string
         self.noindent = noindent
         self.indent_levels = 0
+        self.linenum = linenum
 
     def __str__(self):
         return self.string
@@ -46,7 +70,22 @@ class PythonLine:
     def get_indented(self):
         return self.indent_levels*self.INDENT + self.string
 
-class PythonControlBlock:
+# A line of template text, possibly with ${} expressions. PythonSequence turns runs of
+# these into output statements when generating the Python code.
+class TextLine(object):
+    __slots__ = ('text', 'exprs', 'linenum')
+
+    def __init__(self, text, exprs, linenum):
+        self.text = text
+        self.exprs = exprs
+        self.linenum = linenum
+
+    def __str__(self):
+        return self.text
+
+class PythonControlBlock(object):
+    __slots__ = ('nodes', 'control_statement', 'control_word')
+
     def __init__(self, control_statement, control_word):
         self.nodes = []
         self.control_statement = control_statement
@@ -55,23 +94,312 @@ class PythonControlBlock:
     def __str__(self):
        return "PythonControlBlock (%s):\n" % (self.control_statement) + "\n".join(str(x) for x in self.nodes)
 
-class ParseError(Exception):
-    def __init__(self, text, line, linenum):
-        (self.text, self.line, self.linenum) = (text, line, linenum)
+# Marshals obj into path (creating its directory if needed), through a temp file that's
+# renamed into place, so a concurrent reader never sees half a file. Returns the number
+# of bytes written. Raises IOError/OSError.
+def _atomic_write_marshal(path, obj):
+    import tempfile
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    (fd, temp_path) = tempfile.mkstemp(suffix=".tmp", dir=dirname)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(obj, f)
+            written = f.tell()
+        os.rename(temp_path, path)
+    except:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return written
 
-    def __str__(self):
-        msgs = [
-            "Line %d" % (self.linenum),
-            "Line: %s" % (self.line),
-            self.text
-            ]
-        return "\n".join(msgs)
+class CompileCache:
+    """
+    Cache of compiled templates: the code object plus the python_line_map needed for
+    error reporting. Entries are keyed by a hash of the pyp source (and the pyp version),
+    kept in an in-process LRU, and optionally marshal'd into cache_dir so that other
+    processes can skip parsing and compiling too. Safe to share between threads.
+    """
+    FILE_SUFFIX = ".pypc"
+
+    def __init__(self, maxsize=256, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()   # guards entries and the counts
+
+    # Code objects are only valid for the interpreter that made them, so the bytecode
+    # magic goes into the key along with the pyp and codegen versions
+    def make_key(self, text, filename=None, variant=""):
+        sha = hashlib.sha1()
+        for part in (__version__, str(CODEGEN_VERSION), imp.get_magic(), filename or "", variant, text):
+            sha.update(part)
+            sha.update("\0")
+        return sha.hexdigest()
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + self.FILE_SUFFIX)
+
+    def _remember(self, key, entry):
+        self.entries[key] = entry
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    # Returns (code, python_line_map), or None on a miss
+    def get(self, key):
+        # (moved to the end in one go, so other threads never find it missing)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.entries[key] = entry
+                self.hits += 1
+                return entry
+
+        # the disk is read without holding the lock
+        if self.cache_dir:
+            entry = self._load(key)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, entry)
+        return entry
+
+    def set(self, key, code, python_line_map):
+        entry = (code, python_line_map)
+        with self.lock:
+            self._remember(key, entry)
+        if self.cache_dir:
+            self._store(key, entry)
+
+    def _load(self, key):
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                (code, line_map_bytes) = marshal.load(f)
+            python_line_map = array('i')
+            python_line_map.fromstring(line_map_bytes)
+        except (IOError, EOFError, ValueError, TypeError):
+            # missing or unreadable cache file (or one from before line maps were arrays),
+            # just treat as a miss
+            return None
+        return (code, python_line_map)
+
+    def _store(self, key, entry):
+        (code, python_line_map) = entry
+        try:
+            _atomic_write_marshal(self._disk_path(key), (code, python_line_map.tostring()))
+        except (IOError, OSError):
+            # the cache is only an optimization, never fail a render because of it
+            pass
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
 
 
-class PythonSequence:
+class RegionCache:
+    """
+    Where the output of "% cache" regions is kept between renders. Entries are keyed by
+    the region's compiled code (so editing the region invalidates them) and the repr of
+    its key expression, and hold the region's output lines with an optional expiry time.
+    Subclasses implement get(key) (returns the lines, or None on a miss) and
+    set(key, lines, ttl), and evict entries once they take more than max_bytes. They
+    are safe to share between threads.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._code_ids = {}   # code object -> hash of it, computed once
+        self.lock = threading.Lock()   # guards the entries/size and the counts
+
+    def make_key(self, code, key=None):
+        code_id = self._code_ids.get(code)
+        if code_id is None:
+            code_id = self._code_ids[code] = hashlib.sha1(marshal.dumps(code)).hexdigest()
+        sha = hashlib.sha1()
+        for part in (__version__, imp.get_magic(), code_id, repr(key)):
+            sha.update(part)
+            sha.update("\0")
+        return sha.hexdigest()
+
+    def _entry_size(self, lines):
+        return sum(len(line) + 1 for line in lines)
+
+    def _get_expiry(self, ttl):
+        if ttl is None:
+            return None
+        return time.time() + ttl
+
+
+class MemoryRegionCache(RegionCache):
+    """
+    In-process region cache, evicts the least recently used entries.
+    """
+    DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        RegionCache.__init__(self, max_bytes)
+        self.entries = OrderedDict()   # key -> (expires, lines, size)
+        self.size = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] is not None and time.time() >= entry[0]:
+                self.size -= entry[2]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries[key] = entry   # most recently used goes last
+            return entry[1]
+
+    def set(self, key, lines, ttl=None):
+        size = self._entry_size(lines)
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= old_entry[2]
+
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (self._get_expiry(ttl), lines, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                (_, (_, _, old_size)) = self.entries.popitem(last=False)
+                self.size -= old_size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+class DiskRegionCache(RegionCache):
+    """
+    Region cache in a directory, one marshal'd file per entry, so regions stay cached
+    across runs (and are shared between processes). Reading an entry bumps its file's
+    mtime; when the directory goes over max_bytes the oldest files are removed.
+    """
+    FILE_SUFFIX = ".pypr"
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+        RegionCache.__init__(self, max_bytes)
+        self.cache_dir = cache_dir
+
+        # Size of the directory as far as we know, scanned when first needed
+        self.size = None
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key + self.FILE_SUFFIX)
+
+    def get(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                (expires, lines) = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            # missing or unreadable cache file, just treat as a miss
+            self._count(hit=False)
+            return None
+
+        if expires is not None and time.time() >= expires:
+            self._remove(path)
+            self._count(hit=False)
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self._count(hit=True)
+        return lines
+
+    def _count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def set(self, key, lines, ttl=None):
+        if self._entry_size(lines) > self.max_bytes:
+            return
+        try:
+            written = _atomic_write_marshal(self._disk_path(key), (self._get_expiry(ttl), list(lines)))
+        except (IOError, OSError):
+            # the cache is only an optimization, never fail a render because of it
+            return
+
+        with self.lock:
+            if self.size is None:
+                self._evict()
+            else:
+                self.size += written
+                if self.size > self.max_bytes:
+                    self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # Removes the least recently used files until the directory fits in max_bytes.
+    # Called with the lock held.
+    def _evict(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(self.FILE_SUFFIX):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+
+        self.size = sum(size for (_, size, _) in files)
+        for (_, size, path) in sorted(files):
+            if self.size <= self.max_bytes:
+                break
+            self._remove(path)
+            self.size -= size
+
+    def clear(self):
+        with self.lock:
+            if os.path.isdir(self.cache_dir):
+                for name in os.listdir(self.cache_dir):
+                    if name.endswith(self.FILE_SUFFIX):
+                        self._remove(os.path.join(self.cache_dir, name))
+            self.size = None
+
+# Region cache for the command line modes: on disk (in a "regions" directory in the
+# compile cache dir) if there is a cache dir, so regions stay cached across runs
+def get_region_cache(cache_dir, nocache):
+    if nocache:
+        return None
+    if cache_dir:
+        return DiskRegionCache(os.path.join(cache_dir, "regions"))
+    return MemoryRegionCache()
+
+
+class PythonSequence(object):
     """
     curr_node_list: keeps track of where new nodes (possibly blocks) go into
     """
+    __slots__ = ('control_statement', 'control_word', 'nodes', 'curr_node_list', 'python_line_map',
+                 'pypdef', 'async_mode', 'in_function', 'pypdef_funcs')
+
     EXPR_REGEX = re.compile(r"\${(?P<inner>.*?)}", re.DOTALL)
 
     CONTROL_TAGS = {
@@ -83,6 +411,7 @@ class PythonSequence:
         'pypdef': None,
         'class': None,
         'with': None,
+        'cache': None,
         }
 
     MIDDLE2START_MAP = {}
@@ -98,163 +427,221 @@ class PythonSequence:
 
     keywords_regex_chunk = "|".join(python_startblock_keywords)
 
-    control_start_string = "\s*%\s*(({key}).*:)".format(key=keywords_regex_chunk)
-    control_end_string = "\s*%\s*end({key})".format(key=keywords_regex_chunk)
-    control_middle_string = "\s*%\s*(({key}).*:)".format(key="|".join(middle_keywords))
-
-    CONTROL_START_REGEX = re.compile(control_start_string)
-    CONTROL_MIDDLE_REGEX = re.compile(control_middle_string)
-    CONTROL_END_REGEX = re.compile(control_end_string)
-
-    NORMAL_PYTHON_LINE_REGEX = re.compile("\s*%\s*(.*)")
-
-    PYTHON_BLOCK_START_REGEX = re.compile("\s*<%")
-    PYTHON_BLOCK_END_REGEX = re.compile("\s*%>")
-
     INDENT = "    "
 
-    DUMMYTEXT = "DUMMYTEXT"
     PYP_COMMENT = "##"
-    PYP_COMMENT_REGEX = re.compile('\s*%s' % PYP_COMMENT)
 
-    def _common_init(self, start_linenum):
-        self.python_linenum = start_linenum
-        self.python_line_map = {}
+    # The lexer's master pattern (see tokenize). Each match is one line, with its newline (or
+    # several, for a <% %> block or text with multi-line ${} expressions), and the name of
+    # the outermost group that matched is the token kind. The alternatives are tried in
+    # order, so e.g. "% for ...:" is a control_start and not a plain python line. Keywords
+    # only match as whole words ("% format = 'a:b'" is a python line).
+    # ([^\S\n] is whitespace within the line.)
+    LEXER_REGEX = re.compile(r"""
+        (?:[^\S\n]*(?:
+            (?P<comment>{comment})[^\n]*
+          | (?P<block_start><%[^\n]*\n(?P<block_body>(?:(?![^\S\n]*%>)[^\n]*\n)*)[^\S\n]*%>[^\n]*)
+          | (?P<block_unclosed><%)[^\n]*
+          | %[^\S\n]*(?:
+                (?P<control_start>(?P<start_word>{start_words})\b[^\n]*:)[^\n]*
+              | (?P<control_middle>(?P<middle_word>{middle_words})\b[^\n]*:)[^\n]*
+              | end(?P<control_end>{start_words})\b[^\n]*
+              | (?P<include>include[^\S\n]+(?P<include_path>"[^"\n]*"|'[^'\n]*')[^\S\n]*)(?=\n|\Z)
+              | (?P<import>import[^\S\n]+(?P<import_path>"[^"\n]*"|'[^'\n]*')[^\S\n]+as[^\S\n]+
+                    (?P<import_name>\w+)[^\S\n]*)(?=\n|\Z)
+              | (?P<async_for>async[^\S\n]+for[^\S\n]+(?P<async_target>[^\n]+?)[^\S\n]+in[^\S\n]+
+                    (?P<async_source>[^\n]+?)[^\S\n]*:[^\S\n]*)(?=\n|\Z)
+              | (?P<python>[^\n]*)
+            )
+        )
+      | (?P<text>(?:[^\n$]+|\$\{{[^}}]*\}}|\$)*)
+        )(?:\n|\Z)
+        """.format(comment=re.escape(PYP_COMMENT), start_words=keywords_regex_chunk,
+                   middle_words="|".join(middle_keywords)), re.VERBOSE)
+
+    TRIPLE_QUOTE_REGEX = re.compile(r"\"\"\"|\'\'\'")
+    SPACE_COMMENT_REGEX = re.compile(r"(\s*$)|(\s*#)")
+
+    # Output adjacent text lines with a single call (see text_run_to_pythonlines)
+    COALESCE_TEXT = True
+
+    # % include "other.pyp"   (runs other.pyp here, with the same globals and output)
+    # % import "other.pyp" as name   (runs other.pyp in its own namespace, bound to name)
+    INCLUDE_REGEX = re.compile(r"""\s*%\s*include\s+(?P<path>"[^"]*"|'[^']*')\s*$""")
+    IMPORT_REGEX = re.compile(r"""\s*%\s*import\s+(?P<path>"[^"]*"|'[^']*')\s+as\s+(?P<name>\w+)\s*$""")
+
+    # % pypdef cached name(args):   or   % pypdef cached(maxsize=N) name(args):
+    # (the rest of the statement, from name on, is group 'def')
+    PYPDEF_CACHED_REGEX = re.compile(r"pypdef\s+cached(?:\s*\((?P<args>[^)]*)\))?\s+(?P<def>\w+\s*\(.*)$")
+
+    # "def name(" of a pypdef, to add the _OUTPUT argument of its writer (see pyp_runtime.pypdef)
+    PYPDEF_WRITER_REGEX = re.compile(r"^(def\s+\w+\s*\()\s*(\)?)")
+
+    # ${name(...)} or ${name.attr(...)} alone on a text line, name in group 1 (see _get_output_call)
+    OUTPUT_CALL_REGEX = re.compile(r"^\$\{\s*(\w+)\s*(?:\.\s*\w+\s*)?\(.*\)\s*\}$", re.DOTALL)
+    # (and for checking its arguments: string literals, words that rule it out, parentheses)
+    STRING_LITERAL_REGEX = re.compile(r"'''.*?'''|\"\"\".*?\"\"\"|'(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\"", re.DOTALL)
+    OUTPUT_CALL_EXCLUDE_REGEX = re.compile(r"\b(for|yield)\b")
+    PAREN_REGEX = re.compile(r"[()]")
+
+    # Async mode: "await x" as a whole ${} expression or (the right-hand side of) a % line
+    AWAIT_REGEX = re.compile(r"^(?P<assign>[^=]*[^=!<>]=(?!=))?\s*await\s+(?P<expr>[^=\s].*?)\s*$", re.DOTALL)
+
+    # "def name", name in group 1
+    PYTHON_DEF_REGEX = re.compile(r"\s*def\s+(\w+)")
+
+    # A call in a ${} expression (with its string literals blanked out), which ends a run of
+    # merged text lines: whatever it calls may print, or output text lines of its own
+    CALL_REGEX = re.compile(r"[\w)\]]\s*\(")
+
+    def _common_init(self, async_mode=False, in_function=False, pypdef_funcs=None):
+        self.python_line_map = None
         self.pypdef = False
 
-    def __init__(self,start_linenum=1):
+        # async_mode: the template's code is generated as one generator function, in which
+        # "await" becomes "yield" (see get_python_text). in_function: this sequence is
+        # inside a function (def, pypdef, class or cache region), where it can't await.
+        self.async_mode = async_mode
+        self.in_function = in_function
+
+        # Names of the template's pypdefs and "% import" names, shared by the whole tree. A
+        # text line that is just a call of one of these writes its output straight into the
+        # enclosing output (see _get_output_call).
+        if pypdef_funcs is None:
+            pypdef_funcs = set()
+        self.pypdef_funcs = pypdef_funcs
+
+    def __init__(self, async_mode=False, pypdef_funcs=None):
 
         self.control_statement = None
         self.control_word = None
         self.nodes = []
-        self._common_init(start_linenum)
+        self._common_init(async_mode, pypdef_funcs=pypdef_funcs)
 
         # set so new nodes go to "nodes"
         self.curr_node_list = self.nodes
 
-    def add_node(self, node, linenum=None, update_linemap=True):
+    def add_node(self, node):
         self.curr_node_list.append(node)
 
-        if update_linemap:
-            if linenum != None:
-                self.python_line_map[self.python_linenum] = linenum
-            self.python_linenum += 1
-
 
     def set_curr_node_list(self, node_list):
         self.curr_node_list = node_list
 
 
-    # Process a compound <% ... %> Python block
-
-    def _process_python_block(self, lines):
-
-        SPACE_REGEX = re.compile("(\s*)")
-        SPACE_COMMENT_REGEX  = re.compile("(\s*$)|(\s*#)")
-
+    # Turns the lines of a <% ... %> Python block (a block_start token, see tokenize, that
+    # starts at start_linenum) into PythonLines, dedented by the indent of the first line
+    # that has code. Lines inside triple-quoted strings are left alone.
+    def _process_python_block(self, match, start_linenum):
+        block_lines = []
+        block_body = match.group('block_body')
+        if block_body:
+            block_lines = zip(block_body[:-1].split("\n"), itertools.count(start_linenum + 1))
 
         compound_block = []
         min_spaces = None
         in_triplequotes = False
         in_triplequotes_next = False
-        while True:
-            (line, linenum) = lines.pop(0)
-            m = self.PYTHON_BLOCK_END_REGEX.match(line)
-            if m:
-                break
-            else:
-                # Don't allow indent for lines[1:] of triplequote
-                triples = len(re.findall(r"\"\"\"|\'\'\'", line))
-                if (triples % 2 != 0 ):
-                    in_triplequotes_next = not in_triplequotes_next
+        for (line, linenum) in block_lines:
+            # Don't allow indent for lines[1:] of triplequote
+            triples = len(self.TRIPLE_QUOTE_REGEX.findall(line))
+            if (triples % 2 != 0 ):
+                in_triplequotes_next = not in_triplequotes_next
 
-                noindent = in_triplequotes
+            compound_block.append((PythonLine(line, noindent=in_triplequotes), linenum))
 
-                compound_block.append((PythonLine(line, noindent=in_triplequotes), linenum))
+            # don't calculate min spaces if a line is empty
+            # (or if it's a # comment)
+            # Basically, use the term nonempty/non-comment line to determine
+            # how many spaces to adjust by
+            if min_spaces==None and not self.SPACE_COMMENT_REGEX.match(line):
+                # see how many spaces in front of line
+                min_spaces = len(line) - len(line.lstrip())
 
-                # don't calculate min spaces if a line is empty
-                # (or if it's a # comment)
-                # Basically, use the term nonempty/non-comment line to determine
-                # how many spaces to adjust by
-                if min_spaces==None and not SPACE_COMMENT_REGEX.match(line):
-                    # see how many spaces in front of line
-                    min_spaces = len(SPACE_REGEX.match(line).group(0))
+            in_triplequotes = in_triplequotes_next
 
-                in_triplequotes = in_triplequotes_next
-
-
-        compound_block_fixed = []
         for (pythonline, linenum) in compound_block:
-            if not pythonline.noindent:
-                pythonline.string = re.sub("\s{%s}" % min_spaces,'', pythonline.string,count=1)
-            compound_block_fixed.append((pythonline, linenum))
+            if min_spaces and not pythonline.noindent and pythonline.string[:min_spaces].isspace():
+                pythonline.string = pythonline.string[min_spaces:]
 
-        return compound_block_fixed
+        return compound_block
 
 
-    def parse_lines(self, lines):
+    # tokens is consumed as an iterator of tokens (see tokenize), shared with any nested
+    # sequences, so each line is only visited once
+    def parse_lines(self, tokens):
 
-        compound_python_block = []
+        tokens = iter(tokens)
 
-        DUMMYTEXT_REGEX = re.compile("%s\s*$" % self.DUMMYTEXT)
+        for (kind, linenum, line, m) in tokens:
 
-        while lines:
-            (line, linenum) = lines.pop(0)
+            # When we just find a normal line, need to substitute text!
+            # (turned into Python later, in get_lines)
+            if kind == "text":
+                exprs = self.EXPR_REGEX.findall(line)
+                if self.async_mode:
+                    exprs = [self._convert_await(x, line, linenum) for x in exprs]
+                self.add_node(TextLine(line, exprs, linenum))
+                continue
 
-            if self.PYP_COMMENT_REGEX.match(line) or DUMMYTEXT_REGEX.match(line):
+            # Find a Python statement (% x = 5), just output the Python
+            if kind == "python":
+                python_statement = PythonLine(self._convert_await(m.group('python'), line, linenum), linenum=linenum)
+                self.add_node(python_statement)
                 continue
 
-            line = line.replace(self.DUMMYTEXT, "")
+            if kind == "comment":
+                continue
 
-            # Python compound blocks
-            # Keep consuming until we see the end
-            m = self.PYTHON_BLOCK_START_REGEX.match(line)
-            if m:
+            # Python compound blocks, the tokenizer has collected all their lines
+            if kind == "block_start":
 
-                compound_block = self._process_python_block(lines)
+                compound_block = self._process_python_block(m, linenum)
 
                 for (pythonline, linenum) in compound_block:
-                    self.add_node(pythonline, linenum=linenum)
+                    pythonline.linenum = linenum
+                    self.add_node(pythonline)
 
                 continue
 
             # Main control word ("for","if","try", "while")
-            m = self.CONTROL_START_REGEX.match(line)
-            if m:
-                self.update_python_linemap(linenum)
-                control_statement = m.group(1)
-                control_word = m.group(2)
+            if kind == "control_start":
+                control_statement = m.group('control_start')
+                control_word = m.group('start_word')
+
+                if control_word == "pypdef":
+                    self._add_pypdef(control_statement, linenum, tokens)
+                    continue
 
                 is_pypdef = isinstance(self, PythonIndentedSequence) and self.pypdef
-                if (control_word =="pypdef"):
-                    is_pypdef = True
-                    control_statement = control_statement.replace("pypdef","def",1)
 
-                control_statement = PythonLine(control_statement)
+                control_statement = PythonLine(control_statement, linenum=linenum)
 
                 new_block = PythonIndentedSequence(control_statement=control_statement,
                                            control_word=control_word,
-                                           start_linenum = self.python_linenum + 1,
                                            pypdef=is_pypdef,
-                                           control_linenum = linenum)
+                                           control_linenum = linenum,
+                                           pypdef_funcs=self.pypdef_funcs,
+                                           async_mode=self.async_mode,
+                                           in_function=self.in_function or control_word in ("def", "class"))
+
+                if self.async_mode and not new_block.in_function and control_word in ("for", "while"):
+                    new_block.add_node(PythonLine("yield _PYP_CHECKPOINT"))
 
-                if is_pypdef and (control_word =="pypdef"):
-                    new_block.add_node(PythonLine("_OUTPUT=[]"))   #only add this start very start of pypdef, not a nested block
+                if control_word == "cache":
+                    self._add_cache_region(control_statement, linenum, tokens)
+                    continue
 
-                new_block.parse_lines(lines)
+                new_block.parse_lines(tokens)
 
                 self.add_node(new_block)
-                self.python_linenum = new_block.python_linenum    # advance line num of current sequence
-                self.python_line_map.update(new_block.python_line_map)
                 continue
 
 
             # Middle control words ("elif", "except")
-            m = self.CONTROL_MIDDLE_REGEX.match(line)
-            if m:
-                self.map_increment_linenum(linenum)
-                control_statement = PythonLine(m.group(1))
-                control_word = m.group(2)
+            if kind == "control_middle":
+                control_statement = PythonLine(m.group('control_middle'), linenum=linenum)
+                control_word = m.group('middle_word')
 
                 if self.control_word == None:
                     raise ParseError("Found middle control word (%s) without starting word" % control_word, line, linenum)
@@ -270,15 +657,14 @@ class PythonSequence:
 
                 continue
 
-            m = self.CONTROL_END_REGEX.match(line)
-            if m:
-                end_control_word = m.group(1)
+            if kind == "control_end":
+                end_control_word = m.group('control_end')
 
                 # Don't do any python linemapping, since this code
                 # shouldn't generate any python
 
-                if end_control_word == "pypdef":
-                    self.add_node(PythonLine(r"return '\n'.join(_OUTPUT)"))
+                if end_control_word == "cache":
+                    self.add_node(PythonLine("return _OUTPUT"))
 
                 if self.control_word == None:
                     raise ParseError("Found end control word (end%s) without starting word" % end_control_word, line, linenum)
@@ -289,23 +675,135 @@ class PythonSequence:
                 else:
                     break
 
+            # Includes/imports of other pyp files, run through the IncludeLoader (_PYP)
+            if kind == "include":
+                if self.async_mode:
+                    raise ParseError("Async templates can't include other pyp files (% import works)", line, linenum)
+                python_statement = "_PYP.include(%s, globals(), %s)" % (m.group('include_path'), self.print_func())
+                self.add_node(PythonLine(python_statement, linenum=linenum))
                 continue
 
-            ### MAYBE WE SHOULD ADD SPECIAL OBJECTS INSTEAD OF OUTPUTTING STRINGS HERE!!!!
-
-            # Find a Python statement (% x = 5), just output the Python
-            m = self.NORMAL_PYTHON_LINE_REGEX.match(line)
-            if m:
-                python_statement = PythonLine(m.group(1))
-                self.add_node(python_statement, linenum=linenum)
+            if kind == "import":
+                python_statement = "%s = _PYP.import_template(%s, %s)" % (m.group('import_name'), m.group('import_path'),
+                                                                         self.print_func())
+                self.pypdef_funcs.add(m.group('import_name'))
+                self.add_node(PythonLine(python_statement, linenum=linenum))
                 continue
 
-            # When we just find a normal line, need to substitute text!
-
-            pythonline = PythonLine(self.line_to_pythonstatement(line))
-            self.add_node(pythonline, linenum=linenum)
+            if kind == "async_for":
+                self._add_async_for(m, line, linenum, tokens)
+                continue
 
 
+    # % pypdef name(args):  ...  % endpypdef
+    # The def becomes the pypdef's writer (see pyp_runtime.pypdef), which appends its lines
+    # to the _OUTPUT it's given:
+    #
+    #   @_PYP_PYPDEF
+    #   def name(_OUTPUT, args):
+    #       _START=len(_OUTPUT)
+    #       try:
+    #           _APPEND=_OUTPUT.append
+    #           ...
+    #       except:
+    #           del _OUTPUT[_START:]
+    #           raise
+    #       if len(_OUTPUT) == _START: _APPEND('')
+    #
+    # so that, as when its output was returned as a string, a call that fails outputs
+    # nothing and one that outputs nothing still makes an (empty) line.
+    def _add_pypdef(self, control_statement, linenum, tokens):
+        m = self.PYPDEF_CACHED_REGEX.match(control_statement)
+        if m:
+            self.add_node(PythonLine("@_PYP_CACHED(%s)" % (m.group('args') or ""), linenum=linenum))
+            control_statement = "def " + m.group('def')
+        else:
+            control_statement = control_statement.replace("pypdef","def",1)
+        self.add_node(PythonLine("@_PYP_PYPDEF", linenum=linenum))
+
+        # (methods are called through their object, never by name alone)
+        m = self.PYTHON_DEF_REGEX.match(control_statement)
+        if m and self.control_word != "class":
+            self.pypdef_funcs.add(m.group(1))
+
+        writer_statement = self.PYPDEF_WRITER_REGEX.sub(
+            lambda x: x.group(1) + ("_OUTPUT" if x.group(2) else "_OUTPUT, ") + x.group(2),
+            control_statement, count=1)
+        block_args = dict(control_word="pypdef", pypdef=True, control_linenum=linenum,
+                          pypdef_funcs=self.pypdef_funcs,
+                          async_mode=self.async_mode, in_function=True)
+        writer_block = PythonIndentedSequence(control_statement=PythonLine(writer_statement, linenum=linenum),
+                                              **block_args)
+
+        # The body is parsed as the pypdef's block (for matching % endpypdef, and errors
+        # about it), then turned into the try: block
+        body_block = PythonIndentedSequence(control_statement=PythonLine(control_statement, linenum=linenum),
+                                            **block_args)
+        body_block.add_node(PythonLine("_APPEND=_OUTPUT.append"))   # local name, cheaper to call
+        body_block.parse_lines(tokens)
+        body_block.control_blocks[0].control_statement = PythonLine("try:")
+        except_block = PythonControlBlock(PythonLine("except:"), "except")
+        except_block.nodes.extend([PythonLine("del _OUTPUT[_START:]"), PythonLine("raise")])
+        body_block.control_blocks.append(except_block)
+
+        writer_block.add_node(PythonLine("_START=len(_OUTPUT)"))
+        writer_block.add_node(body_block)
+        writer_block.add_node(PythonLine("if len(_OUTPUT) == _START: _APPEND('')"))
+        self.add_node(writer_block)
+
+    # % cache key=expr, ttl=seconds:  ...  % endcache
+    # The region becomes a function returning its output lines (like a pypdef, but without
+    # joining them), run through _PYP_CACHE_REGION (PYPParser.cache_region), which skips it
+    # when its output is already cached. Both generated lines map to the "% cache" line.
+    def _add_cache_region(self, control_statement, linenum, tokens):
+        cache_args = control_statement.string[len("cache"):-1].strip()
+
+        region_block = PythonIndentedSequence(control_statement=PythonLine("def _pyp_region():", linenum=linenum),
+                                              control_word="cache",
+                                              pypdef=True,
+                                              control_linenum=linenum,
+                                              pypdef_funcs=self.pypdef_funcs,
+                                              async_mode=self.async_mode,
+                                              in_function=True)
+        region_block.add_node(PythonLine("_OUTPUT=[]"))
+        region_block.add_node(PythonLine("_APPEND=_OUTPUT.append"))
+        region_block.parse_lines(tokens)
+        self.add_node(region_block)
+
+        call_args = ", ".join(x for x in ("_pyp_region", self.print_func(), cache_args) if x)
+        self.add_node(PythonLine("_PYP_CACHE_REGION(%s)" % call_args, linenum=linenum))
+
+    # % async for target in source:  ...  % endfor
+    # Awaits source.anext() (see async_iter) for each item, until it gives ASYNC_END
+    def _add_async_for(self, match, line, linenum, tokens):
+        if not self.async_mode or self.in_function:
+            raise ParseError("async for is only allowed at the top level of async templates", line, linenum)
+
+        aiter_name = "_pyp_aiter_%d" % linenum
+        self.add_node(PythonLine("%s = _PYP_AITER(%s)" % (aiter_name, match.group('async_source')), linenum=linenum))
+
+        loop_block = PythonIndentedSequence(control_statement=PythonLine("while True:", linenum=linenum),
+                                            control_word="for",
+                                            control_linenum=linenum,
+                                            pypdef_funcs=self.pypdef_funcs,
+                                            async_mode=self.async_mode)
+        loop_block.add_node(PythonLine("_pyp_item = (yield %s.anext())" % aiter_name, linenum=linenum))
+        loop_block.add_node(PythonLine("if _pyp_item is _PYP_ASYNC_END: break", linenum=linenum))
+        loop_block.add_node(PythonLine("%s = _pyp_item" % match.group('async_target'), linenum=linenum))
+        loop_block.parse_lines(tokens)
+        self.add_node(loop_block)
+
+    # In async mode, "await x" becomes "(yield (x))", for the code to run as a coroutine
+    def _convert_await(self, code, line, linenum):
+        if not self.async_mode or "await" not in code:
+            return code
+        m = self.AWAIT_REGEX.match(code)
+        if not m:
+            return code
+        if self.in_function:
+            raise ParseError("await is only allowed at the top level of the template, "
+                             "not in functions or cache regions", line, linenum)
+        return "%s(yield (%s))" % (m.group('assign') or "", m.group('expr'))
 
     def __str__(self):
         if self.nodes:
@@ -321,11 +819,41 @@ class PythonSequence:
         lines = self.get_lines_from_nodes(self.nodes, indent_level=indent_level)
         return lines
 
+    def print_func(self):
+        if self.pypdef:
+            return "_APPEND"
+        else:
+            return "_PRINT"
+
     # Helper function
     # Takes a list of "nodes", returns array of strings
     def get_lines_from_nodes(self,nodes, indent_level=0):
         lines = []
+        text_run = []
+
         for node in nodes:
+            if isinstance(node, TextLine):
+                output_call = self._get_output_call(node) if len(node.exprs) == 1 else None
+                if output_call:
+                    lines.extend(self.text_run_to_pythonlines(text_run, indent_level))
+                    text_run = []
+                    for line in output_call:
+                        line.set_indent(indent_level)
+                    lines.extend(output_call)
+                    continue
+
+                # A line with a call has to be output on its own, after the text before it
+                if (not self.COALESCE_TEXT) or any(self._has_call(x) for x in node.exprs):
+                    lines.extend(self.text_run_to_pythonlines(text_run, indent_level))
+                    lines.extend(self.text_run_to_pythonlines([node], indent_level))
+                    text_run = []
+                else:
+                    text_run.append(node)
+                continue
+
+            lines.extend(self.text_run_to_pythonlines(text_run, indent_level))
+            text_run = []
+
             if isinstance(node, PythonLine):
                 node.set_indent(indent_level)
                 lines.append(node)
@@ -335,65 +863,144 @@ class PythonSequence:
                 print node
                 print type(node)
                 assert False, 'Should not see anything other than PythonLine/PythonSequence objects'
-        return lines
 
+        lines.extend(self.text_run_to_pythonlines(text_run, indent_level))
+        return lines
 
+    # A text line that is nothing but a call of a pypdef (or of something in an imported
+    # template), "${name(args)}", outputs what the call writes without building its string.
+    # Returns a list of PythonLines: in pypdefs and cache regions, ones that pass _OUTPUT to
+    # the pypdef's writer (or to a _PYP_VALUE_WRITER, for anything else), and output a
+    # value it returns (with "% return") in place of what it wrote,
+    #
+    #   _CALL_START=len(_OUTPUT)
+    #   _CALL_RESULT=(getattr(name, '_pyp_write', None) or _PYP_VALUE_WRITER(name))(_OUTPUT, args)
+    #   if _CALL_RESULT is not None: _OUTPUT[_CALL_START:] = ['%s' % (_CALL_RESULT,)]
+    #
+    # and elsewhere _PYP_PRINT_CALL(_PRINT, name, args) (see pyp_runtime.pypdef). None for
+    # any other line.
+    def _get_output_call(self, node):
+        if not self.pypdef_funcs:
+            return None
+        m = self.OUTPUT_CALL_REGEX.match(node.text)
+        if not m or m.group(1) not in self.pypdef_funcs:
+            return None
+
+        # The call's parentheses have to be the first and the last, with only the arguments
+        # between them (ignoring any in strings). Arguments with a for (a generator
+        # expression can't take another argument next to it) or a yield are left alone.
+        expr = node.exprs[0].strip()
+        code = self.STRING_LITERAL_REGEX.sub('""', expr)
+        if self.OUTPUT_CALL_EXCLUDE_REGEX.search(code):
+            return None
+        depth = 0
+        for paren in self.PAREN_REGEX.finditer(code):
+            depth += 1 if paren.group() == "(" else -1
+            if depth == 0:
+                break
+        if depth or paren.end() != len(code):
+            return None
+
+        paren = expr.index("(")
+        (func, args) = (expr[:paren].strip(), expr[paren+1:-1].strip())
+        args = ", " + args if args else ""
+        if not self.pypdef:
+            return [PythonLine("_PYP_PRINT_CALL(_PRINT, %s%s)" % (func, args), linenum=node.linenum)]
+        return [PythonLine("_CALL_START=len(_OUTPUT)", linenum=node.linenum),
+                PythonLine("_CALL_RESULT=(getattr(%s, '_pyp_write', None) or _PYP_VALUE_WRITER(%s))(_OUTPUT%s)"
+                           % (func, func, args), linenum=node.linenum),
+                PythonLine("if _CALL_RESULT is not None: _OUTPUT[_CALL_START:] = ['%s' % (_CALL_RESULT,)]",
+                           linenum=node.linenum)]
+
+    def _has_call(self, expr):
+        return self.CALL_REGEX.search(self.STRING_LITERAL_REGEX.sub('""', expr)) is not None
+
+    # Also sets python_line_map, for the whole generated text (see get_source_linenum)
+    # In async mode, the code is one generator function, _pyp_main (see PYPParser.render_async)
     def get_python_text(self):
-        lines = self.get_lines()
+        if self.async_mode:
+            lines = [PythonLine("def _pyp_main():")] + self.get_lines(indent_level=1)
+            end_line = PythonLine("yield _PYP_CHECKPOINT")   # (a generator even if it never awaits)
+            end_line.set_indent(1)
+            lines.append(end_line)
+        else:
+            lines = self.get_lines()
+
+        self.python_line_map = array('i', [0])
+        self.python_line_map.extend([line.linenum or 0 for line in lines])
 
         # finally, add in indents
         lines_adjusted = [line.get_indented() for line in lines]
         return "\n".join(lines_adjusted)
 
-    # Takes the source linenum, maps it to the current python line num, then increments py linenum
-    def map_increment_linenum(self, linenum):
-        self.python_line_map[self.python_linenum] = linenum
-        self.python_linenum += 1
-
-    def update_python_linemap(self, linenum):
-        self.python_line_map[self.python_linenum] = linenum
-
-    # Function to do variable expansion, turn into a Python print statement
-    def line_to_pythonstatement(self, line):
-        printline_build = ""
-        exprs = self.EXPR_REGEX.findall(line)
-
-        print_func = "_OUTPUT.append" if self.pypdef else "_PRINT"
-
-        if exprs:
-            print_string = line
-
-            print_string = escape_percent(print_string)
-            print_string = self.EXPR_REGEX.sub("%s", print_string)   # replace ${...} with %s
-
-            print_string = escape_quotes(print_string)
-
-            # Get a list of the original expressions, clean them up
-            exprs_cleaned = []
-            for expr in exprs:
-                expr_cleaned = expr.replace("${","").replace("}","")
-                exprs_cleaned.append(expr_cleaned)
-
-            parens_statement = ("'%s'" % print_string) + " % " + "(%s,)" % \
-                (",".join(["(%s)" % expr for expr in exprs_cleaned]))
+    # Turns a run of adjacent TextLines into PythonLines that output all of them with one
+    # call. Static text is escaped here, once; the ${} expressions of the whole run are
+    # filled into one format string by _PYP_PRINT_RUN (see pyp_runtime.print_run):
+    #
+    #   _PYP_PRINT_RUN(_PRINT, 'static\nx is %s\ny is %s', (
+    #       (x),
+    #       (y),
+    #       ))
+    #
+    # Each expression goes on its own Python line, mapped to its pyp line, so errors
+    # still point at the right line.
+    def text_run_to_pythonlines(self, text_run, indent_level=0):
+        if not text_run:
+            return []
+
+        print_func = self.print_func()
+        first_linenum = text_run[0].linenum
+
+        if not any(x.exprs for x in text_run):
+            print_string = r"\n".join(escape_quotes(x.text) for x in text_run)
+            lines = [PythonLine("%s(('%s'))" % (print_func, print_string), linenum=first_linenum)]
 
         else:
-            line = escape_quotes(line)
-            parens_statement = "('%s')" % line
+            print_strings = []
+            for text_line in text_run:
+                print_string = escape_percent(text_line.text)
+                print_string = self.EXPR_REGEX.sub("%s", print_string)   # replace ${...} with %s
+                print_strings.append(escape_quotes(print_string))
+            print_string = r"\n".join(print_strings)
+
+            if len(text_run) == 1:
+                lines = [PythonLine("%s('%s' %% (%s,))" % (print_func, print_string,
+                                                         self._exprs_to_python(text_run[0].exprs)),
+                                    linenum=first_linenum)]
+            else:
+                lines = [PythonLine("_PYP_PRINT_RUN(%s, '%s', (" % (print_func, print_string), linenum=first_linenum)]
+                for text_line in text_run:
+                    if text_line.exprs:
+                        lines.append(PythonLine(self.INDENT + self._exprs_to_python(text_line.exprs) + ",",
+                                                linenum=text_line.linenum))
+                lines.append(PythonLine(self.INDENT + "))", linenum=text_run[-1].linenum))
+
+        for line in lines:
+            line.set_indent(indent_level)
+        return lines
 
-        python_line = "%s(%s)" % (print_func, parens_statement)
-        return python_line
+    def _exprs_to_python(self, exprs):
+        # Get a list of the original expressions, clean them up
+        exprs_cleaned = []
+        for expr in exprs:
+            expr_cleaned = expr.replace("${","").replace("}","")
+            exprs_cleaned.append(expr_cleaned)
+
+        return ",".join(["(%s)" % expr for expr in exprs_cleaned])
 
 
 class PythonIndentedSequence(PythonSequence):
-    def __init__(self, control_statement, control_word, start_linenum=1, pypdef=False,
-                 control_linenum=None):
+    __slots__ = ('control_linenum', 'control_blocks')
+
+    def __init__(self, control_statement, control_word, pypdef=False,
+                 control_linenum=None, async_mode=False, in_function=False,
+                 pypdef_funcs=None):
 
         self.control_statement = control_statement
         self.control_word = control_word
         self.control_linenum = control_linenum
 
-        self._common_init(start_linenum)
+        self._common_init(async_mode, in_function, pypdef_funcs)
 
         # must init with some control word (for, if, def)
         self.control_blocks = []
@@ -405,12 +1012,6 @@ class PythonIndentedSequence(PythonSequence):
 
         self.pypdef = pypdef
 
-    def print_func(self):
-        if self.pypdef:
-            return "_OUTPUT.append"
-        else:
-            return "_PRINT"
-
     # returns PythonLine's for an indented/control sequence
     # differs from the base class version, in that it adds "if", "else", etc tags
     # and will add indents to inner statements
@@ -427,226 +1028,2376 @@ class PythonIndentedSequence(PythonSequence):
                 lines.extend(sublines)
         return lines
 
+# Splits pyp source into tokens in one pass of LEXER_REGEX. Tokens are tuples
+# (kind, linenum, line, match): kind is the name of the LEXER_REGEX group that matched
+# ("text", "python", "control_start", ...), linenum/line the (first) source line and match
+# the match object. Text with multi-line ${} expressions is one token, its line having the
+# expressions' newlines turned into spaces; a <% %> block is one token too (see
+# PythonSequence._process_python_block). Raises ParseError for a <% block that's never closed.
+def tokenize(text):
+    linenum = 1
+    for m in PythonSequence.LEXER_REGEX.finditer(text):
+        # The empty match at the end is the line after a final newline, like the last item
+        # of text.split("\n"). Without a final newline, the last line has been matched already.
+        if m.start() == len(text) and text and not text.endswith("\n"):
+            break
+        kind = m.lastgroup
+
+        if kind == "text":
+            line = m.group('text')
+            if "\n" in line:
+                # multi-line ${} expressions: join the lines, but keep counting them
+                yield (kind, linenum, PythonSequence.EXPR_REGEX.sub(lambda x: x.group(0).replace("\n", " "), line), m)
+                linenum += line.count("\n") + 1
+                continue
+            yield (kind, linenum, line, m)
+
+        elif kind == "block_start":
+            yield (kind, linenum, m.group(0).split("\n", 1)[0], m)
+            linenum += m.group('block_body').count("\n") + 2
+            continue
+
+        elif kind == "block_unclosed":
+            raise ParseError("Python block (<%) is never closed with %>", m.group(0).rstrip("\n"), linenum)
+
+        else:
+            yield (kind, linenum, m.group(0).rstrip("\n"), m)
+
+        linenum += 1
+
+
 class PYPParser():
 
-    def __init__(self, text, debug=False, input_filename=None):
+    def __init__(self, text, debug=False, input_filename=None, cache=None, region_cache=None,
+                 async_mode=False):
         self.debug = debug
-        text = self.preprocess_text(text)
+        self.source_text = text
 
-        self.text = text
-        textlines = text.split("\n")
-
-        # Save text lines with line numbers (line, lineno). Start line numbering at 1
-        self.textlines = zip(textlines, [1+x for x in range(len(textlines))])
+        # Filled in lazily by get_source_lines(), so that a compile cache hit never
+        # has to split the text
+        self.source_lines = None
 
-        self.python_line_map = {}
+        self.python_line_map = array('i')
         self.input_filename = input_filename
+        self.cache = cache
+
+        # RegionCache for "% cache" regions, they always run if there is none
+        self.region_cache = region_cache
+
+        # Generate the code as a coroutine, for render_async
+        self.async_mode = async_mode
 
-    def preprocess_text(self, text):
+        # Filename given to compile(), shows up in tracebacks of the template code
+        self.code_filename = input_filename or "<pyp>"
 
-        dummyline = "\n%s" % PythonSequence.DUMMYTEXT
+        # Runs included/imported templates, created when needed (see get_loader)
+        self.loader = None
 
-        def replace_func(match):
-            innertext = match.group('inner')
-            num_extra_newlines = innertext.count("\n")
-            newtext = "${%s}" % innertext.replace("\n"," ") + dummyline*num_extra_newlines
-            return newtext
+        # A TemplateProfiler to run execute_code under, if any
+        self.profiler = None
 
-        newtext = PythonSequence.EXPR_REGEX.sub(replace_func, text)
+        # Where execute() reports errors, sys.stdout if None
+        self.report_stream = None
 
-        return newtext
+        # Passed on to the FileSink when execute() writes to a file (to leave the file alone
+        # if its contents didn't change), which then sets output_changed/output_signature
+        self.skip_unchanged = False
+        self.output_manifest = None
+        self.output_changed = None
+        self.output_signature = None
+
+        # A RenderObserver to tell about each compile and render, if any. compile_stats is
+        # the RenderStats of the last compile it saw (the renders copy its line counts).
+        self.observer = None
+        self.compile_stats = None
+        self._compiling_stats = None   # (set while compiling, for the phases to record into)
+
+    def get_report_stream(self):
+        return self.report_stream or sys.stdout
+
+    # The pyp source split into lines, for error messages
+    def get_source_lines(self):
+        if self.source_lines is None:
+            self.source_lines = self.source_text.split("\n")
+        return self.source_lines
 
     def _get_pyp_errorline(self, error_linenum):
-        if error_linenum in self.python_line_map:
-            source_linenum =  self.python_line_map[error_linenum]
-            line_text = self.textlines[source_linenum-1][0]
+        source_linenum = get_source_linenum(self.python_line_map, error_linenum)
+        if source_linenum is not None:
+            line_text = self.get_source_lines()[source_linenum-1]
             return (source_linenum, line_text)
         else:
             return (None, None)
 
-    def write_and_execute_python_file(self, script_text, filename=None, output_filename=None):
+    def _report_syntax_error(self, exc_type, exc_value):
+        out = self.get_report_stream()
+        error_linenum = exc_value.lineno
+
+        print >>out
+        print >>out, "======= SYNTAX ERROR ============="
+        (source_linenum, line_text) = self._get_pyp_errorline(error_linenum)
 
-        if (not filename):
-            pyfile = tempfile.NamedTemporaryFile(suffix='.py')
+        if source_linenum != None:
+            print >>out, 'File "%s", line %d' % (self.input_filename, source_linenum)
+            print >>out, "  %s" % (line_text)
         else:
-            pyfile = open(filename,'w')
+            print >>out, "Sorry, could not find pyp source line"
+
+        print >>out, "%s: %s" % (exc_type.__name__, exc_value)
+
+        print >>out
+        print >>out, 'DETAILED SYNTAX ERROR:'
+        exception_text = traceback.format_exception_only(exc_type, exc_value)
+        print >>out, "".join(exception_text)
+
+        #traceback.print_exc()
+        print >>out, "==================================="
+
+    # Returns the parser for the template (this one, or an included file) that the code
+    # in a traceback frame came from, or None if it's not template code
+    def _get_frame_parser(self, filename):
+        if filename == self.code_filename:
+            return self
+        if self.loader:
+            for parser in self.loader.parsers.values():
+                if filename == parser.code_filename:
+                    return parser
+        return None
+
+    # Report the innermost frame that's actually in a template (the error may have
+    # been raised inside some imported module). Returns (tb_packet, parser)
+    def _get_error_packet(self, tb_packets):
+        for tb_packet in reversed(tb_packets):
+            parser = self._get_frame_parser(tb_packet[0])
+            if parser:
+                return (tb_packet, parser)
+        return (tb_packets[-1], self)
+
+    # tb_packets should only contain the frames from the template code onwards
+    def _report_runtime_error(self, exc_type, exc_value, tb_packets):
+        out = self.get_report_stream()
+        (tb_packet, parser) = self._get_error_packet(tb_packets)
+        (filename, error_linenum, func, text) = tb_packet
+
+        #traceback.print_exc()
+
+        print >>out
+        print >>out, "======= ERROR INFO ================"
+        #exception_text = traceback.format_exception_only(exc_type, exc_value)
+        #print exception_text[0]
+
+
+
+        (source_linenum, line_text) = parser._get_pyp_errorline(error_linenum)
+        if source_linenum != None:
+            print >>out, 'File "%s", line %d' % (parser.input_filename, source_linenum)
+            print >>out, "  %s" % (line_text)
 
-        pyfile.write(script_text)
-        pyfile.flush()
+        else:
+            print >>out, "Sorry, could not find pyp source line"
+            print >>out, "".join(traceback.format_list([tb_packets[-1]]))
+            #print "Python error --> %s on line: %d (%s)" % (os.path.abspath(pyfile.name), error_linenum, text)
 
-        if self.debug:
-            print "Python executable:", pyfile.name
-        dir = os.path.dirname( pyfile.name)
-        sys.path.append(dir)
+        print >>out, "%s: %s" % (exc_type.__name__, exc_value)
 
-        modname = os.path.split(pyfile.name)[1].replace('.py','')
 
-        # Create a print function that prints to the file (or otherwise std.out)
-        if output_filename:
-            temp_outputname = output_filename + ".tmp"
-            output = open(temp_outputname,'w')
+        if self.debug:
+            print >>out
+            print >>out, "TRACEBACK:"
+            out.write("".join(traceback.format_list(tb_packets)))
+
+            print >>out
+            print >>out, "PYP TRACEBACK:"
+            for tb_packet in tb_packets:
+                linenum = tb_packet[1]
+                (source_linenum, line_text) = (None, None)
+                parser = self._get_frame_parser(tb_packet[0])
+                if parser:
+                    (source_linenum, line_text) = parser._get_pyp_errorline(linenum)
+                if (source_linenum != None):
+                    print >>out, '  File "%s", line %d' % (parser.input_filename, source_linenum)
+                    print >>out, "    %s" % (line_text)
+                else:
+                    print >>out, "(Unknown pyp line)"
+
+        print >>out, "==================================="
+
+    # Turn errors from compiling/running the template into TemplateErrors with the pyp location
+
+    def _make_syntax_error(self, exc_value):
+        (source_linenum, line_text) = self._get_pyp_errorline(exc_value.lineno)
+        return TemplateSyntaxError("SyntaxError: %s" % (exc_value,), line_text, source_linenum,
+                                   self.input_filename)
+
+    def _make_runtime_error(self, exc_info):
+        (exc_type, exc_value, tb) = exc_info
+        (tb_packet, parser) = self._get_error_packet(traceback.extract_tb(tb))
+        (source_linenum, line_text) = parser._get_pyp_errorline(tb_packet[1])
+        return TemplateRuntimeError("%s: %s" % (exc_type.__name__, exc_value), line_text, source_linenum,
+                                    parser.input_filename, exc_info)
+
+    # Globals for one run of the template code. Context variables become template globals.
+    def _make_namespace(self, print_func, context=None):
+        namespace = make_namespace(print_func, context, self.input_filename)
+        namespace['_PYP'] = self.get_loader()
+        namespace['_PYP_CACHE_REGION'] = self.cache_region
+        return namespace
+
+    # Runs a "% cache" region (body, which returns the region's output lines) unless its
+    # output for this key is in the region cache, then prints the lines with print_func.
+    # Counts the hit or miss in stats, if given.
+    def cache_region(self, body, print_func, key=None, ttl=None, stats=None):
+        if self.region_cache is None:
+            output_lines = body()
         else:
-            output = sys.stdout
+            cache_key = self.region_cache.make_key(body.func_code, key)
+            output_lines = self.region_cache.get(cache_key)
+            if stats is not None:
+                if output_lines is None:
+                    stats.region_cache_misses += 1
+                else:
+                    stats.region_cache_hits += 1
+            if output_lines is None:
+                output_lines = body()
+                self.region_cache.set(cache_key, output_lines, ttl)
+        for line in output_lines:
+            print_func(line)
+
+    def get_loader(self):
+        if self.loader is None:
+            with _loader_lock:
+                if self.loader is None:
+                    self.loader = IncludeLoader(cache=self.cache, region_cache=self.region_cache)
+        return self.loader
+
+    # Files this template includes or imports directly, as paths relative to the current
+    # directory. Found with a quick scan of the source, without parsing.
+    def get_dependencies(self):
+        dependencies = []
+        for line in self.source_text.split("\n"):
+            m = PythonSequence.INCLUDE_REGEX.match(line) or PythonSequence.IMPORT_REGEX.match(line)
+            if m:
+                path = resolve_include_path(m.group('path')[1:-1], self.input_filename)
+                if path not in dependencies:
+                    dependencies.append(path)
+        return dependencies
+
+    # Renders the template, yielding the output in chunks (of about RENDER_CHUNK_SIZE bytes) as
+    # the template code produces them. The template runs in a separate thread, which blocks
+    # once RENDER_QUEUE_SIZE chunks are waiting, so memory stays bounded however big the output.
+    # ParseError/TemplateSyntaxError are raised straight away, TemplateRuntimeError from the generator.
+    RENDER_CHUNK_SIZE = 16384
+    RENDER_QUEUE_SIZE = 4
+
+    def render_iter(self, **context):
+        return self.iter_code(self.compile_template(), context)
+
+    def iter_code(self, code, context=None):
+        import Queue
+        sink = _ChunkQueueSink(self.RENDER_CHUNK_SIZE, self.RENDER_QUEUE_SIZE)
+        namespace = self._make_namespace(sink.append, context)
+        stats = self._start_render_stats(namespace) if self.observer is not None else None
+
+        def run():
+            try:
+                try:
+                    exec code in namespace
+                    sink.flush()
+                    if stats is not None:
+                        self._finish_render_stats(stats, True, sink.get_output_counts())
+                    sink.put(("done", None))
+                except RenderAborted:
+                    pass
+                except:
+                    exc_info = sys.exc_info()
+                    if stats is not None:
+                        self._finish_render_stats(stats, False, sink.get_output_counts())
+                    sink.put(("error", (self._make_runtime_error(exc_info), exc_info[2])))
+            except RenderAborted:
+                pass
+
+        thread = threading.Thread(target=run, name="pyp-render")
+        thread.daemon = True
+        thread.start()
 
-        def _PRINT(line):
-            output.write(line + "\n")
+        try:
+            while True:
+                # (poll with a timeout, so that KeyboardInterrupt still gets through)
+                try:
+                    (kind, value) = sink.chunks.get(timeout=0.5)
+                except Queue.Empty:
+                    continue
+
+                if kind == "chunk":
+                    yield value
+                elif kind == "done":
+                    break
+                else:
+                    (error, tb) = value
+                    raise error, None, tb
+        finally:
+            sink.stopped.set()
+
+    # Runs async template code (see PythonSequence.get_python_text) as a coroutine: a generator
+    # yielding whatever the template awaits, and expecting the result to be sent back (or the
+    # error thrown in), the protocol of Tornado's gen.coroutine, for one. Output goes to
+    # writer.write() in chunks: before each await that reaches the event loop, every
+    # chunk_lines lines otherwise, and at the end. If write() returns an awaitable, it's
+    # yielded too. Errors are raised as TemplateRuntimeErrors.
+    def render_async(self, code, writer, context=None, chunk_lines=StreamSink.DEFAULT_FLUSH_LINES):
+        buf = []
+        namespace = self._make_namespace(buf.append, context)
+        stats = self._start_render_stats(namespace) if self.observer is not None else None
+        try:
+            exec code in namespace
+            body = namespace['_pyp_main']()
+        except:
+            exc_info = sys.exc_info()
+            if stats is not None:
+                self._finish_render_stats(stats, False, (0, 0))
+            raise self._make_runtime_error(exc_info), None, exc_info[2]
+
+        counts = [0, 0]   # lines and bytes written
+
+        def flush():
+            buf.append("")
+            chunk = join_lines(buf)
+            del buf[:]
+            counts[0] += chunk.count("\n")
+            counts[1] += len(chunk)
+            return writer.write(chunk)
+
+        (value, exc_info) = (None, None)
+        success = False
+        try:
+            while True:
+                try:
+                    if exc_info:
+                        awaitable = body.throw(*exc_info)
+                    else:
+                        awaitable = body.send(value)
+                except StopIteration:
+                    break
+                except:
+                    exc_info = sys.exc_info()
+                    raise self._make_runtime_error(exc_info), None, exc_info[2]
+                (value, exc_info) = (None, None)
+
+                if isinstance(awaitable, Ready):
+                    value = awaitable.value
+                    continue
+                if awaitable is ASYNC_CHECKPOINT and len(buf) < chunk_lines:
+                    continue
+
+                if buf:
+                    pending = flush()
+                    if pending is not None:
+                        yield pending
+                if awaitable is ASYNC_CHECKPOINT:
+                    continue
+
+                try:
+                    value = yield awaitable
+                except GeneratorExit:
+                    raise
+                except:
+                    exc_info = sys.exc_info()
+
+            if buf:
+                pending = flush()
+                if pending is not None:
+                    yield pending
+            success = True
+        finally:
+            body.close()
+            if stats is not None:
+                self._finish_render_stats(stats, success, tuple(counts))
+
+    # Runs compiled template code, sending the output to sink (an OutputSink). The caller
+    # is responsible for closing the sink. Raises TemplateRuntimeError.
+    def run_code(self, code, sink, context=None):
+        namespace = self._make_namespace(sink.append, context)
+        stats = self._start_render_stats(namespace) if self.observer is not None else None
+        try:
+            exec code in namespace
+        except:
+            exc_info = sys.exc_info()
+            if stats is not None:
+                self._finish_render_stats(stats, False, sink.get_output_counts())
+            raise self._make_runtime_error(exc_info), None, exc_info[2]
+        if stats is not None:
+            self._finish_render_stats(stats, True, sink.get_output_counts())
+
+    # Returns the RenderStats for a render about to run in namespace, whose cache regions
+    # now count their hits and misses into it
+    def _start_render_stats(self, namespace):
+        stats = RenderStats("render", self.input_filename, self.compile_stats)
+        namespace['_PYP_CACHE_REGION'] = functools.partial(self.cache_region, stats=stats)
+        stats.start_time = time.time()
+        return stats
+
+    def _finish_render_stats(self, stats, success, output_counts):
+        stats.phases['execute'] = time.time() - stats.start_time
+        stats.success = success
+        if output_counts is not None:
+            (stats.output_lines, stats.output_bytes) = output_counts
+        stats.peak_memory_kb = get_peak_memory_kb()
+        self.observer.rendered(stats)
+
+    # Runs an already compiled template (see compile_code)
+    def execute_code(self, code, output_filename=None):
+        if output_filename:
+            sink = FileSink(output_filename, skip_unchanged=self.skip_unchanged, manifest=self.output_manifest)
+        else:
+            sink = StreamSink(sys.stdout)
 
-        # Use this to try to figure out which traceback message matches the input PYP file
-        tb_regex = re.compile('.*%s.*line (\d+)' % pyfile.name)
+        namespace = self._make_namespace(sink.append)
+        stats = self._start_render_stats(namespace) if self.observer is not None else None
 
         success = False
         try:
-            runpy.run_module(modname, init_globals={'_PRINT': _PRINT
-                                                    })
+            if self.profiler:
+                self.profiler.enable()
+            try:
+                exec code in namespace
+            finally:
+                if self.profiler:
+                    self.profiler.disable()
+            sink.close(True)
             success = True
         except SyntaxError:
             exc_type, exc_value, tb = sys.exc_info()
-            #tb_packets = traceback.extract_tb(tb)
-            #(filename, error_linenum, func, text) = tb_packets[-1]
+            close_failed_sink(sink)   # (before the report, so the output so far comes first on stdout)
+            self._report_syntax_error(exc_type, exc_value)
+        except:
+            exc_type, exc_value, tb = sys.exc_info()
+            close_failed_sink(sink)
+            # skip this frame
+            tb_packets = traceback.extract_tb(tb)
+            self._report_runtime_error(exc_type, exc_value, tb_packets[1:])
 
-            error_linenum = exc_value.lineno
+        if output_filename:
+            (self.output_changed, self.output_signature) = (sink.changed, sink.signature)
+        if stats is not None:
+            self._finish_render_stats(stats, success, sink.get_output_counts())
+        return success
+
+    # Returns the source of a standalone Python module for the template (see MODULE_TEMPLATE).
+    # Raises ParseError/SyntaxError.
+    def gen_python_module(self):
+        for (kind, linenum, line, m) in tokenize(self.source_text):
+            if kind in ("include", "import"):
+                raise ParseError("Precompiled modules can't include/import other pyp files", line, linenum)
+            if kind == "control_start":
+                if PythonSequence.PYPDEF_CACHED_REGEX.match(m.group('control_start')):
+                    raise ParseError("Precompiled modules can't use cached pypdefs", line, linenum)
+                if m.group('start_word') == "cache":
+                    raise ParseError("Precompiled modules can't use cache regions", line, linenum)
+
+        python_text = self.parse()
+        compile(python_text, self.code_filename, 'exec')   # check it compiles
+
+        from pprint import PrettyPrinter
+        pp = PrettyPrinter()
+        source_lines = self.get_source_lines()
+        return MODULE_TEMPLATE.format(version=__version__,
+                                      filename=self.input_filename,
+                                      filename_repr=repr(self.code_filename),
+                                      line_map=pp.pformat(dict((python_linenum, linenum)
+                                          for (python_linenum, linenum) in enumerate(self.python_line_map)
+                                          if linenum)),
+                                      source_lines=pp.pformat(source_lines),
+                                      python_source=repr(python_text))
+
+    # Parses the template, returns the generated Python text. Sets python_line_map.
+    def parse(self):
+        stats = self._compiling_stats
+        if stats is not None:
+            start = time.time()
+
+        sequence = PythonSequence(async_mode=self.async_mode)
+        sequence.parse_lines(tokenize(self.source_text))
+        if stats is not None:
+            now = time.time()
+            (stats.phases['parse'], start) = (now - start, now)
 
+        python_text = sequence.get_python_text()
+        self.python_line_map = sequence.python_line_map
+        if stats is not None:
+            stats.phases['codegen'] = time.time() - start
+
+        return python_text
+
+    def _cache_key(self):
+        return self.cache.make_key(self.source_text, self.input_filename, variant="async" if self.async_mode else "")
+
+    # Compiles generated Python text (from parse) and stores it in the compile cache
+    def compile_python(self, python_text):
+        stats = self._compiling_stats
+        if stats is not None:
+            start = time.time()
+        code = compile(python_text, self.code_filename, 'exec')
+        if stats is not None:
+            stats.phases['compile'] = time.time() - start
+        if self.cache is not None:
+            self.cache.set(self._cache_key(), code, self.python_line_map)
+        return code
+
+    # Returns the compiled code object for the template, straight from the compile cache if
+    # the source has been seen before. Raises ParseError/SyntaxError.
+    def compile_code(self):
+        if self.observer is not None:
+            return self._observe_compile(self._compile_code)
+        return self._compile_code()
+
+    def _compile_code(self):
+        if self.cache is not None:
+            stats = self._compiling_stats
+            if stats is not None:
+                start = time.time()
+            cached = self.cache.get(self._cache_key())
+            if stats is not None:
+                stats.phases['cache'] = time.time() - start
+                stats.compile_cache = "miss" if cached is None else "hit"
+            if cached is not None:
+                (code, self.python_line_map) = cached
+                return code
+
+        return self.compile_python(self.parse())
+
+    # Runs compile_func (which compiles the template and returns the code) collecting its
+    # RenderStats, then tells the observer
+    def _observe_compile(self, compile_func):
+        stats = self._compiling_stats = RenderStats("compile", self.input_filename)
+        text = self.source_text
+        stats.template_lines = text.count("\n") + (1 if text and not text.endswith("\n") else 0)
+        try:
+            code = compile_func()
+            stats.success = True
+            return code
+        except:
+            stats.success = False
+            raise
+        finally:
+            self._compiling_stats = None
+            if stats.success:
+                stats.python_lines = len(self.python_line_map) - 1
+            stats.peak_memory_kb = get_peak_memory_kb()
+            self.compile_stats = stats
+            self.observer.compiled(stats)
+
+    # Like compile_code, but for library use: errors are raised as TemplateErrors
+    # that know the pyp filename and line
+    def compile_template(self):
+        try:
+            return self.compile_code()
+        except ParseError as inst:
+            inst.filename = self.input_filename
+            raise
+        except SyntaxError as inst:
+            raise self._make_syntax_error(inst)
+
+    def _report_parse_error(self, inst):
+        out = self.get_report_stream()
+        print >>out
+        print >>out, "====== PARSE ERROR ========="
+        print >>out, 'File "%s", line %d' % (self.input_filename, inst.linenum)
+
+        print >>out, "  %s" % inst.line
+        print >>out, "ParseError: %s" % inst.text
+        print >>out, "============================"
+        print >>out
+
+    # Compiles the template for --py/--debug, which need the generated text: always parses,
+    # writes the text to python_filename (if given) and prints it in debug mode
+    def _compile_showing_python(self, python_filename):
+        python_text = self.parse()
+        if python_filename:
+            with open(python_filename, 'w') as pyfile:
+                pyfile.write(python_text)
+
+        if self.debug:
+            print "PYTHON CODE:"
+            print python_text
             print
-            print "======= SYNTAX ERROR ============="
-            (source_linenum, line_text) = self._get_pyp_errorline(error_linenum)
 
-            if source_linenum != None:
-                print 'File "%s", line %d' % (self.input_filename, source_linenum)
-                print "  %s" % (line_text)
-            else:
-                print "Sorry, could not find pyp source line"
+            # so debug tracebacks show the generated Python lines
+            python_lines = [x + "\n" for x in python_text.split("\n")]
+            linecache.cache[self.code_filename] = (len(python_text), None, python_lines,
+                                                   self.code_filename)
 
-            print "%s: %s" % (exc_type.__name__, exc_value)
+        return self.compile_python(python_text)
 
+    # Renders to output_filename (or stdout), printing any errors. Returns True on success.
+    # Exits on a parse error.
+    def execute(self, output_filename=None, python_filename=None):
+        try:
+            if python_filename or self.debug:
+                if self.observer is not None:
+                    code = self._observe_compile(lambda: self._compile_showing_python(python_filename))
+                else:
+                    code = self._compile_showing_python(python_filename)
+            else:
+                code = self.compile_code()
+        except ParseError as inst:
+            self._report_parse_error(inst)
+            sys.exit(1)
+        except SyntaxError:
+            exc_type, exc_value, tb = sys.exc_info()
+            self._report_syntax_error(exc_type, exc_value)
+            return False
+
+        if self.debug:
             print
-            print 'DETAILED SYNTAX ERROR:'
-            exception_text = traceback.format_exception_only(exc_type, exc_value)
-            print "".join(exception_text)
+            print "EXECUTING PYTHON:"
+        return self.execute_code(code, output_filename=output_filename)
+
+
+# Held while a parser creates its IncludeLoader, so that renders in several threads
+# all get the same one
+_loader_lock = threading.Lock()
+
+# Resolves a path from an include/import relative to the template it's in
+def resolve_include_path(path, from_filename):
+    if os.path.isabs(path) or not from_filename or from_filename.startswith("<"):
+        return path
+    return os.path.normpath(os.path.join(os.path.dirname(from_filename), path))
 
-            #traceback.print_exc()
-            print "==================================="
 
+class IncludeLoader:
+    """
+    Runs the pyp files that a template includes (% include "file.pyp") or imports
+    (% import "file.pyp" as name). The template code sees it as _PYP. Each file is read
+    and compiled once per loader (and through the compile cache, if there is one), and
+    its parser is kept in parsers so errors in it map back to the right file and line.
+    A loader is shared by all renders of a template, which may run in several threads.
+    """
+    def __init__(self, cache=None, region_cache=None):
+        self.cache = cache
+        self.region_cache = region_cache
+        self.parsers = {}
+        self.lock = threading.Lock()   # held while a file is loaded into parsers
+
+        # Per thread: files being included right now, to catch include cycles
+        self.local = threading.local()
+
+    def get_parser(self, path):
+        parser = self.parsers.get(path)
+        if parser is None:
+            with self.lock:
+                parser = self.parsers.get(path)
+                if parser is None:
+                    with open(path, 'r') as f:
+                        text = f.read()
+                    parser = PYPParser(text, input_filename=path, cache=self.cache,
+                                       region_cache=self.region_cache)
+                    parser.loader = self
+                    parser.code = parser.compile_template()
+                    self.parsers[path] = parser
+        return parser
+
+    # The files the current thread is including right now
+    def get_active(self):
+        active = getattr(self.local, 'active', None)
+        if active is None:
+            active = self.local.active = []
+        return active
+
+    def _load(self, path, from_filename):
+        path = resolve_include_path(path, from_filename)
+        active = self.get_active()
+        if path in active:
+            raise TemplateError("Include cycle: %s" % " -> ".join(active + [path]))
+        return self.get_parser(path)
+
+    # Runs the file with the includer's globals, sending its output to print_func
+    def include(self, path, namespace, print_func):
+        # (paths are relative to the file the include is in, which is the caller's code)
+        parser = self._load(path, sys._getframe(1).f_code.co_filename)
+
+        saved_print_func = namespace.get('_PRINT')
+        namespace['_PRINT'] = print_func
+        active = self.get_active()
+        active.append(parser.input_filename)
+        try:
+            exec parser.code in namespace
+        finally:
+            active.pop()
+            namespace['_PRINT'] = saved_print_func
+
+    # Runs the file in a namespace of its own and returns it as a module. Output from its
+    # top level is thrown away, but its functions print to print_func when called.
+    def import_template(self, path, print_func):
+        parser = self._load(path, sys._getframe(1).f_code.co_filename)
+
+        namespace = parser._make_namespace(NullSink().append)
+        active = self.get_active()
+        active.append(parser.input_filename)
+        try:
+            exec parser.code in namespace
+        finally:
+            active.pop()
+        namespace['_PRINT'] = print_func
+
+        module_name = os.path.splitext(os.path.basename(parser.code_filename))[0]
+        module = types.ModuleType(module_name)
+        module.__dict__.update(namespace)
+        return module
+
+
+# Returns {pypfile: [files it includes/imports directly]} for the given files and
+# everything they depend on
+def get_dependency_graph(pypfiles):
+    graph = {}
+    todo = list(pypfiles)
+    while todo:
+        pypfile = todo.pop()
+        if pypfile in graph:
+            continue
+        try:
+            with open(pypfile, 'r') as f:
+                graph[pypfile] = PYPParser(f.read(), input_filename=pypfile).get_dependencies()
+        except IOError:
+            # missing file, will fail when it's rendered
+            graph[pypfile] = []
+        todo.extend(graph[pypfile])
+    return graph
+
+# All the files a pyp file depends on (directly or not), in the order they're found
+def get_all_dependencies(graph, pypfile):
+    found = []
+    todo = list(graph.get(pypfile, []))
+    while todo:
+        dependency = todo.pop(0)
+        if dependency not in found and dependency != pypfile:
+            found.append(dependency)
+            todo.extend(graph.get(dependency, []))
+    return found
+
+
+class TemplateProfiler:
+    """
+    Profiles a render at the level of pyp source lines. While enabled, it traces the
+    template code (including included/imported files) with sys.settrace and maps every
+    generated Python line back through python_line_map. For each pyp line it collects
+    hits, self time (spent on the line itself, including any non-template code it calls)
+    and cumulative time (also counting template functions it calls); for each template
+    function (pypdef/def) calls, self and cumulative time.
+    """
+    def __init__(self, parser, timer=time.time):
+        self.parser = parser
+        self.timer = timer
+
+        self.line_stats = {}   # (pyp filename, linenum) -> [hits, self time, cumulative time]
+        self.func_stats = {}   # (pyp filename, linenum, name) -> [calls, self time, cumulative time]
+        self.total_time = 0.0
+
+        # One entry per active template frame:
+        # [parser, line key, line start time, call start time, time in template callees, func key]
+        self.stack = []
+        self.last_time = None
+        self._parsers = {}     # code filename -> parser (or None, if not template code)
+
+    def enable(self):
+        self.start_time = self.last_time = self.timer()
+        sys.settrace(self._trace_call)
+
+    def disable(self):
+        sys.settrace(None)
+        self.total_time += self.timer() - self.start_time
+
+    def _get_parser(self, filename):
+        if filename not in self._parsers:
+            self._parsers[filename] = self.parser._get_frame_parser(filename)
+        return self._parsers[filename]
+
+    # pyp line for a generated line; boilerplate lines count as the closest mapped line above
+    def _get_pyp_linenum(self, parser, python_linenum):
+        line_map = parser.python_line_map
+        python_linenum = min(python_linenum, len(line_map) - 1)
+        while python_linenum > 0:
+            if line_map[python_linenum]:
+                return line_map[python_linenum]
+            python_linenum -= 1
+        return None
+
+    # Self time since the last event goes to the current line of the innermost template frame
+    def _charge(self, now):
+        if self.stack and self.stack[-1][1]:
+            self.line_stats[self.stack[-1][1]][1] += now - self.last_time
+        self.last_time = now
+
+    # Cumulative time for the line the innermost frame is leaving (outermost instance only, for recursion)
+    def _end_line(self, entry, now):
+        if entry[1] and not [x for x in self.stack[:-1] if x[1] == entry[1]]:
+            self.line_stats[entry[1]][2] += now - entry[2]
+
+    def _trace_call(self, frame, event, arg):
+        if event != 'call':
+            return None
+        parser = self._get_parser(frame.f_code.co_filename)
+        if parser is None:
+            return None
+
+        now = self.timer()
+        self._charge(now)
+
+        func_key = None
+        code = frame.f_code
+        if code.co_name != '<module>':
+            func_key = (parser.input_filename, self._get_pyp_linenum(parser, code.co_firstlineno), code.co_name)
+            self.func_stats.setdefault(func_key, [0, 0.0, 0.0])[0] += 1
+
+        self.stack.append([parser, None, now, now, 0.0, func_key])
+        return self._trace_local
+
+    def _trace_local(self, frame, event, arg):
+        now = self.timer()
+        self._charge(now)
+        entry = self.stack[-1]
+
+        if event == 'line':
+            self._end_line(entry, now)
+            parser = entry[0]
+            key = (parser.input_filename, self._get_pyp_linenum(parser, frame.f_lineno))
+            self.line_stats.setdefault(key, [0, 0.0, 0.0])[0] += 1
+            entry[1] = key
+            entry[2] = now
+
+        elif event == 'return':
+            self._end_line(entry, now)
+            self.stack.pop()
+            elapsed = now - entry[3]
+            func_key = entry[5]
+            if func_key:
+                stats = self.func_stats[func_key]
+                stats[1] += elapsed - entry[4]
+                # (for recursive calls, only the outermost one counts towards cumulative time)
+                if not [x for x in self.stack if x[5] == func_key]:
+                    stats[2] += elapsed
+            if self.stack:
+                self.stack[-1][4] += elapsed
+
+        return self._trace_local
+
+    def _get_source_line(self, filename, linenum):
+        parser = self._get_parser(filename if filename != self.parser.input_filename
+                                  else self.parser.code_filename)
+        if parser is None or linenum is None:
+            return ""
+        source_lines = parser.get_source_lines()
+        if 0 < linenum <= len(source_lines):
+            return source_lines[linenum-1].strip()
+        return ""
+
+    # Profile results as plain data (for --profile-json), hottest lines/functions first
+    def get_results(self):
+        lines = []
+        for ((filename, linenum), (hits, self_time, cum_time)) in self.line_stats.items():
+            lines.append({'file': filename, 'line': linenum, 'hits': hits,
+                          'self_time': self_time, 'cumulative_time': cum_time,
+                          'source': self._get_source_line(filename, linenum)})
+        functions = []
+        for ((filename, linenum, name), (calls, self_time, cum_time)) in self.func_stats.items():
+            functions.append({'file': filename, 'line': linenum, 'name': name, 'calls': calls,
+                              'self_time': self_time, 'cumulative_time': cum_time})
+
+        lines.sort(key=lambda x: x['self_time'], reverse=True)
+        functions.sort(key=lambda x: x['cumulative_time'], reverse=True)
+        return {'file': self.parser.input_filename, 'total_time': self.total_time,
+                'lines': lines, 'functions': functions}
+
+    def report(self, stream, top=20):
+        results = self.get_results()
+        stream.write("\n======= PROFILE: %s (%.4fs total) =======\n" % (results['file'], results['total_time']))
+
+        stream.write("Hottest lines (by self time):\n")
+        stream.write("  %10s %10s %8s  %s\n" % ("self(s)", "cum(s)", "hits", "line"))
+        for x in results['lines'][:top]:
+            stream.write("  %10.4f %10.4f %8d  %s:%s  %s\n" % (x['self_time'], x['cumulative_time'], x['hits'],
+                                                           x['file'], x['line'], x['source']))
+
+        if results['functions']:
+            stream.write("\nFunctions (by cumulative time):\n")
+            stream.write("  %10s %10s %8s  %s\n" % ("self(s)", "cum(s)", "calls", "function"))
+            for x in results['functions'][:top]:
+                stream.write("  %10.4f %10.4f %8d  %s (%s:%s)\n" % (x['self_time'], x['cumulative_time'],
+                                                                x['calls'], x['name'], x['file'], x['line']))
+        stream.write("===================================\n")
+
+
+# Peak RSS of this process so far in KB, None where the resource module isn't available
+def get_peak_memory_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":   # (bytes there, KB elsewhere)
+        peak //= 1024
+    return peak
+
+
+class RenderStats:
+    """
+    What one compile (kind "compile") or one render (kind "render") of a template did, as
+    handed to a RenderObserver. phases has the wall time in seconds of each phase that ran:
+    "cache" (compile cache lookup), "parse" (tokenize and parse_lines), "codegen"
+    (get_python_text) and "compile" for a compile, "execute" for a render. A render's stats
+    also carry its template's line counts and compile cache result. Counts that aren't
+    known (like the output of a sink that doesn't count) are None.
+    """
+    def __init__(self, kind, filename=None, compile_stats=None):
+        self.kind = kind
+        self.filename = filename
+        self.success = None
+        self.phases = {}
+        (self.template_lines, self.python_lines, self.compile_cache) = (None, None, None)
+        if compile_stats is not None:
+            (self.template_lines, self.python_lines, self.compile_cache) = \
+                (compile_stats.template_lines, compile_stats.python_lines, compile_stats.compile_cache)
+        (self.output_lines, self.output_bytes) = (None, None)
+        (self.region_cache_hits, self.region_cache_misses) = (0, 0)
+        self.peak_memory_kb = None
+        self.start_time = None   # (of a render, while it runs)
+
+    def to_dict(self):
+        return {'kind': self.kind, 'file': self.filename, 'success': self.success, 'phases': self.phases,
+                'template_lines': self.template_lines, 'python_lines': self.python_lines,
+                'compile_cache': self.compile_cache, 'output_lines': self.output_lines,
+                'output_bytes': self.output_bytes, 'region_cache_hits': self.region_cache_hits,
+                'region_cache_misses': self.region_cache_misses, 'peak_memory_kb': self.peak_memory_kb}
+
+
+class RenderObserver:
+    """
+    Told about every compile and render of a template, for metrics: set one as a
+    PYPParser's observer (Template takes observer=). compiled(stats) and rendered(stats)
+    get a RenderStats each, in the thread that did the work, after it's done (also when it
+    failed). Gathering the stats takes a few clock reads and counters per compile/render,
+    nothing per output line, so it's cheap enough to leave on. Included and imported
+    templates count as part of the render that runs them.
+    """
+    def compiled(self, stats):
+        pass
+
+    def rendered(self, stats):
+        pass
+
+
+class StatsCollector(RenderObserver):
+    """
+    Adds up the stats of any number of compiles and renders: total time per phase, line,
+    byte and cache counts, and the highest peak memory. With keep_all, each one's stats
+    are kept too (as dicts). get_results() returns it all as plain data (for --stats-json),
+    report(stream) prints a summary, reset() starts over. Safe to share between threads.
+    """
+    PHASES = ['cache', 'parse', 'codegen', 'compile', 'execute']
+    COUNTS = ['template_lines', 'python_lines', 'output_lines', 'output_bytes',
+              'region_cache_hits', 'region_cache_misses']
+
+    def __init__(self, keep_all=False):
+        self.keep_all = keep_all
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        totals = {'compiles': 0, 'renders': 0, 'failed': 0, 'compile_cache_hits': 0,
+                  'compile_cache_misses': 0, 'peak_memory_kb': 0,
+                  'phases': dict((phase, 0.0) for phase in self.PHASES)}
+        for name in self.COUNTS:
+            totals[name] = 0
+        with self.lock:
+            (self.totals, self.entries) = (totals, [])
+
+    def compiled(self, stats):
+        self.add(stats)
+
+    def rendered(self, stats):
+        self.add(stats)
+
+    def add(self, stats):
+        totals = self.totals
+        with self.lock:
+            totals['compiles' if stats.kind == "compile" else 'renders'] += 1
+            if stats.success is False:
+                totals['failed'] += 1
+            for (phase, elapsed) in stats.phases.iteritems():
+                totals['phases'][phase] = totals['phases'].get(phase, 0.0) + elapsed
+            if stats.kind == "compile":
+                if stats.compile_cache == "hit":
+                    totals['compile_cache_hits'] += 1
+                elif stats.compile_cache == "miss":
+                    totals['compile_cache_misses'] += 1
+                counts = ('template_lines', 'python_lines')
+            else:
+                counts = ('output_lines', 'output_bytes', 'region_cache_hits', 'region_cache_misses')
+            for name in counts:
+                totals[name] += getattr(stats, name) or 0
+            if stats.peak_memory_kb is not None and stats.peak_memory_kb > totals['peak_memory_kb']:
+                totals['peak_memory_kb'] = stats.peak_memory_kb
+            if self.keep_all:
+                self.entries.append(stats.to_dict())
+
+    def get_results(self):
+        with self.lock:
+            results = {'totals': dict(self.totals, phases=dict(self.totals['phases']))}
+            if self.keep_all:
+                results['entries'] = list(self.entries)
+        return results
+
+    def report(self, stream):
+        totals = self.get_results()['totals']
+        stream.write("\n======= STATS =======\n")
+        stream.write("%d compiles (compile cache: %d hits, %d misses), %d renders (%d failed)\n" % (
+            totals['compiles'], totals['compile_cache_hits'], totals['compile_cache_misses'],
+            totals['renders'], totals['failed']))
+        stream.write("Time by phase:\n")
+        for phase in self.PHASES:
+            stream.write("  %-10s %10.2fms\n" % (phase, totals['phases'][phase] * 1000))
+        stream.write("Template lines: %d, generated Python lines: %d\n" % (totals['template_lines'],
+                                                                           totals['python_lines']))
+        stream.write("Output: %d lines, %d bytes\n" % (totals['output_lines'], totals['output_bytes']))
+        stream.write("Region cache: %d hits, %d misses\n" % (totals['region_cache_hits'],
+                                                              totals['region_cache_misses']))
+        if totals['peak_memory_kb']:
+            stream.write("Peak memory: %.1f MB\n" % (totals['peak_memory_kb'] / 1024.0))
+        stream.write("=====================\n")
+
+
+# Passes stats on from a worker process: keeps them until take() returns them (to be sent
+# back with the result, and handed to the real observer there)
+class _StatsRelay(RenderObserver):
+    def __init__(self):
+        self.stats = []
+
+    def compiled(self, stats):
+        self.stats.append(stats)
+
+    def rendered(self, stats):
+        self.stats.append(stats)
+
+    def take(self):
+        (stats, self.stats) = (self.stats, [])
+        return stats
+
+# Hands stats from _StatsRelay.take() to observer
+def _replay_stats(observer, stats_list):
+    for stats in stats_list:
+        if stats.kind == "compile":
+            observer.compiled(stats)
+        else:
+            observer.rendered(stats)
+
+
+class Template:
+    """
+    A compiled template, for rendering the same pyp source many times from Python code.
+
+        template = Template(filename="report.txt.pyp")
+        text = template.render(rows=rows)
+
+    The source is parsed and compiled once, here. Keyword arguments to the render methods
+    become globals in the template. Errors are raised as TemplateErrors (ParseError,
+    TemplateSyntaxError, TemplateRuntimeError) carrying the pyp filename and line number.
+    An observer (see RenderObserver) is told about the compile and every render.
+    """
+    async_mode = False
+
+    def __init__(self, text=None, filename=None, cache=None, region_cache=None, observer=None):
+        if text is None:
+            with open(filename, 'r') as f:
+                text = f.read()
+        if cache is None:
+            cache = default_compile_cache
+        if region_cache is None:
+            region_cache = default_region_cache
+
+        self.filename = filename
+        self.parser = PYPParser(text, input_filename=filename, cache=cache, region_cache=region_cache,
+                                async_mode=self.async_mode)
+        self.parser.observer = observer
+        self.code = self.parser.compile_template()
+
+        # Every pyp file this one includes/imports, directly or not
+        direct_dependencies = self.parser.get_dependencies()
+        graph = get_dependency_graph(direct_dependencies)
+        graph[filename] = direct_dependencies
+        self.dependencies = get_all_dependencies(graph, filename)
+
+    # Returns the output as a string
+    def render(self, **context):
+        sink = ListSink()
+        self.parser.run_code(self.code, sink, context)
+        return sink.getvalue()
+
+    # Writes the output to out, either a file-like object or an OutputSink. OutputSinks
+    # are closed afterwards (with success=False if the render failed), streams just flushed.
+    def render_to(self, out, **context):
+        if isinstance(out, OutputSink):
+            sink = out
+        else:
+            sink = StreamSink(out)
+
+        try:
+            self.parser.run_code(self.code, sink, context)
+            sink.close(True)
         except:
-            exc_type, exc_value, tb = sys.exc_info()
+            exc_info = sys.exc_info()
+            close_failed_sink(sink)
+            raise exc_info[0], exc_info[1], exc_info[2]
 
-            tb_packets = traceback.extract_tb(tb)
-            (filename, error_linenum, func, text) = tb_packets[-1]
+    # Yields the output in chunks, see PYPParser.render_iter
+    def render_iter(self, **context):
+        return self.parser.iter_code(self.code, context)
 
-            #traceback.print_exc()
 
-            print
-            print "======= ERROR INFO ================"
-            #exception_text = traceback.format_exception_only(exc_type, exc_value)
-            #print exception_text[0]
+class AsyncTemplate(Template):
+    """
+    A template compiled as a coroutine, so it can await: "${await expr}", "% x = await expr"
+    and "% async for item in source:" at its top level. render_async(writer, **context)
+    returns a coroutine (a generator yielding what the template awaits) to run on an event
+    loop, which sends the output to writer.write() in chunks (see PYPParser.render_async).
+    The synchronous render methods aren't available.
+    """
+    async_mode = True
 
+    def render_async(self, writer, **context):
+        return self.parser.render_async(self.code, writer, context)
 
+    def render(self, **context):
+        raise TypeError("AsyncTemplate can only be rendered with render_async()")
 
-            (source_linenum, line_text) = self._get_pyp_errorline(error_linenum)
-            if source_linenum != None:
-                print 'File "%s", line %d' % (self.input_filename, source_linenum)
-                print "  %s" % (line_text)
+    render_to = render_iter = render
 
-            else:
-                print "Sorry, could not find pyp source line"
-                print "".join(traceback.format_list([tb_packets[-1]]))
-                #print "Python error --> %s on line: %d (%s)" % (os.path.abspath(pyfile.name), error_linenum, text)
-
-            print "%s: %s" % (exc_type.__name__, exc_value)
-
-
-            if self.debug:
-                print
-                print "TRACEBACK:"
-                sys.stdout.write( "".join(traceback.format_list(tb_packets[3:])))
-
-                print
-                print "PYP TRACEBACK:"
-                for tb_packet in tb_packets[3:]:
-                    linenum = tb_packet[1]
-                    (source_linenum, line_text) = self._get_pyp_errorline(linenum)
-                    if (source_linenum != None):
-                        print '  File "%s", line %d' % (self.input_filename, source_linenum)
-                        print "    %s" % (line_text)
-                    else:
-                        print "(Unknown pyp line)"
 
-            print "==================================="
+# Shared by Template objects unless they're given their own
+default_compile_cache = CompileCache()
+default_region_cache = MemoryRegionCache()
 
-        output.close()
-        if output_filename:
-            if success:
-                os.rename(temp_outputname, output_filename)
-            else:
-                os.remove(temp_outputname)
 
-    def gen_python_script(self):
+PYP_SUFFIX = ".pyp"
+
+# Source of a module made by "pyp.py compile". Has no dependency on pyp.py itself.
+MODULE_TEMPLATE = '''\
+# Generated by pyp.py {version} from {filename}, don't edit.
+# To regenerate: pyp.py compile {filename}
+"""
+Precompiled pyp template. Use:
+
+    render(out, **context)
+
+out is anything with a write method, context keyword arguments become template globals.
+"""
+import sys
+import traceback
+
+PYP_VERSION = "{version}"
+SOURCE_FILENAME = {filename_repr}
+
+# Generated Python line number -> pyp source line number
+PYTHON_LINE_MAP = {line_map}
+
+# The pyp source, for error messages
+SOURCE_LINES = {source_lines}
+
+PYTHON_SOURCE = {python_source}
+
+_CODE = compile(PYTHON_SOURCE, SOURCE_FILENAME, 'exec')
+
+FLUSH_LINES = 512
+
+
+# The template raised an exception. filename/linenum/line point at the pyp source (linenum
+# is None if it can't be found), the original exception is in exc_type/exc_value/exc_traceback.
+class RenderError(Exception):
+    def __init__(self, text, line, linenum, exc_info):
+        Exception.__init__(self, text)
+        (self.text, self.line, self.linenum, self.filename) = (text, line, linenum, SOURCE_FILENAME)
+        (self.exc_type, self.exc_value, self.exc_traceback) = exc_info
+
+    def __str__(self):
+        if self.linenum is None:
+            return self.text
+        return 'File "%s", line %d\\nLine: %s\\n%s' % (self.filename, self.linenum, self.line, self.text)
+
+
+# Pypdefs and calls of them alone on a line (the same as in pyp_runtime)
+def _pypdef(write):
+    def func(*args, **kwargs):
+        output = []
+        result = write(output, *args, **kwargs)
+        if result is None:
+            return '\\n'.join(output)
+        return result
+    func.__name__ = write.__name__
+    func.__doc__ = write.__doc__
+    func._pyp_write = write
+    return func
+
+def _value_writer(func):
+    def write(output, *args, **kwargs):
+        output.append('%s' % (func(*args, **kwargs),))
+    return write
+
+def _print_call(_pyp_print_func, _pyp_func, *args, **kwargs):
+    write = getattr(_pyp_func, '_pyp_write', None)
+    if write is None:
+        _pyp_print_func('%s' % (_pyp_func(*args, **kwargs),))
+        return
+    output = []
+    result = write(output, *args, **kwargs)
+    if result is not None:
+        _pyp_print_func('%s' % (result,))
+        return
+    for line in output:
+        _pyp_print_func(line)
+
+def _print_run(print_func, format_string, values):
+    try:
+        text = format_string % values
+    except UnicodeDecodeError:
+        start = 0
+        for line_format in format_string.split("\\n"):
+            count = line_format.replace("%%", "").count("%s")
+            print_func(line_format % values[start:start+count])
+            start += count
+        return
+    print_func(text)
+
+
+def _get_pyp_errorline(tb):
+    packets = [x for x in traceback.extract_tb(tb) if x[0] == SOURCE_FILENAME]
+    if packets and packets[-1][1] in PYTHON_LINE_MAP:
+        linenum = PYTHON_LINE_MAP[packets[-1][1]]
+        return (linenum, SOURCE_LINES[linenum-1])
+    return (None, None)
+
+
+def render(out, **context):
+    buf = []
+    # (unicode lines are encoded as they come in, output to sys.stdout isn't buffered so it
+    # stays in order with print statements in the template)
+    encoding = getattr(out, 'encoding', None) or sys.getdefaultencoding()
+    flush_lines = 1 if out is sys.stdout else FLUSH_LINES
+
+    def _PRINT(line):
+        if isinstance(line, unicode):
+            line = line.encode(encoding)
+        buf.append(line)
+        if len(buf) >= flush_lines:
+            flush()
+
+    def flush():
+        if buf:
+            buf.append("")
+            out.write("\\n".join(buf))
+            del buf[:]
+
+    namespace = dict(context)
+    namespace.update({{
+        '__name__': '__main__',
+        '__file__': SOURCE_FILENAME,
+        '_PRINT': _PRINT,
+        '_PYP_PYPDEF': _pypdef,
+        '_PYP_VALUE_WRITER': _value_writer,
+        '_PYP_PRINT_CALL': _print_call,
+        '_PYP_PRINT_RUN': _print_run,
+        }})
+    try:
+        exec _CODE in namespace
+    except:
+        (exc_type, exc_value, tb) = sys.exc_info()
+        (linenum, line) = _get_pyp_errorline(tb)
+        raise RenderError("%s: %s" % (exc_type.__name__, exc_value), line, linenum,
+                          (exc_type, exc_value, tb)), None, tb
+    flush()
+'''
+
+# somefile.txt.pyp -> somefile_txt.py, something importable
+def get_module_filename(pypfile, outdir=None):
+    name = os.path.basename(pypfile)
+    if name.endswith(PYP_SUFFIX):
+        name = name[:-len(PYP_SUFFIX)]
+    name = re.sub(r"\W", "_", name)
+    if name[:1].isdigit():
+        name = "_" + name
+    return os.path.join(outdir or os.path.dirname(pypfile), name + ".py")
+
+# somefile.txt.pyp -> somefile.txt (in outdir, if given)
+def get_output_filename(pypfile, outdir=None):
+    output_filename = pypfile
+    if output_filename.endswith(PYP_SUFFIX):
+        output_filename = output_filename[:-len(PYP_SUFFIX)]
+    else:
+        output_filename += ".out"
+    if outdir:
+        output_filename = os.path.join(outdir, os.path.basename(output_filename))
+    return output_filename
+
+
+# Templates run from the command line see their file name and arguments in sys.argv.
+# Only the command line modes do this, rendering one template at a time; Template and
+# PYPParser never touch sys.argv (pass what a template needs as context instead).
+def set_template_argv(argv):
+    sys.argv = argv
+
+# Writes a make-style dependency file, output_filename.d, listing every file the output
+# depends on
+def write_depfile(output_filename, pypfile):
+    dependencies = get_all_dependencies(get_dependency_graph([pypfile]), pypfile)
+    with open(output_filename + ".d", 'w') as f:
+        f.write("%s: %s\n" % (output_filename, " ".join([pypfile] + dependencies)))
+        for dependency in dependencies:
+            f.write("%s:\n" % dependency)
+
+
+# -seed (left out if seed_help is None, for serve) and the compile cache options
+def add_common_arguments(parser, seed_help='Random seed value'):
+    if seed_help is not None:
+        parser.add_argument('-seed', '--seed', dest='seed', type=int, help=seed_help)
+    parser.add_argument('-cache-dir', '--cache-dir', dest='cache_dir', default=os.environ.get('PYP_CACHE_DIR'),
+                        help='Directory for compiled template cache (default: $PYP_CACHE_DIR)')
+    parser.add_argument('-nocache', '--no-cache', dest='nocache', action='store_true', default=False,
+                        help='Disable the compiled template cache')
+
+def add_output_arguments(parser):
+    parser.add_argument('-skip-unchanged', '--skip-unchanged', dest='skip_unchanged', action='store_true',
+                        default=False, help="Don't rewrite output files whose contents didn't change (keeps their mtime)")
+    parser.add_argument('-manifest', '--manifest', dest='manifest', metavar='FILE',
+                        help="Keep the outputs' hashes in FILE, so unchanged outputs needn't be read back "
+                             "to compare (implies --skip-unchanged)")
+
+def add_stats_arguments(parser):
+    parser.add_argument('-stats', '--stats', dest='stats', action='store_true', default=False,
+                        help='Print where the time went (per phase), line/byte/cache counts and peak memory to stderr')
+    parser.add_argument('-stats-json', '--stats-json', dest='stats_json', metavar='FILE',
+                        help='Write the same stats to FILE as JSON, with an entry per compile and render')
+
+# A StatsCollector for --stats/--stats-json, or None. Only --stats-json keeps the entries.
+def get_stats_collector(options):
+    if not (options.stats or options.stats_json):
+        return None
+    return StatsCollector(keep_all=bool(options.stats_json))
+
+def write_stats(collector, options):
+    if options.stats:
+        collector.report(sys.stderr)
+    if options.stats_json:
+        import json
+        with open(options.stats_json, 'w') as f:
+            json.dump(collector.get_results(), f, indent=2, sort_keys=True)
+
+# Output manifests (--manifest) are JSON, {output filename: [mtime, size, sha1]}, see
+# FileSink. A missing or unreadable one is just empty, it only saves reading files.
+def load_output_manifest(filename):
+    import json
+    try:
+        with open(filename, 'r') as f:
+            entries = _encode_strings(json.load(f), 'utf-8')
+    except (IOError, ValueError):
+        return {}
+    if not isinstance(entries, dict):
+        return {}
+    return dict((path, tuple(signature)) for (path, signature) in entries.iteritems())
+
+def save_output_manifest(filename, manifest):
+    import json
+    with open(filename + ".tmp", 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.rename(filename + ".tmp", filename)
+
+
+# Compile and region caches of the current build process (each pool worker gets its own,
+# they share compiled templates and cached regions through the cache dir), the output
+# manifest (each worker has a copy, the results bring the changes back), and a _StatsRelay
+# if stats are wanted (they go back with the results too)
+_build_cache = None
+_build_region_cache = None
+_build_skip_unchanged = False
+_build_manifest = None
+_build_stats_relay = None
+
+def _init_build_worker(cache_dir, nocache, skip_unchanged=False, manifest=None, collect_stats=False):
+    global _build_cache, _build_region_cache, _build_skip_unchanged, _build_manifest, _build_stats_relay
+    _build_cache = None
+    if not nocache:
+        _build_cache = CompileCache(cache_dir=cache_dir)
+    _build_region_cache = get_region_cache(cache_dir, nocache)
+    (_build_skip_unchanged, _build_manifest) = (skip_unchanged, manifest)
+    _build_stats_relay = _StatsRelay() if collect_stats else None
+
+
+# Renders one file for build mode. Error reports are captured rather than printed, so
+# that output from parallel workers doesn't get mixed up.
+# Returns (pypfile, output_filename, success, elapsed, report, changed, output signature,
+# [RenderStats])
+def build_file(task):
+    (pypfile, output_filename, seed, depfile) = task
+
+    start = time.time()
+    report = StringIO.StringIO()
+    (success, changed, signature) = (False, False, None)
+    try:
+        if seed != None:
+            import random
+            random.seed(seed)
+        set_template_argv([pypfile])
+
+        with open(pypfile, 'r') as inputfile:
+            text = inputfile.read()
+
+        pypparser = PYPParser(text, input_filename=pypfile, cache=_build_cache, region_cache=_build_region_cache)
+        pypparser.report_stream = report
+        pypparser.skip_unchanged = _build_skip_unchanged
+        pypparser.output_manifest = _build_manifest
+        pypparser.observer = _build_stats_relay
+        success = pypparser.execute(output_filename=output_filename)
+        (changed, signature) = (pypparser.output_changed, pypparser.output_signature)
+        if success and depfile:
+            write_depfile(output_filename, pypfile)
+    except SystemExit:
+        # parse error, already reported
         pass
+    except (IOError, OSError) as inst:
+        print >>report, "%s: %s" % (pypfile, inst)
 
-    def execute(self, output_filename=None, python_filename=None):
-        #for line in self.textlines:
-        lines = copy.copy(self.textlines)
+    stats = _build_stats_relay.take() if _build_stats_relay else []
+    return (pypfile, output_filename, success, time.time() - start, report.getvalue(), changed, signature, stats)
 
-        sequence = PythonSequence()
-        try:
-            sequence.parse_lines(lines)
-        except ParseError as inst:
-            print
-            print "====== PARSE ERROR ========="
-            print 'File "%s", line %d' % (self.input_filename, inst.linenum)
 
-            print "  %s" % inst.line
-            print "ParseError: %s" % inst.text
-            print "============================"
-            print
-            sys.exit(1)
+class PollWaiter:
+    """
+    Waits for files to change by just sleeping; the caller checks what actually changed.
+    """
+    def wait(self, dirs, timeout):
+        time.sleep(timeout)
 
-        self.python_line_map = sequence.python_line_map
+    def close(self):
+        pass
 
-        python_text = sequence.get_python_text()
-        if self.debug:
-            print "PYTHON CODE:"
-            print python_text
-            print
 
-        if self.debug:
-            print
-            print "EXECUTING PYTHON:"
-        self.write_and_execute_python_file(python_text,
-                                           filename=python_filename,
-                                           output_filename=output_filename)
+class InotifyWaiter:
+    """
+    Waits for changes in a set of directories with Linux inotify (through ctypes, there's
+    no binding in the standard library). Directories rather than files are watched, so
+    editors that save by writing a new file and renaming it are noticed. The events
+    themselves are thrown away; they only mean "something changed, go and check".
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    # Wait this long after an event for more to arrive, so one save = one re-render
+    SETTLE_TIME = 0.05
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError("inotify not available")
+
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.watched = set()
+
+    def _add_watch(self, path):
+        if path in self.watched:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, path, self.MASK)
+        if wd >= 0:
+            self.watched.add(path)
+
+    def _drain(self):
+        while select.select([self.fd], [], [], 0)[0]:
+            os.read(self.fd, 65536)
+
+    def wait(self, dirs, timeout):
+        for path in dirs:
+            self._add_watch(path)
+        if select.select([self.fd], [], [], timeout)[0]:
+            time.sleep(self.SETTLE_TIME)
+            self._drain()
+
+    def close(self):
+        os.close(self.fd)
+
+
+def get_file_waiter():
+    try:
+        return InotifyWaiter()
+    except (OSError, AttributeError):
+        return PollWaiter()
+
+
+class TemplateWatcher:
+    """
+    Keeps templates compiled in memory, and re-renders each one only when one of its
+    inputs changes: the pyp file itself, the files it includes/imports, or any of the
+    data_files given. Files are compared by mtime/size first, then by content hash, so
+    touching a file without changing it doesn't cause a re-render. A change to a pyp
+    file recompiles the template, a change to a data file just re-renders it.
+
+    With skip_unchanged, outputs that come out the same aren't rewritten (see FileSink);
+    the hashes are kept in the manifest file manifest_filename, if given. An observer (see
+    RenderObserver) is told about every compile and render.
+    """
+    def __init__(self, targets, cache=None, data_files=(), seed=None, pypfile_args=(), region_cache=None,
+                 skip_unchanged=False, manifest_filename=None, observer=None):
+        # targets: [(pypfile, output_filename)]
+        self.targets = targets
+        self.cache = cache
+        self.region_cache = region_cache
+        self.data_files = list(data_files)
+        self.seed = seed
+        self.pypfile_args = list(pypfile_args)
+        self.observer = observer
+
+        self.templates = {}        # pypfile -> Template, or None if it didn't compile
+        self.template_inputs = {}  # pypfile -> pyp files it's compiled from
+        self.signatures = {}       # path -> (mtime, size, sha1 of contents)
+
+        self.skip_unchanged = skip_unchanged or bool(manifest_filename)
+        self.manifest_filename = manifest_filename
+        self.manifest = None       # output filename -> signature, see FileSink
+        if manifest_filename:
+            self.manifest = load_output_manifest(manifest_filename)
+        elif skip_unchanged:
+            self.manifest = {}
+
+    # Re-stats the given files, returns the set of them whose contents changed
+    def _update_signatures(self, paths):
+        changed = set()
+        for path in paths:
+            old_signature = self.signatures.get(path)
+            signature = get_file_signature(path, old_signature)
+            if path not in self.signatures or \
+                    (signature and old_signature and signature[2] != old_signature[2]) or \
+                    (signature is None) != (old_signature is None):
+                changed.add(path)
+            self.signatures[path] = signature
+        return changed
+
+    def get_watch_dirs(self):
+        dirs = set()
+        for path in self.signatures:
+            dirs.add(os.path.dirname(os.path.abspath(path)))
+        return dirs
+
+    def _compile(self, pypfile):
+        self.templates[pypfile] = None
+        self.template_inputs[pypfile] = [pypfile]
+        try:
+            template = Template(filename=pypfile, cache=self.cache, region_cache=self.region_cache,
+                                observer=self.observer)
+        except (TemplateError, IOError) as inst:
+            self._report_error(pypfile, inst)
+            return
+        self.templates[pypfile] = template
+        self.template_inputs[pypfile] = [pypfile] + template.dependencies
+
+    def _render(self, pypfile, output_filename):
+        template = self.templates.get(pypfile)
+        if template is None:
+            return False
+
+        if self.seed != None:
+            import random
+            random.seed(self.seed)
+        set_template_argv([pypfile] + self.pypfile_args)
+
+        start = time.time()
+        try:
+            sink = FileSink(output_filename, skip_unchanged=self.skip_unchanged, manifest=self.manifest)
+            template.render_to(sink)
+        except (TemplateError, IOError) as inst:
+            self._report_error(pypfile, inst)
+            return False
+        print "Rendered %s -> %s (%.3fs%s)" % (pypfile, output_filename, time.time() - start,
+                                               "" if sink.changed else ", unchanged")
+        return True
+
+    def _report_error(self, pypfile, inst):
+        print
+        print "======= ERROR: %s =======" % (pypfile)
+        print inst
+        print "==================================="
+
+    # Renders every target whose inputs changed since the last call (all of them, the first
+    # time). Returns the number of templates rendered. The inputs of all the targets are
+    # checked together, once, so every target including a changed file sees the change.
+    def check(self):
+        paths = set(self.data_files)
+        for (pypfile, _) in self.targets:
+            paths.update(self.template_inputs.get(pypfile, [pypfile]))
+        changed = self._update_signatures(paths)
+        changed_data = changed.intersection(self.data_files)
+
+        num_rendered = 0
+        for (pypfile, output_filename) in self.targets:
+            if pypfile not in self.templates or changed.intersection(self.template_inputs[pypfile]):
+                self._compile(pypfile)
+                # (the inputs may be different now, start tracking any new ones)
+                self._update_signatures([x for x in self.template_inputs[pypfile] if x not in self.signatures])
+            elif not changed_data:
+                continue
+
+            self._render(pypfile, output_filename)
+            num_rendered += 1
+        if num_rendered and self.manifest_filename:
+            save_output_manifest(self.manifest_filename, self.manifest)
+        return num_rendered
+
+    # Checks for changes until interrupted. after_rebuild, if given, is called after each
+    # check that rendered something.
+    def run(self, interval=0.5, after_rebuild=None):
+        waiter = get_file_waiter()
+        print "Watching %d templates (%s), Ctrl-C to stop" % (len(self.targets),
+            "inotify" if isinstance(waiter, InotifyWaiter) else "polling every %.1fs" % interval)
+        try:
+            while True:
+                if self.check() and after_rebuild:
+                    after_rebuild()
+                sys.stdout.flush()
+                waiter.wait(self.get_watch_dirs(), interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            waiter.close()
+
+
+def add_watch_arguments(parser):
+    parser.add_argument('-watch', '--watch', dest='watch', action='store_true', default=False,
+                        help='Keep running, re-rendering templates when their inputs change')
+    parser.add_argument('-data', '--data', dest='data_files', action='append', default=[], metavar='FILE',
+                        help='With --watch, also re-render when this data file changes (can be repeated)')
+    parser.add_argument('-interval', '--interval', dest='interval', type=float, default=0.5,
+                        help='With --watch, seconds between checks when polling (default: 0.5)')
+
+# --stats/--stats-json are reported after every rebuild, for that rebuild alone
+def watch_main(targets, options, pypfile_args=()):
+    cache = None
+    if not options.nocache:
+        cache = CompileCache(cache_dir=options.cache_dir)
+    collector = get_stats_collector(options)
+    watcher = TemplateWatcher(targets, cache=cache, data_files=options.data_files, seed=options.seed,
+                              pypfile_args=pypfile_args,
+                              region_cache=get_region_cache(options.cache_dir, options.nocache),
+                              skip_unchanged=options.skip_unchanged, manifest_filename=options.manifest,
+                              observer=collector)
+
+    def report_stats():
+        write_stats(collector, options)
+        collector.reset()
+    watcher.run(interval=options.interval, after_rebuild=report_stats if collector else None)
+
+
+def build_main(args):
+    import multiprocessing
+    from argparse import ArgumentParser
+    parser = ArgumentParser(prog="pyp.py build", description="Render many pyp files in one go")
+
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-outdir', '--outdir', dest='outdir',
+                        help='Output directory (default: next to each pyp file)')
+    add_common_arguments(parser, seed_help='Random seed value, for each file')
+    parser.add_argument('-deps', '--deps', dest='deps', action='store_true', default=False,
+                        help='Also write a make-style dependency file (OUTPUT.d) for each output')
+    add_output_arguments(parser)
+    add_stats_arguments(parser)
+    add_watch_arguments(parser)
+    parser.add_argument('pypfiles', nargs='+', help='pyp files to render')
+
+    options = parser.parse_args(args)
+
+    if options.outdir and not os.path.isdir(options.outdir):
+        os.makedirs(options.outdir)
+
+    if options.watch:
+        targets = [(pypfile, get_output_filename(pypfile, options.outdir)) for pypfile in options.pypfiles]
+        return watch_main(targets, options)
+
+    tasks = [(pypfile, get_output_filename(pypfile, options.outdir), options.seed, options.deps)
+             for pypfile in options.pypfiles]
+
+    manifest = load_output_manifest(options.manifest) if options.manifest else None
+    collector = get_stats_collector(options)
+    init_args = (options.cache_dir, options.nocache, options.skip_unchanged, manifest, collector is not None)
+
+    start = time.time()
+    jobs = max(1, min(options.jobs, len(tasks)))
+    if jobs == 1:
+        _init_build_worker(*init_args)
+        results = itertools.imap(build_file, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs, _init_build_worker, init_args)
+        results = pool.imap(build_file, tasks)
+
+    (num_failed, num_written) = (0, 0)
+    render_time = 0
+    for (pypfile, output_filename, success, elapsed, report, changed, signature, stats) in results:
+        render_time += elapsed
+        if report:
+            sys.stdout.write(report)
+        if not success:
+            num_failed += 1
+            print "FAILED: %s" % (pypfile)
+        if changed:
+            num_written += 1
+        if manifest is not None and signature:
+            manifest[output_filename] = signature
+        if collector:
+            _replay_stats(collector, stats)
+
+    if jobs > 1:
+        pool.close()
+        pool.join()
+    if options.manifest:
+        save_output_manifest(options.manifest, manifest)
+
+    if options.skip_unchanged or options.manifest:
+        print "Built %d of %d files (%d failed, %d written, %d unchanged) in %.2fs, %.2fs total render time, %d jobs" % (
+            len(tasks) - num_failed, len(tasks), num_failed, num_written, len(tasks) - num_failed - num_written,
+            time.time() - start, render_time, jobs)
+    else:
+        print "Built %d of %d files (%d failed) in %.2fs, %.2fs total render time, %d jobs" % (
+            len(tasks) - num_failed, len(tasks), num_failed, time.time() - start, render_time, jobs)
+    if collector:
+        write_stats(collector, options)
+
+    if num_failed:
+        sys.exit(1)
+
+
+def compile_main(args):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(prog="pyp.py compile",
+                            description="Compile pyp files to importable Python modules, with a render(out, **context) function")
+
+    parser.add_argument('-o','-output','--output', dest='output_filename',
+                        help='Output module file (only with one pyp file; default: somefile_txt.py for somefile.txt.pyp)')
+    parser.add_argument('-outdir', '--outdir', dest='outdir', help='Output directory (default: next to each pyp file)')
+    parser.add_argument('pypfiles', nargs='+', help='pyp files to compile')
+
+    options = parser.parse_args(args)
+
+    if options.output_filename and len(options.pypfiles) > 1:
+        parser.error("-o can only be used with one pyp file")
+    if options.outdir and not os.path.isdir(options.outdir):
+        os.makedirs(options.outdir)
+
+    num_failed = 0
+    for pypfile in options.pypfiles:
+        with open(pypfile, 'r') as inputfile:
+            text = inputfile.read()
+
+        pypparser = PYPParser(text, input_filename=pypfile)
+        try:
+            module_text = pypparser.gen_python_module()
+        except ParseError as inst:
+            pypparser._report_parse_error(inst)
+            num_failed += 1
+            continue
+        except SyntaxError:
+            exc_type, exc_value, tb = sys.exc_info()
+            pypparser._report_syntax_error(exc_type, exc_value)
+            num_failed += 1
+            continue
+
+        output_filename = options.output_filename or get_module_filename(pypfile, options.outdir)
+        with open(output_filename + ".tmp", 'w') as f:
+            f.write(module_text)
+        os.rename(output_filename + ".tmp", output_filename)
+
+    if num_failed:
+        sys.exit(1)
+
+
+# Record fan-out ("pyp.py records", render_records): one template rendered once per record
+# of a JSON-lines or CSV data set, each record to its own output file
+
+RECORD_FORMATS = ('jsonl', 'csv')
+
+# The record format for a data file, from its extension (anything but .csv is JSON lines)
+def guess_record_format(filename):
+    if filename and filename.lower().endswith(".csv"):
+        return 'csv'
+    return 'jsonl'
+
+# Yields the records in stream one at a time, as dicts: for "jsonl", one JSON object per
+# line (blank lines are skipped, strings become UTF-8 encoded byte strings); for "csv", the
+# rows, keyed by the header row. Raises ValueError for a line that isn't a JSON object.
+def read_records(stream, format='jsonl'):
+    if format == 'csv':
+        import csv
+        for row in csv.DictReader(stream):
+            yield row
+        return
+    if format != 'jsonl':
+        raise ValueError("unknown record format '%s'" % format)
+
+    import json
+    for (linenum, line) in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as inst:
+            raise ValueError("line %d: %s" % (linenum, inst))
+        if not isinstance(record, dict):
+            raise ValueError("line %d: not a JSON object" % linenum)
+        yield _encode_strings(record, 'utf-8')
+
+# What the template (and the output filename pattern) sees for a record: its fields, plus
+# record (the whole dict) and record_number (counting from 1), unless it has fields of
+# those names
+def get_record_context(record, number):
+    context = dict(record)
+    context.setdefault('record', record)
+    context.setdefault('record_number', number)
+    return context
+
+# The output filename for a record: the pattern, str.format()ted with its context
+# ("out/{id}.html", "{record_number:06d}.txt"). Raises ValueError if that fails.
+def get_record_output_filename(pattern, context):
+    try:
+        return pattern.format(**context)
+    except (KeyError, IndexError, AttributeError) as inst:
+        raise ValueError("can't make the output filename from '%s': no field %s" % (pattern, inst))
+
+
+# The template, filename pattern and seed of the current records process. render_records
+# compiles the template before starting the pool, so forked workers inherit it compiled.
+_records_template = None
+_records_output_pattern = None
+_records_seed = None
+
+def _init_records_worker(pypfile, output_pattern, seed, cache_dir, nocache, skip_unchanged=False, manifest=None,
+                         collect_stats=False):
+    global _records_template, _records_output_pattern, _records_seed
+    _init_build_worker(cache_dir, nocache, skip_unchanged, manifest, collect_stats)
+    _records_template = Template(filename=pypfile, cache=_build_cache, region_cache=_build_region_cache,
+                                 observer=_build_stats_relay)
+    (_records_output_pattern, _records_seed) = (output_pattern, seed)
+
+# Pool initializer: a worker forked from render_records already has everything set up, with
+# the same arguments, and only one started some other way (no fork) compiles the template
+def _init_records_pool_worker(*init_args):
+    if _records_template is None:
+        _init_records_worker(*init_args)
+
+# Renders one record, task is (record number, record).
+# Returns (record number, output_filename, success, error text, changed, output signature,
+# [RenderStats])
+def render_record(task):
+    (number, record) = task
+    output_filename = None
+    try:
+        context = get_record_context(record, number)
+        output_filename = get_record_output_filename(_records_output_pattern, context)
+        output_dir = os.path.dirname(output_filename)
+        if output_dir and not os.path.isdir(output_dir):
+            try:
+                os.makedirs(output_dir)
+            except OSError:
+                if not os.path.isdir(output_dir):   # (or another worker just made it)
+                    raise
+        if _records_seed != None:
+            import random
+            random.seed(_records_seed)
+        sink = FileSink(output_filename, skip_unchanged=_build_skip_unchanged, manifest=_build_manifest)
+        _records_template.render_to(sink, **context)
+    except (TemplateError, ValueError, IOError, OSError) as inst:
+        return (number, output_filename, False, str(inst), False, None, _take_stats())
+    return (number, output_filename, True, "", sink.changed, sink.signature, _take_stats())
+
+def _take_stats():
+    return _build_stats_relay.take() if _build_stats_relay else []
+
+
+class _RecordFeeder:
+    """
+    Numbers the records for the worker pool, reading them only as fast as results come
+    back: the pool's task thread pulls from this, and blocks once max_in_flight records
+    are out; done() is called for each result. A read error ends the records, it's kept
+    in error.
+    """
+    def __init__(self, records, max_in_flight):
+        self.records = records
+        self.slots = threading.Semaphore(max_in_flight)
+        self.stopped = False
+        self.error = None
+
+    def __iter__(self):
+        try:
+            for (number, record) in enumerate(self.records, 1):
+                self.slots.acquire()
+                if self.stopped:
+                    return
+                yield (number, record)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def done(self):
+        self.slots.release()
+
+    def stop(self):
+        self.stopped = True
+        self.slots.release()
+
+# Renders pypfile once per record (dicts, read lazily from any iterable, see read_records),
+# each to the file output_pattern makes for it (see get_record_output_filename). The work is
+# spread over jobs worker processes (default: number of CPUs), with at most max_in_flight
+# records (default: 64 per job) read but not yet done, so memory stays flat however many
+# records there are. skip_unchanged and manifest are as for FileSink; the manifest is
+# updated here as the results come in, and observer (a RenderObserver) is told about every
+# compile and render, whichever process did it. The template is compiled here first:
+# errors in it are raised as TemplateErrors. Returns an iterator of (record number, output_filename,
+# success, error text, changed), in the order the records finish. Errors reading the
+# records are raised from it, after the records read so far are done.
+def render_records(pypfile, records, output_pattern, jobs=None, max_in_flight=None, seed=None,
+                   cache_dir=None, nocache=False, skip_unchanged=False, manifest=None, observer=None):
+    import multiprocessing
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 64 * jobs
+    jobs = max(1, jobs)
+    max_in_flight = max(jobs, max_in_flight)
+
+    init_args = (pypfile, output_pattern, seed, cache_dir, nocache, skip_unchanged, manifest, observer is not None)
+    _init_records_worker(*init_args)   # (compile errors show up here, workers inherit the result)
+    if observer is not None:
+        _replay_stats(observer, _take_stats())
+    if jobs == 1:
+        results = itertools.imap(render_record, enumerate(records, 1))
+    else:
+        results = _render_records_pool(records, init_args, jobs, max_in_flight)
+    return _collect_record_results(results, manifest, observer)
+
+def _collect_record_results(results, manifest, observer):
+    for (number, output_filename, success, error, changed, signature, stats) in results:
+        if manifest is not None and signature:
+            manifest[output_filename] = signature
+        if observer is not None:
+            _replay_stats(observer, stats)
+        yield (number, output_filename, success, error, changed)
+
+def _render_records_pool(records, init_args, jobs, max_in_flight):
+    import multiprocessing
+    feeder = _RecordFeeder(records, max_in_flight)
+    # (records go out in chunks, a whole chunk has to fit in flight)
+    chunksize = max(1, min(16, max_in_flight // (4 * jobs)))
+    pool = multiprocessing.Pool(jobs, _init_records_pool_worker, init_args)
+    try:
+        for result in pool.imap_unordered(render_record, feeder, chunksize):
+            feeder.done()
+            yield result
+    except:
+        feeder.stop()
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    if feeder.error:
+        raise feeder.error[0], feeder.error[1], feeder.error[2]
+
+
+def records_main(args):
+    import multiprocessing
+    from argparse import ArgumentParser
+    parser = ArgumentParser(prog="pyp.py records",
+                            description="Render a pyp file once per record of a JSON-lines or CSV file, "
+                                        "each record to its own output file")
+
+    parser.add_argument('-o', '-output', '--output', dest='output_pattern', required=True,
+                        help='Output filename pattern, formatted with each record\'s fields and record_number '
+                             '(like "out/{id}.html")')
+    parser.add_argument('-format', '--format', dest='format', choices=RECORD_FORMATS,
+                        help='Format of the records (default: csv for .csv files, otherwise jsonl)')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of worker processes (default: number of CPUs)')
+    parser.add_argument('-max-in-flight', '--max-in-flight', dest='max_in_flight', type=int,
+                        help='Records read ahead of the ones done, at most (default: 64 per job)')
+    add_common_arguments(parser, seed_help='Random seed value, for each record')
+    add_output_arguments(parser)
+    add_stats_arguments(parser)
+    parser.add_argument('pypfile', help='pyp file to render')
+    parser.add_argument('records', nargs='?', default='-',
+                        help='JSON-lines or CSV file with the records (default: - for stdin)')
+
+    options = parser.parse_args(args)
+
+    record_format = options.format or guess_record_format(options.records)
+    if options.records == '-':
+        records_file = sys.stdin
+    else:
+        records_file = open(options.records, 'r')
+
+    manifest = load_output_manifest(options.manifest) if options.manifest else None
+    collector = get_stats_collector(options)
+
+    start = time.time()
+    set_template_argv([options.pypfile])   # (the workers get it too)
+    try:
+        results = render_records(options.pypfile, read_records(records_file, record_format),
+                                 options.output_pattern, jobs=options.jobs, max_in_flight=options.max_in_flight,
+                                 seed=options.seed, cache_dir=options.cache_dir, nocache=options.nocache,
+                                 skip_unchanged=options.skip_unchanged, manifest=manifest, observer=collector)
+    except TemplateError as inst:
+        print >>sys.stderr, inst
+        sys.exit(1)
+
+    (num_records, num_failed, num_written) = (0, 0, 0)
+    try:
+        for (number, output_filename, success, error, changed) in results:
+            num_records += 1
+            if not success:
+                num_failed += 1
+                print "FAILED: record %d (%s)" % (number, output_filename or "no output file")
+                print error
+            if changed:
+                num_written += 1
+    except ValueError as inst:
+        print >>sys.stderr, "pyp.py records: %s: %s" % (options.records, inst)
+        sys.exit(2)
+    finally:
+        if options.manifest:
+            save_output_manifest(options.manifest, manifest)
+
+    if options.skip_unchanged or options.manifest:
+        print "Rendered %d of %d records (%d failed, %d written, %d unchanged) in %.2fs, %d jobs" % (
+            num_records - num_failed, num_records, num_failed, num_written, num_records - num_failed - num_written,
+            time.time() - start, max(1, options.jobs))
+    else:
+        print "Rendered %d of %d records (%d failed) in %.2fs, %d jobs" % (
+            num_records - num_failed, num_records, num_failed, time.time() - start, max(1, options.jobs))
+    if collector:
+        write_stats(collector, options)
+
+    if num_failed:
+        sys.exit(1)
+
+
+class RenderServer:
+    """
+    Renders pyp files for "pyp.py serve", keeping the compile and region caches (and
+    imported Python modules) warm between requests. A request is a dict with the pyp file,
+    its arguments and output file, and the client's directory; the response has the exit
+    status and the stdout/stderr text that pyp.py itself would have given.
+
+    Requests are handled one at a time: like the command line, a render sets sys.argv and
+    the random seed, and runs in the client's directory with sys.stdout and sys.stderr
+    captured.
+    """
+    def __init__(self, cache_dir=None, nocache=False):
+        self.cache = None
+        if not nocache:
+            self.cache = CompileCache(cache_dir=cache_dir)
+        self.region_cache = get_region_cache(cache_dir, nocache)
+        self.stopped = False
+        self.num_requests = 0
+
+    # Takes and returns one line of the JSON-lines protocol. Strings both ways are bytes
+    # decoded as latin-1 (and encoded back at the other end), so any bytes get through
+    # unchanged.
+    def handle_line(self, line):
+        import json
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("not a JSON object")
+            request = _encode_strings(request, 'latin-1')
+        except ValueError as inst:
+            response = {'status': 2, 'stdout': "", 'stderr': "pyp.py serve: bad request: %s\n" % inst}
+        else:
+            response = self.handle(request)
+        return json.dumps(response) + "\n"
+
+    # Returns the response dict for a request. Never raises: whatever goes wrong is reported
+    # in the response, so one request can't take the server down.
+    def handle(self, request):
+        try:
+            return self._handle(request)
+        except Exception:
+            return {'status': 2, 'stdout': u"",
+                    'stderr': _latin1_text("pyp.py serve: internal error\n" + traceback.format_exc())}
+
+    def _handle(self, request):
+        self.num_requests += 1
+        if request.get('stop'):
+            self.stopped = True
+            return {'status': 0, 'stdout': "", 'stderr': ""}
+
+        (real_stdout, real_stderr, real_cwd) = (sys.stdout, sys.stderr, os.getcwd())
+        sys.stdout = out = _CapturedOutput()
+        sys.stderr = err = _CapturedOutput()
+        (status, error) = (0, "")
+        try:
+            os.chdir(request.get('cwd') or real_cwd)
+            self.render(request)
+        except SystemExit as inst:
+            # parse error, already reported
+            status = inst.code if isinstance(inst.code, int) else 1
+        except (IOError, OSError) as inst:
+            (status, error) = (1, "%s: %s\n" % (type(inst).__name__, inst))
+        except Exception:
+            (status, error) = (1, traceback.format_exc())
+        finally:
+            (sys.stdout, sys.stderr) = (real_stdout, real_stderr)
+            os.chdir(real_cwd)
+
+        return {'status': status, 'stdout': _latin1_text(out.getvalue()),
+                'stderr': _latin1_text(err.getvalue()) + _latin1_text(error)}
+
+    # Renders like main() does for a single file. The request's keys are main()'s option
+    # names; the reports of --profile and --stats go to sys.stderr, captured by handle().
+    def render(self, request):
+        import argparse
+        options = argparse.Namespace(stats=request.get('stats'), stats_json=request.get('stats_json'))
+
+        pypfile = request['pypfile']
+        if request.get('seed') != None:
+            import random
+            random.seed(request['seed'])
+        set_template_argv([pypfile] + list(request.get('args') or []))
+
+        with open(pypfile, 'r') as inputfile:
+            text = inputfile.read()
+
+        pypparser = PYPParser(text, debug=bool(request.get('debug')), input_filename=pypfile, cache=self.cache,
+                              region_cache=self.region_cache)
+        if request.get('profile') or request.get('profile_json'):
+            pypparser.profiler = TemplateProfiler(pypparser)
+        pypparser.skip_unchanged = bool(request.get('skip_unchanged'))
+        if request.get('manifest'):
+            pypparser.output_manifest = load_output_manifest(request['manifest'])
+        collector = get_stats_collector(options)
+        pypparser.observer = collector
+
+        success = pypparser.execute(output_filename=request.get('output'), python_filename=request.get('python'))
+        if success and request.get('manifest'):
+            save_output_manifest(request['manifest'], pypparser.output_manifest)
+        if success and request.get('deps'):
+            write_depfile(request['output'], pypfile)
+
+        if request.get('profile'):
+            pypparser.profiler.report(sys.stderr, top=request.get('profile_top') or 20)
+        if request.get('profile_json'):
+            import json
+            with open(request['profile_json'], 'w') as f:
+                json.dump(pypparser.profiler.get_results(), f, indent=2)
+        if collector:
+            write_stats(collector, options)
+
+
+# sys.stdout/stderr while the server renders. It keeps bytes only: like a real file, it
+# encodes unicode writes with the default encoding (so a template that can't print to a
+# file fails the same way here, with a runtime error report).
+class _CapturedOutput(StringIO.StringIO):
+    def write(self, s):
+        if isinstance(s, unicode):
+            s = s.encode(sys.getdefaultencoding())
+        StringIO.StringIO.write(self, s)
+
+# Text for a JSON response: byte strings are decoded as latin-1 (see handle_line)
+def _latin1_text(s):
+    if isinstance(s, unicode):
+        return s
+    return s.decode('latin-1')
+
+# Turns the unicode strings in decoded JSON into byte strings
+def _encode_strings(value, encoding):
+    if isinstance(value, unicode):
+        return value.encode(encoding)
+    if isinstance(value, list):
+        return [_encode_strings(x, encoding) for x in value]
+    if isinstance(value, dict):
+        return dict((_encode_strings(key, encoding), _encode_strings(x, encoding)) for (key, x) in value.iteritems())
+    return value
+
+def _socket_in_use(path):
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+    return True
+
+def serve_socket(render_server, path):
+    if os.path.exists(path):
+        if _socket_in_use(path):
+            raise IOError("%s: a server is already listening there" % path)
+        os.remove(path)   # left over from a server that didn't shut down cleanly
+
+    import socket
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        listener.bind(path)
+        listener.listen(64)
+        # one request per connection
+        while not render_server.stopped:
+            (conn, _) = listener.accept()
+            try:
+                line = conn.makefile('rb').readline()
+                if line:
+                    conn.sendall(render_server.handle_line(line))
+            except socket.error:
+                pass   # the client went away
+            finally:
+                conn.close()
+    finally:
+        listener.close()
+        if os.path.exists(path):
+            os.remove(path)
+
+def serve_stdio(render_server, instream, outstream):
+    while not render_server.stopped:
+        line = instream.readline()
+        if not line:
+            break
+        if line.strip():
+            outstream.write(render_server.handle_line(line))
+            outstream.flush()
+
+def serve_main(args):
+    from argparse import ArgumentParser
+    parser = ArgumentParser(prog="pyp.py serve",
+                            description="Render pyp files for \"pyp.py client\" (or any JSON-lines client), "
+                                        "keeping compiled templates warm between requests")
+    parser.add_argument('-socket', '--socket', dest='socket', default=os.environ.get('PYP_SOCKET'),
+                        help='Unix domain socket to listen on (default: $PYP_SOCKET)')
+    parser.add_argument('-stdio', '--stdio', dest='stdio', action='store_true', default=False,
+                        help='Read requests from stdin and write responses to stdout instead')
+    add_common_arguments(parser, seed_help=None)
+
+    options = parser.parse_args(args)
+    if options.stdio == bool(options.socket):
+        parser.error("give either --socket PATH or --stdio")
+
+    render_server = RenderServer(cache_dir=options.cache_dir, nocache=options.nocache)
+
+    # stop cleanly (removing the socket) on SIGTERM too. (Not with SystemExit, which
+    # a render in progress would take for the exit of a parse error.)
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+    try:
+        if options.stdio:
+            serve_stdio(render_server, sys.stdin, sys.stdout)
+        else:
+            serve_socket(render_server, options.socket)
+    except KeyboardInterrupt:
+        pass
+    except (IOError, OSError) as inst:   # (socket.error is an IOError)
+        sys.stderr.write("pyp.py serve: %s\n" % inst)
+        sys.exit(1)
 
 
 def main():
 
+    if sys.argv[1:2] == ["build"]:
+        return build_main(sys.argv[2:])
+    if sys.argv[1:2] == ["compile"]:
+        return compile_main(sys.argv[2:])
+    if sys.argv[1:2] == ["records"]:
+        return records_main(sys.argv[2:])
+    if sys.argv[1:2] == ["serve"]:
+        return serve_main(sys.argv[2:])
+    if sys.argv[1:2] == ["client"]:
+        import pyp_client
+        return pyp_client.main(sys.argv[2:], prog="pyp.py client")
+
+    import argparse
+    from argparse import ArgumentParser
     parser = ArgumentParser()
 
     parser.add_argument('-o','-output','--output', dest='output_filename', help='Output file')
     parser.add_argument('-p','-py','--py', dest='python_filename', help='Output the Python file')
     parser.add_argument('-debug','--debug', dest='debug', action='store_true', default=False, help='Debug mode')
     parser.add_argument('-nofix','--nofix', dest='nofix', action='store_true', default=False, help='No fix text')
-    parser.add_argument('-seed', '--seed', dest='seed', type=int,  help='Random seed value')
+    add_common_arguments(parser)
+    parser.add_argument('-deps', '--deps', dest='deps', action='store_true', default=False,
+                        help='Also write a make-style dependency file (OUTPUT.d), needs -o')
+    add_output_arguments(parser)
+    add_watch_arguments(parser)
+    parser.add_argument('-profile', '--profile', dest='profile', action='store_true', default=False,
+                        help='Profile the render, print the slowest pyp lines and functions to stderr')
+    parser.add_argument('-profile-json', '--profile-json', dest='profile_json', metavar='FILE',
+                        help='Profile the render, write the results to FILE as JSON')
+    parser.add_argument('-profile-top', '--profile-top', dest='profile_top', type=int, default=20,
+                        help='Number of lines/functions to show in the profile report (default: 20)')
+    add_stats_arguments(parser)
     parser.add_argument('pypfile', help='Name of input pyp file')
 
     parser.add_argument('pypfile_args', nargs=argparse.REMAINDER)
 
     options = parser.parse_args()
 
+    if options.deps and not options.output_filename:
+        parser.error("--deps needs an output file (-o)")
+    if (options.skip_unchanged or options.manifest) and not options.output_filename:
+        parser.error("--skip-unchanged and --manifest need an output file (-o)")
+    if options.watch:
+        if not options.output_filename:
+            parser.error("--watch needs an output file (-o)")
+        return watch_main([(options.pypfile, options.output_filename)], options, options.pypfile_args)
 
     if options.seed != None:
+        import random
         random.seed(options.seed)
 
     inputfilename = options.pypfile
 
-    # For the template context, clean up sys.argv
-    sys.argv = [options.pypfile] + options.pypfile_args
+    set_template_argv([options.pypfile] + options.pypfile_args)
 
     inputfile = open(inputfilename,'r')
 
     text = inputfile.read()
 
-    pypparser = PYPParser(text, debug=options.debug, input_filename=inputfilename)
-    pypparser.execute(output_filename=options.output_filename,
-                                 python_filename=options.python_filename)
+    cache = None
+    if not options.nocache:
+        cache = CompileCache(cache_dir=options.cache_dir)
+
+    pypparser = PYPParser(text, debug=options.debug, input_filename=inputfilename, cache=cache,
+                          region_cache=get_region_cache(options.cache_dir, options.nocache))
+    if options.profile or options.profile_json:
+        pypparser.profiler = TemplateProfiler(pypparser)
+    pypparser.skip_unchanged = options.skip_unchanged
+    if options.manifest:
+        pypparser.output_manifest = load_output_manifest(options.manifest)
+    collector = get_stats_collector(options)
+    pypparser.observer = collector
+
+    success = pypparser.execute(output_filename=options.output_filename,
+                                python_filename=options.python_filename)
+    if success and options.manifest:
+        save_output_manifest(options.manifest, pypparser.output_manifest)
+    if success and options.deps:
+        write_depfile(options.output_filename, inputfilename)
+
+    if options.profile:
+        pypparser.profiler.report(sys.stderr, top=options.profile_top)
+    if options.profile_json:
+        import json
+        with open(options.profile_json, 'w') as f:
+            json.dump(pypparser.profiler.get_results(), f, indent=2)
+    if collector:
+        write_stats(collector, options)
 
 
 if __name__ == "__main__":
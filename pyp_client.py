@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Thin client for "pyp.py serve": sends one render request over the server's Unix domain
+socket and prints the output, with the same exit status as running pyp.py itself. Only
+needs the standard library, so it starts much faster than pyp.py.
+
+    pyp.py serve --socket /tmp/pyp.sock &
+    pyp_client.py --socket /tmp/pyp.sock -o somefile.txt somefile.txt.pyp arg1 arg2
+"""
+import os
+import sys
+import json
+import socket
+import argparse
+from argparse import ArgumentParser
+
+
+# Sends a request (a dict) to the server at socket_path and returns its response, see
+# RenderServer in pyp.py. Strings both ways are bytes decoded as latin-1.
+def send_request(socket_path, request):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request, encoding='latin-1') + "\n")
+        return json.loads(sock.makefile('rb').readline())
+    finally:
+        sock.close()
+
+def main(args, prog="pyp_client.py"):
+    parser = ArgumentParser(prog=prog,
+                            description="Render a pyp file with a running \"pyp.py serve\", with the same output "
+                                        "and exit status as pyp.py itself")
+    parser.add_argument('-socket', '--socket', dest='socket', default=os.environ.get('PYP_SOCKET'),
+                        help='Socket of the server (default: $PYP_SOCKET)')
+    parser.add_argument('-o','-output','--output', dest='output_filename', help='Output file')
+    parser.add_argument('-p','-py','--py', dest='python_filename', help='Output the Python file')
+    parser.add_argument('-seed', '--seed', dest='seed', type=int,  help='Random seed value')
+    parser.add_argument('-debug','--debug', dest='debug', action='store_true', default=False, help='Debug mode')
+    parser.add_argument('-deps', '--deps', dest='deps', action='store_true', default=False,
+                        help='Also write a make-style dependency file (OUTPUT.d) listing the pyp files used')
+    parser.add_argument('-skip-unchanged', '--skip-unchanged', dest='skip_unchanged', action='store_true',
+                        default=False, help="Don't rewrite the output file if its contents didn't change (keeps its mtime)")
+    parser.add_argument('-manifest', '--manifest', dest='manifest', metavar='FILE',
+                        help="Keep the output's hash in FILE, so an unchanged output needn't be read back "
+                             "to compare (implies --skip-unchanged)")
+    parser.add_argument('-profile', '--profile', dest='profile', action='store_true', default=False,
+                        help='Profile the render, print the slowest pyp lines and functions to stderr')
+    parser.add_argument('-profile-json', '--profile-json', dest='profile_json', metavar='FILE',
+                        help='Profile the render, write the results to FILE as JSON')
+    parser.add_argument('-profile-top', '--profile-top', dest='profile_top', type=int, default=20,
+                        help='Number of lines/functions to show in the profile report (default: 20)')
+    parser.add_argument('-stats', '--stats', dest='stats', action='store_true', default=False,
+                        help='Print where the time went (per phase), line/byte/cache counts and peak memory to stderr')
+    parser.add_argument('-stats-json', '--stats-json', dest='stats_json', metavar='FILE',
+                        help='Write the same stats to FILE as JSON, with an entry per compile and render')
+    # (options of pyp.py that don't apply to a single request, rejected below)
+    parser.add_argument('-watch', '--watch', dest='watch', action='store_true', default=False, help=argparse.SUPPRESS)
+    parser.add_argument('-cache-dir', '--cache-dir', dest='cache_dir', help=argparse.SUPPRESS)
+    parser.add_argument('-nocache', '--no-cache', dest='nocache', action='store_true', default=False,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('-stop', '--stop', dest='stop', action='store_true', default=False,
+                        help='Stop the server')
+    parser.add_argument('pypfile', nargs='?', help='Name of input pyp file')
+    parser.add_argument('pypfile_args', nargs=argparse.REMAINDER)
+
+    options = parser.parse_args(args)
+    if options.watch:
+        parser.error("--watch doesn't go through the server, run pyp.py --watch instead")
+    if options.cache_dir or options.nocache:
+        parser.error("the compile cache is the server's, give --cache-dir/--no-cache to \"pyp.py serve\"")
+    if not options.socket:
+        parser.error("no server socket, give --socket or set $PYP_SOCKET")
+    if options.stop:
+        request = {'stop': True}
+    elif not options.pypfile:
+        parser.error("too few arguments")
+    else:
+        if options.deps and not options.output_filename:
+            parser.error("--deps needs an output file (-o)")
+        if (options.skip_unchanged or options.manifest) and not options.output_filename:
+            parser.error("--skip-unchanged and --manifest need an output file (-o)")
+        request = {'cwd': os.getcwd(), 'pypfile': options.pypfile, 'args': options.pypfile_args,
+                   'output': options.output_filename, 'python': options.python_filename,
+                   'seed': options.seed, 'deps': options.deps, 'debug': options.debug,
+                   'skip_unchanged': options.skip_unchanged, 'manifest': options.manifest,
+                   'profile': options.profile, 'profile_json': options.profile_json,
+                   'profile_top': options.profile_top, 'stats': options.stats, 'stats_json': options.stats_json}
+
+    try:
+        response = send_request(options.socket, request)
+    except (socket.error, ValueError) as inst:
+        sys.stderr.write("%s: no response from server at %s: %s\n" % (prog, options.socket, inst))
+        sys.exit(2)
+
+    sys.stdout.write(response['stdout'].encode('latin-1'))
+    sys.stderr.write(response['stderr'].encode('latin-1'))
+    sys.exit(response['status'])
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
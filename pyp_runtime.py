@@ -0,0 +1,537 @@
+"""
+The part of pyp needed to run templates that are already compiled: output sinks, the
+template error types, mapping generated Python lines back to pyp lines, the helpers
+that template code calls (pypdefs, cached pypdefs, async loops), and render_code() to
+run a compiled template. The compiler is in pyp.py, which re-exports all of this.
+
+Only imports what rendering itself needs, anything else is imported where it's used, so
+that a process that just renders starts quickly (see benchmarks/bench_startup.py).
+"""
+import os
+import sys
+import functools
+import traceback
+
+
+# A python_line_map is an array('i') with the pyp line number for each generated Python
+# line (indexed by Python line number, 0 where the line has no pyp line). Returns the pyp
+# line number for python_linenum, or None.
+def get_source_linenum(line_map, python_linenum):
+    if python_linenum is None or not 0 < python_linenum < len(line_map):
+        return None
+    return line_map[python_linenum] or None
+
+
+# Base class for template errors, carries the location in the pyp source (if known)
+class TemplateError(Exception):
+    def __init__(self, text, line=None, linenum=None, filename=None):
+        Exception.__init__(self, text)
+        (self.text, self.line, self.linenum, self.filename) = (text, line, linenum, filename)
+
+    def __str__(self):
+        msgs = []
+        if self.linenum != None:
+            if self.filename:
+                msgs.append('File "%s", line %d' % (self.filename, self.linenum))
+            else:
+                msgs.append("Line %d" % (self.linenum))
+            msgs.append("Line: %s" % (self.line))
+        msgs.append(self.text)
+        return "\n".join(msgs)
+
+class ParseError(TemplateError):
+    def __init__(self, text, line, linenum):
+        TemplateError.__init__(self, text, line, linenum)
+
+# The generated Python didn't compile
+class TemplateSyntaxError(TemplateError):
+    pass
+
+# The template code raised an exception while rendering. The original exception
+# is kept in exc_type/exc_value/exc_traceback.
+class TemplateRuntimeError(TemplateError):
+    def __init__(self, text, line=None, linenum=None, filename=None, exc_info=(None, None, None)):
+        TemplateError.__init__(self, text, line, linenum, filename)
+        (self.exc_type, self.exc_value, self.exc_traceback) = exc_info
+
+
+# Joins output lines with newlines. Lines are byte strings, except where the template
+# printed a unicode value; if those don't mix with the rest (non-ASCII template text),
+# each one is encoded on its own, the way file.write() did when lines were written one at
+# a time (with encoding, the default encoding if None).
+def join_lines(lines, encoding=None):
+    try:
+        return "\n".join(lines)
+    except UnicodeDecodeError:
+        encoding = encoding or sys.getdefaultencoding()
+        return "\n".join([line.encode(encoding) if isinstance(line, unicode) else line for line in lines])
+
+
+# Closes the sink of a render that failed (maybe in closing the sink itself), without
+# letting another error hide the first one
+def close_failed_sink(sink):
+    try:
+        sink.close(False)
+    except Exception:
+        pass
+
+
+class OutputSink:
+    """
+    Where rendered output goes. The template code calls append(line) once per output line
+    (without the trailing newline); append is bound straight to _PRINT in the template's
+    globals, so it's on the hot path. close(success) is called once the render is over.
+    Lines are byte strings, or unicode where the template printed a unicode value (see
+    join_lines).
+    """
+    def append(self, line):
+        raise NotImplementedError
+
+    def close(self, success=True):
+        pass
+
+    # (lines, bytes) output so far, for render stats; None if the sink doesn't keep count.
+    # Lines are the newlines output: one append can carry several lines (a merged text run).
+    # Counting happens where the sink handles the lines anyway, never per append.
+    def get_output_counts(self):
+        return None
+
+
+# Collects the output in memory, getvalue() returns it as one string
+class ListSink(OutputSink):
+    def __init__(self):
+        self.lines = []
+        self.append = self.lines.append
+
+    def getvalue(self):
+        if not self.lines:
+            return ""
+        return join_lines(self.lines) + "\n"
+
+    def get_output_counts(self):
+        return (sum(line.count("\n") for line in self.lines) + len(self.lines),
+                sum(map(len, self.lines)) + len(self.lines))
+
+
+# Throws the output away (for benchmarking)
+class NullSink(OutputSink):
+    def append(self, line):
+        pass
+
+
+# Buffers lines and writes them to a file-like object flush_lines at a time. The stream
+# is flushed, but not closed, on close(). Unicode lines are encoded as they come in, with
+# the stream's encoding (if it has one), like file.write() would.
+#
+# Output to sys.stdout isn't buffered: print statements in the template write there
+# directly, and would otherwise come out ahead of the template text before them.
+class StreamSink(OutputSink):
+    DEFAULT_FLUSH_LINES = 512
+
+    def __init__(self, stream, flush_lines=DEFAULT_FLUSH_LINES):
+        self.stream = stream
+        self.flush_lines = 1 if stream is sys.stdout else flush_lines
+        self.encoding = getattr(stream, 'encoding', None) or sys.getdefaultencoding()
+        self.buf = []
+        self.num_lines = 0   # written to the stream so far
+        self.num_bytes = 0
+
+    def append(self, line):
+        if isinstance(line, unicode):
+            line = line.encode(self.encoding)
+        buf = self.buf
+        buf.append(line)
+        if len(buf) >= self.flush_lines:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.buf.append("")
+            data = "\n".join(self.buf)
+            del self.buf[:]
+            self.num_lines += data.count("\n")
+            self.num_bytes += len(data)
+            self.write_data(data)
+
+    def write_data(self, data):
+        self.stream.write(data)
+
+    def close(self, success=True):
+        self.flush()
+        self.stream.flush()
+
+    def get_output_counts(self):
+        return (self.num_lines + sum(line.count("\n") for line in self.buf) + len(self.buf),
+                self.num_bytes + sum(map(len, self.buf)) + len(self.buf))
+
+
+# Returns (mtime, size, sha1 of the contents) for the file at path, or None if it can't be
+# read. If old_signature has the same mtime and size, its hash is taken as is instead of
+# reading the file again.
+def get_file_signature(path, old_signature=None):
+    import hashlib
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if old_signature and old_signature[:2] == (st.st_mtime, st.st_size):
+        return old_signature
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ""):
+                digest.update(chunk)
+    except IOError:
+        return None
+    return (st.st_mtime, st.st_size, digest.hexdigest())
+
+
+# Writes to filename + ".tmp", which replaces filename only if the render succeeds.
+#
+# With skip_unchanged, the output is hashed as it's written, and if filename already has
+# the same contents the temp file is removed instead, so filename and its mtime are left
+# alone (and whatever rebuilds when it changes doesn't). manifest is a dict of output
+# filename -> signature (see get_file_signature) from earlier renders: an existing file
+# whose mtime and size match its entry isn't read back to compare. The entry is updated
+# on close. A manifest implies skip_unchanged.
+#
+# After close(), changed is True if filename was written, and signature (when hashing)
+# is its signature.
+class FileSink(StreamSink):
+    def __init__(self, filename, flush_lines=StreamSink.DEFAULT_FLUSH_LINES, skip_unchanged=False,
+                 manifest=None):
+        self.filename = filename
+        self.temp_filename = filename + ".tmp"
+        StreamSink.__init__(self, open(self.temp_filename, 'w'), flush_lines)
+        self.manifest = manifest
+        self.hash = None
+        if skip_unchanged or manifest is not None:
+            import hashlib
+            self.hash = hashlib.sha1()
+        self.changed = False
+        self.signature = None
+
+    def write_data(self, data):
+        self.stream.write(data)
+        if self.hash is not None:
+            self.hash.update(data)
+
+    def close(self, success=True):
+        if success:
+            self.flush()
+        self.stream.close()
+        if not success:
+            os.remove(self.temp_filename)
+            return
+        if self.hash is None:
+            os.rename(self.temp_filename, self.filename)
+            self.changed = True
+            return
+
+        # (a file of another size can't be the same, no need to read it)
+        old_signature = None
+        if os.path.isfile(self.filename) and os.path.getsize(self.filename) == self.num_bytes:
+            old_signature = get_file_signature(self.filename,
+                                               self.manifest.get(self.filename) if self.manifest else None)
+        if old_signature and old_signature[1:] == (self.num_bytes, self.hash.hexdigest()):
+            os.remove(self.temp_filename)
+            self.signature = old_signature
+        else:
+            os.rename(self.temp_filename, self.filename)
+            self.changed = True
+            self.signature = (os.stat(self.filename).st_mtime, self.num_bytes, self.hash.hexdigest())
+        if self.manifest is not None:
+            self.manifest[self.filename] = self.signature
+
+
+# Keeps the output in memory up to max_size bytes, then spills it to a temp file
+class SpoolSink(StreamSink):
+    DEFAULT_MAX_SIZE = 8*1024*1024
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, flush_lines=StreamSink.DEFAULT_FLUSH_LINES):
+        import tempfile
+        StreamSink.__init__(self, tempfile.SpooledTemporaryFile(max_size=max_size), flush_lines)
+
+    # Returns the spooled file, rewound for reading
+    def getfile(self):
+        self.flush()
+        self.stream.seek(0)
+        return self.stream
+
+    def getvalue(self):
+        return self.getfile().read()
+
+
+# Used by render_iter: hands the output to the consumer in chunks through a bounded queue.
+# Raises RenderAborted in the template code once stopped is set.
+class _ChunkQueueSink(OutputSink):
+    def __init__(self, chunk_size, queue_size):
+        import threading
+        import Queue
+        self.chunk_size = chunk_size
+        self.chunks = Queue.Queue(maxsize=queue_size)
+        self.stopped = threading.Event()
+        self.buf = []
+        self.buf_size = 0
+        self.num_lines = 0   # handed to the consumer so far
+        self.num_bytes = 0
+
+    def put(self, item):
+        import Queue
+        # wait for room in the queue, unless the consumer has gone away
+        while True:
+            if self.stopped.is_set():
+                raise RenderAborted()
+            try:
+                self.chunks.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def append(self, line):
+        if isinstance(line, unicode):
+            line = line.encode(sys.getdefaultencoding())
+        self.buf.append(line)
+        self.buf_size += len(line) + 1
+        if self.buf_size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.buf:
+            self.buf.append("")
+            chunk = "\n".join(self.buf)
+            self.num_lines += chunk.count("\n")
+            self.num_bytes += self.buf_size
+            self.put(("chunk", chunk))
+            self.buf = []
+            self.buf_size = 0
+
+    def get_output_counts(self):
+        return (self.num_lines + sum(line.count("\n") for line in self.buf) + len(self.buf),
+                self.num_bytes + self.buf_size)
+
+
+class CachedPypdef(object):
+    """
+    A "% pypdef cached" function: remembers the text returned for each set of arguments,
+    keeping the maxsize most recently used (all of them, if maxsize is None). Arguments
+    have to be hashable to be cached; calls with unhashable ones bypass the cache and are
+    counted as uncacheable. See cache_info() for hit/miss statistics.
+
+    In a class body it works as a method (a new-style class, for __get__): the object is
+    the first argument, and part of the key, so each object has its own cached results
+    (which keep it alive while they're cached).
+    """
+    _KWARGS_MARK = object()
+
+    def __init__(self, func, maxsize=128):
+        self.func = func
+        self.maxsize = maxsize
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+        from collections import OrderedDict
+        self.results = OrderedDict()
+        self.hits = self.misses = self.uncacheable = 0
+
+    # Method access binds the object as the first argument
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return functools.partial(self, obj)
+
+    def __call__(self, *args, **kwargs):
+        key = args
+        if kwargs:
+            key += (self._KWARGS_MARK,) + tuple(sorted(kwargs.items()))
+        try:
+            hash(key)
+        except TypeError:
+            self.uncacheable += 1
+            return self.func(*args, **kwargs)
+
+        if key in self.results:
+            self.hits += 1
+            result = self.results.pop(key)
+            self.results[key] = result   # most recently used goes last
+            return result
+
+        self.misses += 1
+        result = self.func(*args, **kwargs)
+        if self.maxsize is None or self.maxsize > 0:
+            self.results[key] = result
+            if self.maxsize is not None and len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+        return result
+
+    def cache_info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'uncacheable': self.uncacheable,
+                'maxsize': self.maxsize, 'currsize': len(self.results)}
+
+    def cache_clear(self):
+        self.results.clear()
+        self.hits = self.misses = self.uncacheable = 0
+
+# Decorator for cached pypdefs, available to templates as _PYP_CACHED
+def cached_pypdef(maxsize=128):
+    def decorator(func):
+        return CachedPypdef(func, maxsize)
+    return decorator
+
+
+# Pypdefs. "% pypdef name(args):" compiles to a writer, name(_OUTPUT, args), that appends
+# its output lines to the list _OUTPUT, and returns whatever the body returns. This
+# (_PYP_PYPDEF) wraps the writer into the name the template calls, which returns the lines
+# joined into a string, or the value of a "% return value" if that isn't None. A call
+# alone on a line in a pypdef ("${name(args)}", in output position) calls the writer
+# instead, with its own _OUTPUT: nested pypdefs all append to one list, rather than each
+# level joining and copying everything below it. A value returned there replaces the
+# lines the call wrote. (See PythonSequence._get_output_call.)
+def pypdef(write):
+    def func(*args, **kwargs):
+        output = []
+        result = write(output, *args, **kwargs)
+        if result is None:
+            return '\n'.join(output)
+        return result
+    func.__name__ = write.__name__
+    func.__doc__ = write.__doc__
+    func._pyp_write = write
+    return func
+
+# A writer for something in output position that isn't a pypdef (_PYP_VALUE_WRITER)
+def value_writer(func):
+    def write(output, *args, **kwargs):
+        output.append('%s' % (func(*args, **kwargs),))
+    return write
+
+# A call alone on a line at the top level of the template (_PYP_PRINT_CALL): a pypdef's
+# lines go to print_func (_PRINT) one by one, they're never joined
+def print_call(_pyp_print_func, _pyp_func, *args, **kwargs):
+    write = getattr(_pyp_func, '_pyp_write', None)
+    if write is None:
+        _pyp_print_func('%s' % (_pyp_func(*args, **kwargs),))
+        return
+    output = []
+    result = write(output, *args, **kwargs)
+    if result is not None:
+        _pyp_print_func('%s' % (result,))
+        return
+    for line in output:
+        _pyp_print_func(line)
+
+# A run of adjacent text lines with ${} expressions (_PYP_PRINT_RUN): values are filled into
+# the format string of the whole run, which goes to print_func as one string. If the run
+# mixes unicode values with non-ASCII str text or values, each line is filled in and
+# printed on its own instead, just like text lines that aren't merged. (The format strings
+# are generated, "%%" and "%s" are all they contain.)
+def print_run(print_func, format_string, values):
+    try:
+        text = format_string % values
+    except UnicodeDecodeError:
+        start = 0
+        for line_format in format_string.split("\n"):
+            count = line_format.replace("%%", "").count("%s")
+            print_func(line_format % values[start:start+count])
+            start += count
+        return
+    print_func(text)
+
+
+# Yielded by async template code on every loop iteration, so render_async can send out
+# a chunk once enough output has built up. Never passed on to the event loop.
+ASYNC_CHECKPOINT = object()
+
+# What an "% async for" source's awaitables resolve to once there are no more items
+ASYNC_END = object()
+
+class Ready:
+    """
+    An awaitable whose value is already known. render_async sends the value straight back
+    into the template instead of passing it to the event loop.
+    """
+    def __init__(self, value):
+        self.value = value
+
+class AsyncIterator:
+    """
+    What "% async for" loops over: anext() returns an awaitable for the next item, which
+    resolves to ASYNC_END after the last one. Sources with their own anext() are used as
+    they are; plain iterables of awaitables (like a list of futures) are wrapped in this.
+    """
+    def __init__(self, iterable):
+        self.iterator = iter(iterable)
+
+    def anext(self):
+        for awaitable in self.iterator:
+            return awaitable
+        return Ready(ASYNC_END)
+
+def async_iter(source):
+    if hasattr(source, 'anext'):
+        return source
+    return AsyncIterator(source)
+
+
+# Raised inside the template code when the consumer of render_iter() goes away
+class RenderAborted(Exception):
+    pass
+
+
+# Globals for one run of template code: the context, plus what the generated code calls.
+# (PYPParser adds _PYP and _PYP_CACHE_REGION, for includes and cache regions.)
+def make_namespace(print_func, context=None, filename=None):
+    namespace = {}
+    if context:
+        namespace.update(context)
+    namespace.update({
+        '__name__': '__main__',
+        '__file__': filename,
+        '_PRINT': print_func,
+        '_PYP_CACHED': cached_pypdef,
+        '_PYP_PYPDEF': pypdef,
+        '_PYP_VALUE_WRITER': value_writer,
+        '_PYP_PRINT_CALL': print_call,
+        '_PYP_PRINT_RUN': print_run,
+        '_PYP_CHECKPOINT': ASYNC_CHECKPOINT,
+        '_PYP_AITER': async_iter,
+        '_PYP_ASYNC_END': ASYNC_END,
+        })
+    return namespace
+
+# pyp (line number, line text) for the innermost frame of a traceback that's in the template
+# code, (None, None) if it can't be found
+def get_error_location(tb, code_filename, line_map, source_lines):
+    for (filename, python_linenum, _, _) in reversed(traceback.extract_tb(tb)):
+        if filename == code_filename:
+            linenum = get_source_linenum(line_map, python_linenum)
+            if linenum is not None and linenum <= len(source_lines):
+                return (linenum, source_lines[linenum-1])
+            break
+    return (None, None)
+
+# Runs a compiled template without the compiler: code as compiled by pyp.py (for example
+# from PYPParser.compile_code, with its python_line_map), source_lines the pyp source split
+# into lines. Output goes to out, a file-like object or an OutputSink (closed afterwards,
+# with success=False if the render failed). Keyword arguments become template globals.
+# The template can't include/import files or use cache regions, those need pyp.py.
+# Errors are raised as TemplateRuntimeErrors.
+def render_code(code, out, line_map, source_lines, filename=None, **context):
+    if isinstance(out, OutputSink):
+        sink = out
+    else:
+        sink = StreamSink(out)
+
+    try:
+        exec code in make_namespace(sink.append, context, filename)
+    except:
+        exc_info = sys.exc_info()
+        close_failed_sink(sink)
+        (linenum, line) = get_error_location(exc_info[2], code.co_filename, line_map, source_lines)
+        raise TemplateRuntimeError("%s: %s" % (exc_info[0].__name__, exc_info[1]), line, linenum,
+                                   filename, exc_info), None, exc_info[2]
+    try:
+        sink.close(True)
+    except:
+        exc_info = sys.exc_info()
+        close_failed_sink(sink)
+        raise exc_info[0], exc_info[1], exc_info[2]